@@ -0,0 +1,131 @@
+"""Headless benchmark of the liveview pipeline. Drives UserInterface with a SimulatedInstrument and reports sustained
+display rate, dropped frames, per frame latency and memory growth.
+
+    python -m benchmarks.live_pipeline --fps 100 --channels 2 --duration 20
+
+Runs offscreen by default. If the offscreen Qt platform has no OpenGL on the machine, run it with
+xvfb-run and --platform xcb instead."""
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+
+
+def memory_mb():
+
+    """Current resident memory of process in MB from psutil or /proc. None if neither is available"""
+
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1e6
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def run(args):
+
+    os.environ.setdefault('QT_QPA_PLATFORM', args.platform)
+    from qtpy.QtWidgets import QApplication
+    import qtpy.QtCore as QtCore
+    from dispim_userinterface import UserInterface
+    from widgets.waveform_cache import waveform_cache
+    from benchmarks.simulated_instrument import SimulatedInstrument
+
+    instrument = SimulatedInstrument(fps=args.fps, rows=args.rows, columns=args.columns, channels=args.channels)
+    ui = UserInterface(config_filepath='', simulated=True, instrument=instrument,
+                       experimenters_name='benchmark', show=True)
+    livestream = ui.livestream_parameters
+    livestream.display_rate['fps'].setValue(args.display_fps)
+    livestream.display_rate['multiscale'].setChecked(args.multiscale)
+    livestream.display_rate['autocontrast'].setChecked(args.autocontrast)
+    livestream.latency_panel['record'].setChecked(True)
+
+    app = QApplication.instance()
+    results = {}
+
+    def start():
+        gc.collect()
+        results['memory_start_mb'] = memory_mb()
+        tracemalloc.start()
+        instrument.start_livestream(instrument.cfg.imaging_wavelengths)
+        livestream.start_frame_pipeline()
+        results['start'] = perf_counter()
+
+    def stop():
+        elapsed = perf_counter() - results.pop('start')
+        paced = livestream.frame_pacer.stats()
+        buffered = livestream.frame_buffer.stats()
+        latency = livestream.latency.summary()
+        totals = livestream.latency.totals_ms()
+        livestream.stop_frame_pipeline()
+        instrument.stop_livestream()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        gc.collect()
+
+        results.update({
+            'duration_s': round(elapsed, 2),
+            'camera_fps': round(buffered['written'] / elapsed / args.channels, 1),
+            'display_fps': round(paced['repaints'] / elapsed / args.channels, 1),
+            'drop_rate': round(buffered['dropped'] / max(buffered['written'], 1), 3),
+            'skipped': paced['skipped'],
+            'latency_ms': {k: round(v, 2) for k, v in latency.items()},
+            'latency_p95_ms': round(float(sorted(totals)[int(.95 * (len(totals) - 1))]), 2) if len(totals) else None,
+            'python_peak_mb': round(peak / 1e6, 1),
+            'memory_end_mb': memory_mb(),
+        })
+        if results['memory_start_mb'] is not None and results['memory_end_mb'] is not None:
+            results['memory_growth_mb'] = round(results['memory_end_mb'] - results['memory_start_mb'], 1)
+            results['memory_start_mb'] = round(results['memory_start_mb'], 1)
+            results['memory_end_mb'] = round(results['memory_end_mb'], 1)
+        app.quit()
+
+    QtCore.QTimer.singleShot(round(args.warmup * 1000), start)
+    QtCore.QTimer.singleShot(round((args.warmup + args.duration) * 1000), stop)
+    app.exec_()
+    results.update({'startup_queries_ms': ui.snapshot.stats(),
+                    'stage_commands': ui.stage_commands.stats(),
+                    'reconfiguration': ui.reconfiguration.stats(),
+                    'laser_io': ui.laser_io.stats(),
+                    'waveform_cache': waveform_cache.stats(),
+                    'waveforms_generated': instrument.waveforms_generated})
+    ui.close_instrument()   # Stops service threads and restores instrument module like closing the gui
+    ui.viewer.close()
+    return results
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fps', type=float, default=100, help='camera frame rate per channel')
+    parser.add_argument('--rows', type=int, default=2048, help='sensor rows')
+    parser.add_argument('--columns', type=int, default=2048, help='sensor columns')
+    parser.add_argument('--channels', type=int, default=1, help='number of channels streamed')
+    parser.add_argument('--display-fps', type=int, default=30, help='target display rate')
+    parser.add_argument('--multiscale', action='store_true', help='display pyramid level fitting zoom')
+    parser.add_argument('--autocontrast', action='store_true', help='compute streaming autocontrast')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to measure')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds before measuring')
+    parser.add_argument('--platform', default='offscreen', help='Qt platform plugin')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for k, v in results.items():
+            print(f'{k}: {v}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
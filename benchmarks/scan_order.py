@@ -0,0 +1,64 @@
+"""Check and benchmark of scan order optimizer. Runs the edge cases the scan table hits, one queued scan and every scan
+but one pinned, then times optimizing a random queue.
+
+    python -m benchmarks.scan_order --scans 30"""
+import argparse
+import json
+import sys
+from time import perf_counter
+import numpy as np
+from widgets.scan_order import optimize_order, route_time, travel_matrix
+
+
+def random_scans(count: int, seed: int = 0):
+
+    rng = np.random.default_rng(seed)
+    return [{'start_pos_um': dict(zip(['x', 'y', 'z'], rng.uniform(0, 40000, 3))),
+             'volume_x_um': 2000., 'volume_y_um': 2000., 'volume_z_um': 1000.} for _ in range(count)]
+
+
+def check_edge_cases():
+
+    """Queues of one scan and queues with one unpinned scan keep their order and give finite travel times"""
+
+    start = {'x': 0, 'y': 0, 'z': 0}
+    for start_um in (start, None):
+        one = random_scans(1)
+        times = travel_matrix(one, start_um)
+        assert np.isfinite(route_time([0], times))
+        assert optimize_order(one, start_um)[0] == [0]
+
+        scans = random_scans(5)
+        order, before, after = optimize_order(scans, start_um, pinned={0, 1, 3, 4})
+        assert order == list(range(5)) and after == before
+
+
+def run(args):
+
+    check_edge_cases()
+    scans = random_scans(args.scans, args.seed)
+    start = perf_counter()
+    order, before, after = optimize_order(scans, {'x': 0, 'y': 0, 'z': 0})
+    return {'scans': args.scans, 'before_s': round(before, 1), 'after_s': round(after, 1),
+            'optimize_ms': round((perf_counter() - start) * 1000, 1)}
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scans', type=int, default=30, help='scans in random queue')
+    parser.add_argument('--seed', type=int, default=0, help='seed of random queue')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for k, v in results.items():
+            print(f'{k}: {v}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,284 @@
+"""Stand in for ispim.Ispim that generates synthetic frames so the gui can be driven without hardware"""
+import threading
+import numpy as np
+from time import sleep, perf_counter
+
+
+def generate_waveforms(cfg, lasers):
+
+    """Synthetic waveforms in place of ispim's. Module level like in the instrument module so the gui's waveform cache
+    is installed over it
+    :return: (t, voltages) with a ramp for every laser"""
+
+    samples = max(int(cfg.get_period_time() * 10000), 2)
+    t = np.linspace(0, cfg.get_period_time(), samples)
+    return t, np.tile(np.linspace(0, 5, samples), (len(lasers), 1))
+
+
+class SimulatedConfig:
+
+    def __init__(self, rows: int = 2048, columns: int = 2048, wavelengths: list = None):
+
+        """Config with the attributes the widgets read from ispim's config
+            :param rows: sensor rows of synthetic frames
+            :param columns: sensor columns of synthetic frames
+            :param wavelengths: wavelengths of simulated lasers
+        """
+
+        wavelengths = [488, 561] if wavelengths is None else wavelengths
+        colors = ['cyan', 'lime', 'orange', 'magenta', 'red', 'purple']
+        self.laser_wavelengths = list(wavelengths)
+        self.imaging_wavelengths = list(wavelengths)
+        self.laser_specs = {str(wl): {'color': colors[i % len(colors)],
+                                      'intensity_mode': 'current',
+                                      'galvo': {'x_offset_v': 2.5, 'y_offset_v': 2.5},
+                                      'etl': {'offset_v': 2.5, 'amplitude_v': .5}}
+                            for i, wl in enumerate(wavelengths)}
+        self.sensor_row_count = rows
+        self.sensor_column_count = columns
+        self.tile_specs = {'x_field_of_view_um': rows * .75, 'y_field_of_view_um': columns * .75}
+        self.tile_size_x_um = self.tile_specs['x_field_of_view_um']
+        self.tile_size_y_um = self.tile_specs['y_field_of_view_um']
+        self.acquisition_style = 'interleaved'
+        self.volume_x_um = 1000
+        self.volume_y_um = 1000
+        self.volume_z_um = 1000
+        self.z_step_size_um = 1
+        self.tile_overlap_x_percent = 15
+        self.tile_overlap_y_percent = 15
+        self.imaging_specs = {'volume_x_um': 1000, 'volume_y_um': 1000, 'volume_z_um': 1000, 'filetype': 'Tiff'}
+        self.camera_specs = {'scan_direction': 'FORWARD'}
+        self.exposure_time = .01
+        self.slit_width_pix = 20
+        self.daq_ao_names_to_channels = {}
+        self.experimenters_name = 'benchmark'
+        self.local_storage_dir = '.'
+        self.ext_storage_dir = '.'
+        self.subject_id = 'benchmark'
+        self.tile_prefix = 'tile'
+
+    def get_period_time(self):
+        return .01
+
+    def save(self):
+        pass
+
+
+class SimulatedSamplePose:
+
+    def __init__(self):
+
+        self.position = {'x': 0, 'y': 0, 'z': 0}  # 1/10 um
+
+    def get_position(self, *axes):
+        return dict(self.position)
+
+    def get_travel_limits(self, *axes):
+        return {axis: [-50, 50] for axis in (axes if axes else ['x', 'y', 'z'])}  # mm
+
+
+class SimulatedTigerbox:
+
+    def __init__(self, sample_pose: SimulatedSamplePose):
+
+        self.sample_pose = sample_pose
+
+    def get_position(self, *axes):
+        return {'Z': self.sample_pose.position['y']}
+
+    def move_absolute(self, **axes):
+        if 'z' in axes:
+            self.sample_pose.position['y'] = axes['z']
+
+    def halt(self):
+        pass
+
+    def get_joystick_axis_mapping(self):
+        return {}
+
+    def bind_axis_to_joystick_input(self, **axes):
+        pass
+
+
+class SimulatedLaser:
+
+    def __init__(self, setpoint: float = 15, max_setpoint: float = 100, delay_s: float = .005):
+
+        """Laser driver answering after a serial delay
+            :param delay_s: seconds each command takes
+        """
+
+        self.setpoint = setpoint
+        self.max_setpoint = max_setpoint
+        self.delay_s = delay_s
+
+    def get_setpoint(self):
+        sleep(self.delay_s)
+        return self.setpoint
+
+    def get_max_setpoint(self):
+        sleep(self.delay_s)
+        return self.max_setpoint
+
+    def set_setpoint(self, value: float):
+        sleep(self.delay_s)
+        self.setpoint = value
+
+
+class SimulatedCombiner:
+
+    def __init__(self, delay_s: float = .005):
+
+        self.split = '15%'
+        self.delay_s = delay_s
+
+    def get_percentage_split(self):
+        sleep(self.delay_s)
+        return self.split
+
+    def set_percentage_split(self, value):
+        sleep(self.delay_s)
+        self.split = f'{value}%'
+
+
+class SimulatedNI:
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def rereserve_buffer(self, length: int):
+        pass
+
+
+class SimulatedFrameGrabber:
+
+    def get_line_interval(self):
+        return [10]
+
+    def set_line_interval(self, *args, **kwargs):
+        pass
+
+    def set_exposure_time(self, *args, **kwargs):
+        pass
+
+    def set_scan_direction(self, *args, **kwargs):
+        pass
+
+
+class SimulatedInstrument:
+
+    def __init__(self, fps: float = 100, rows: int = 2048, columns: int = 2048, channels: int = 2):
+
+        """Generates synthetic uint16 frames at a fixed rate from _livestream_worker like the real instrument
+            :param fps: rate frames are generated at for every channel
+            :param rows: sensor rows of synthetic frames
+            :param columns: sensor columns of synthetic frames
+            :param channels: number of simulated laser channels
+        """
+
+        wavelengths = [405, 488, 561, 638, 730, 800][:channels]
+        self.cfg = SimulatedConfig(rows, columns, wavelengths)
+        self.simulated = True
+        self.fps = fps
+        self.frame_grabber = SimulatedFrameGrabber()
+        self.ni = SimulatedNI()
+        self.sample_pose = SimulatedSamplePose()
+        self.tigerbox = SimulatedTigerbox(self.sample_pose)
+        self.lasers = {str(wl): SimulatedLaser() for wl in wavelengths}
+        self.lasers['main'] = SimulatedCombiner()
+        self.channel_gene = {}
+        self.stage_query_lock = threading.Lock()
+        self.livestream_enabled = threading.Event()
+        self.overview_set = threading.Event()
+        self.scout_mode = False
+        self.setting_up_livestream = False
+        self.active_lasers = None
+        self.start_pos = None
+        self.overview_imgs = []
+        self.total_tiles = None
+        self.tiles_acquired = None
+        self.latest_frame_layer = None
+        self.est_run_time = None
+        self.start_time = None
+        self.img_storage_dir = None
+        self.cache_storage_dir = '.'
+        self.waveforms_generated = 0    # Calls of _setup_waveform_hardware and setup_imaging_for_laser
+        self.frames = self.synthetic_frames(rows, columns, wavelengths)
+
+    def synthetic_frames(self, rows: int, columns: int, wavelengths: list, count: int = 8):
+
+        """A few noisy frames with a bright blob per channel that are cycled through while streaming"""
+
+        rng = np.random.default_rng(0)
+        r, c = np.ogrid[:rows, :columns]
+        frames = {}
+        for i, wl in enumerate(wavelengths):
+            frames[wl] = []
+            for k in range(count):
+                center = (rows * (.3 + .05 * k), columns * (.2 + .1 * i))
+                blob = 20000 * np.exp(-((r - center[0]) ** 2 + (c - center[1]) ** 2) / (2 * (rows / 10) ** 2))
+                noise = rng.integers(90, 110, size=(rows, columns))
+                frames[wl].append((blob + noise).astype(np.uint16))
+        return frames
+
+    def _setup_waveform_hardware(self, wavelengths: list = None, live: bool = False):
+
+        """Generate waveforms like the instrument does on every hardware setup"""
+
+        wavelengths = self.cfg.imaging_wavelengths if wavelengths is None else wavelengths
+        _, voltages = generate_waveforms(self.cfg, wavelengths)
+        self.ni.rereserve_buffer(voltages.shape[1])
+        self.waveforms_generated += 1
+
+    def setup_imaging_for_laser(self, wavelength, live: bool = False):
+        self._setup_waveform_hardware([wavelength], live)
+
+    def start_livestream(self, wavelengths: list = None, scout_mode: bool = False):
+        self.active_lasers = wavelengths if wavelengths is not None else self.cfg.imaging_wavelengths
+        self.scout_mode = scout_mode
+        self.livestream_enabled.set()
+
+    def stop_livestream(self):
+        self.livestream_enabled.clear()
+
+    def _livestream_worker(self):
+
+        """Yield (frame, wavelength) for every active channel at the configured rate"""
+
+        period = 1 / self.fps
+        deadline = perf_counter()
+        i = 0
+        while self.livestream_enabled.is_set():
+            for wl in self.active_lasers:
+                frames = self.frames[wl]
+                yield frames[i % len(frames)], wl
+            i += 1
+            deadline += period
+            delay = deadline - perf_counter()
+            if delay > 0:
+                sleep(delay)
+
+    def _acquisition_livestream_worker(self):
+        yield from self._livestream_worker()
+
+    def set_scan_start(self, start):
+        self.start_pos = start
+
+    def wait_to_stop(self, axis, position):
+        pass
+
+    def get_xy_grid_step(self, x_overlap, y_overlap):
+        return (self.cfg.tile_size_x_um * (1 - x_overlap / 100), self.cfg.tile_size_y_um * (1 - y_overlap / 100))
+
+    def get_tile_counts(self, x_overlap, y_overlap, z_step, volume_x, volume_y, volume_z):
+        x_step, y_step = self.get_xy_grid_step(x_overlap, y_overlap)
+        return (int(np.ceil(volume_x / x_step)), int(np.ceil(volume_y / y_step)), int(np.ceil(volume_z / z_step)))
+
+    def acquisition_time(self, x, y, z):
+        return x * y * z / self.fps / 86400
+
+    def close(self):
+        self.livestream_enabled.clear()
@@ -1,6 +1,10 @@
 """Launch dispim UI"""
 import os
+from time import perf_counter
+from widgets.startup_profile import StartupProfile
+import_start = perf_counter()
 from dispim_userinterface import UserInterface
+UI_IMPORT_S = perf_counter() - import_start
 import logging
 from coloredlogs import ColoredFormatter
 import sys
@@ -29,6 +33,7 @@ class create_UI():
         log_level = "INFO"  # ["INFO", "DEBUG"]
         color_console_output = True
         console_output = True
+        profile_startup = '--profile-startup' in sys.argv  # Print import and widget build times
 
         # Setup logging.
         # Create log handlers to dispatch:
@@ -67,9 +72,12 @@ class create_UI():
             config_path = rf'C:\Users\{os.getlogin()}\Documents\dispim_files\config.toml'
 
 
+        profile = StartupProfile(enabled=profile_startup, start=import_start)
+        profile.record('import dispim_userinterface', UI_IMPORT_S)
         self.UI = UserInterface(config_filepath=config_path,
                             console_output_level=log_level,
-                            simulated=simulated)
+                            simulated=simulated,
+                            profile=profile)
         # finally:
         #     file_handler.close()
         #     logger.removeHandler(file_handler)
@@ -2,17 +2,24 @@ import napari
 from qtpy.QtWidgets import QDockWidget, QTabWidget,QPlainTextEdit, QDialog, QFrame, QMessageBox, QInputDialog, \
     QLineEdit, QWidget
 from PyQt5 import QtWidgets
-import ispim.ispim as ispim
 from widgets.instrument_parameters import InstrumentParameters
 from widgets.volumeteric_acquisition import VolumetericAcquisition
 from widgets.livestream import Livestream
-from widgets.lasers import Lasers
+from widgets.lasers import Lasers, laser_state_queries
+from widgets.laser_io import LaserIOPool
+from widgets.hardware_snapshot import HardwareSnapshot
 from widgets.tissue_map import TissueMap
+from widgets.stage_position import StagePositionService
+from widgets.stage_commands import StageCommandExecutor
+from widgets.reconfiguration import ReconfigurationScheduler
+from widgets.waveform_cache import waveform_cache
+from widgets.startup_profile import StartupProfile
 import traceback
-import pyqtgraph.opengl as gl
 import io
 import logging
 import numpy as np
+import sys
+from time import perf_counter
 
 class UserInterface:
 
@@ -20,30 +27,71 @@ class UserInterface:
                  log_filename: str = 'debug.log',
                  console_output: bool = True,
                  console_output_level: str = 'info',
-                 simulated: bool = False):
+                 simulated: bool = False,
+                 instrument=None,
+                 experimenters_name: str = None,
+                 show: bool = True,
+                 profile: StartupProfile = None):
+
+            """
+                :param config_filepath: path to instrument config
+                :param simulated: if instrument is in simulate mode
+                :param instrument: already created instrument to use instead of creating an ispim.Ispim from config
+                :param experimenters_name: skips popup asking for experimenters name if given
+                :param show: show napari window
+                :param profile: times building of gui. Printed once window is ready if enabled
+            """
 
         #try:
 
-            self.instrument = ispim.Ispim(config_filepath=config_filepath, simulated=simulated)
+            self.profile = profile if profile is not None else StartupProfile()
+            if instrument is None:
+                with self.profile.step('instrument'):
+                    import ispim.ispim as ispim
+                    instrument = ispim.Ispim(config_filepath=config_filepath, simulated=simulated)
+            self.instrument = instrument
+            # Instrument regenerates waveforms on every hardware setup so let it share gui's cache
+            waveform_cache.install(sys.modules.get(type(self.instrument).__module__))
             self.simulated = simulated
             self.cfg = self.instrument.cfg
-            self.viewer = napari.Viewer(title='ISPIM control', axis_labels=('y','x'))
-            self.experimenters_name_popup()         # Popup for experimenters name.
-                                                    # Determines what parameters will be exposed
+            self.reconfiguration = ReconfigurationScheduler(self.instrument)  # Debounces hardware reprograms
+            self.stage_commands = StageCommandExecutor(self.instrument)    # All stage I/O goes through this queue
+            self.position_service = StagePositionService(self.instrument,
+                                                         commands=self.stage_commands)    # Shared poller of stage position
+            self.laser_io = LaserIOPool(self.instrument.lasers)     # One worker per laser serial link
+            # Read hardware in the background while viewer is made and experimenter types their name
+            self.snapshot = HardwareSnapshot()
+            self.snapshot.prefetch(self.startup_queries())
+            with self.profile.step('napari viewer'):
+                self.viewer = napari.Viewer(title='ISPIM control', axis_labels=('y','x'), show=show)
+            if experimenters_name is None:
+                self.experimenters_name_popup()         # Popup for experimenters name.
+                                                        # Determines what parameters will be exposed
+            else:
+                self.cfg.experimenters_name = experimenters_name
+            with self.profile.step('waiting on hardware snapshot'):
+                self.snapshot.wait()
+            logging.getLogger(__name__).info(f'Startup query times (ms): {self.snapshot.stats()}')
             # Set up laser sliders and tabs
-            self.laser_widget()
+            with self.profile.step('laser sliders'):
+                self.laser_widget()
 
             # Set up automatically generated widget labels and inputs
-            instr_params_window = self.instrument_params_widget()
+            with self.profile.step('instrument parameters'):
+                instr_params_window = self.instrument_params_widget()
 
             # Set up main window on gui which combines livestreaming and volumeteric imaging
             main_window = QDockWidget()
             main_window.setWindowTitle('Main')
+            with self.profile.step('livestream'):
+                live = self.livestream_widget()
+            with self.profile.step('volumetric acquisition'):
+                vol = self.volumeteric_acquisition_widget()
+            with self.profile.step('stage slider'):
+                stage_slider = self.livestream_parameters.move_stage_widget()
             main_widgets = {
-                'main_block': self.instrument_params.create_layout(struct='V',
-                                                                      live = self.livestream_widget(),
-                                                                      vol = self.volumeteric_acquisition_widget()),
-                'stage_slider': self.livestream_parameters.move_stage_widget(),
+                'main_block': self.instrument_params.create_layout(struct='V', live=live, vol=vol),
+                'stage_slider': stage_slider,
             }
             main_widgets['stage_slider'].setMaximumWidth(100)
             main_window.setWidget(self.instrument_params.create_layout(struct='H', **main_widgets))
@@ -56,14 +104,16 @@ class UserInterface:
             }
             laser_window.setWidget(self.laser_parameters.create_layout(struct='H', **laser_widget))
 
-            # Set up tissue map widget
-            self.tissue_map_window = self.tissue_map_widget()
+            # Set up tissue map widget. Map itself is built the first time its tab is shown
+            with self.profile.step('tissue map controls'):
+                self.tissue_map_window = self.tissue_map_widget()
 
             # Add dockwidgets to viewer
             tabbed_widgets = QTabWidget()  # Creating tab object
             tabbed_widgets.setTabPosition(QTabWidget.South)
             tabbed_widgets.addTab(main_window, 'Main Window')  # Adding main window tab
             tabbed_widgets = self.laser_parameters.add_wavelength_tabs(tabbed_widgets)  # Generate laser wl tabs
+            tabbed_widgets.currentChanged.connect(self.build_tab)  # Wavelength tabs and map are built when shown
             tabbed_widgets.addTab(self.tissue_map_window, 'Tissue Map')  # Adding tissue map tab
             self.tissue_map.set_tab_widget(tabbed_widgets)  # Passing in tab widget to tissue map
             self.livestream_parameters.set_tab_widget(tabbed_widgets)  # Passing in tab widget to livestream
@@ -85,8 +135,11 @@ class UserInterface:
 
             # TODO: Move set scan to tissue map tab?
 
-            self.viewer.window.add_dock_widget(instr_params_window, name='Instrument Parameters', area='left')
-            self.viewer.window.add_dock_widget(laser_window, name="Laser Current", area='bottom')
+            with self.profile.step('dock widgets'):
+                self.viewer.window.add_dock_widget(instr_params_window, name='Instrument Parameters', area='left')
+                self.viewer.window.add_dock_widget(laser_window, name="Laser Current", area='bottom')
+                self.viewer.window.add_dock_widget(self.livestream_parameters.latency_widget(), name='Liveview Latency',
+                                                   area='right')
 
             self.viewer.scale_bar.visible = True
             self.viewer.scale_bar.unit = "um"
@@ -94,13 +147,36 @@ class UserInterface:
 
             # hide layers with <hidden> in name
             self.viewer.window.qt_viewer.layers.model().filterAcceptsRow = self._filter
+            self.profile.report()
 
         # finally:
         #     self.close_instrument()
 
+    def startup_queries(self):
+
+        """Hardware values widgets read while they're built. Stage values go through the stage services so their
+        caches are filled, and each laser is its own device so lasers are read in parallel
+        :return: device name to list of (key, function, *args)"""
+
+        stage = [('stage_position', self.position_service.get_position),
+                 ('tigerbox_z', self.stage_commands.query, self.instrument.tigerbox.get_position, 'z'),
+                 ('joystick_mapping', self.stage_commands.query, self.instrument.tigerbox.get_joystick_axis_mapping)]
+        if not self.simulated:
+            stage.append(('travel_limits', self.position_service.get_travel_limits, 'x', 'y', 'z'))
+        devices = {'tigerbox': stage}
+        queries = self.laser_io.missing(laser_state_queries(self.cfg.laser_wavelengths, self.instrument.lasers,
+                                                            self.simulated))
+        for name, commands in queries.items():
+            devices[f'laser {name}'] = [(f'laser {name} {command}', self.laser_io.read, name, command)
+                                        for command in commands]
+        return devices
+
     def instrument_params_widget(self):
         self.instrument_params = InstrumentParameters(self.instrument.frame_grabber, self.cfg.sensor_column_count,
-                                                      self.simulated, self.instrument, self.cfg)
+                                                      self.simulated, self.instrument, self.cfg,
+                                                      stage_commands=self.stage_commands,
+                                                      reconfiguration=self.reconfiguration,
+                                                      snapshot=self.snapshot)
 
         tabbed_widgets = QTabWidget()  # Creating tab object
         tabbed_widgets.setTabPosition(QTabWidget.North)
@@ -135,7 +211,9 @@ class UserInterface:
 
     def livestream_widget(self):
 
-        self.livestream_parameters = Livestream(self.viewer, self.cfg, self.instrument, self.simulated)
+        self.livestream_parameters = Livestream(self.viewer, self.cfg, self.instrument, self.simulated,
+                                                position_service=self.position_service, snapshot=self.snapshot,
+                                                reconfiguration=self.reconfiguration)
 
         widgets = {
             'screenshot': self.livestream_parameters.screenshot_button(),
@@ -146,7 +224,8 @@ class UserInterface:
 
     def volumeteric_acquisition_widget(self):
 
-        self.vol_acq_params = VolumetericAcquisition(self.viewer, self.cfg, self.instrument, self.simulated)
+        self.vol_acq_params = VolumetericAcquisition(self.viewer, self.cfg, self.instrument, self.simulated,
+                                                     position_service=self.position_service)
         widgets = {
             'volumetric_image': self.vol_acq_params.volumeteric_imaging_button(),
             'waveform': self.vol_acq_params.waveform_graph(),
@@ -156,7 +235,8 @@ class UserInterface:
 
     def laser_widget(self):
 
-        self.laser_parameters = Lasers(self.viewer, self.cfg, self.instrument, self.simulated)
+        self.laser_parameters = Lasers(self.viewer, self.cfg, self.instrument, self.simulated,
+                                       reconfiguration=self.reconfiguration, laser_io=self.laser_io)
 
         if 'main' in self.cfg.laser_specs.keys():
             widgets = {
@@ -172,15 +252,17 @@ class UserInterface:
 
     def tissue_map_widget(self):
 
-        self.tissue_map = TissueMap(self.instrument, self.viewer)
+        # Overview reports progress to the acquisition progress bar
+        self.tissue_map = TissueMap(self.instrument, self.viewer, self.position_service,
+                                    progress_events=self.vol_acq_params.progress_events)
         quick_scan_widget = self.tissue_map.overview_widget()
-        # Connect quick scan to progress bar
-        quick_scan_widget.children()[1].released.connect(lambda: self.vol_acq_params._progress_bar_worker().start())
         # Add scans to tissue map
         self.vol_acq_params.volumetric_image['start'].menu().aboutToHide.connect(lambda:self.tissue_map.draw_configured_scans(self.vol_acq_params.acquisition_order))
         self.vol_acq_params.volumetric_image['start'].menu().actions()[0].triggered.connect(lambda:self.tissue_map.draw_configured_scans(self.vol_acq_params.acquisition_order))
+        # Plan scans around tissue in overview
+        self.tissue_map.planning['plan'].clicked.connect(self.plan_scans)
         widgets = {
-            'graph': self.tissue_map.graph(),
+            'graph': self.tissue_map.deferred_graph(),
             'functions': self.tissue_map.create_layout
             (struct='H',point=self.tissue_map.mark_graph(),
                                                        quick_scan = quick_scan_widget)
@@ -190,6 +272,28 @@ class UserInterface:
 
         return self.tissue_map.create_layout(struct='V', **widgets)
 
+    def build_tab(self, index: int):
+
+        """Build contents of wavelength or tissue map tab the first time it's shown
+        :param index: index of tab shown"""
+
+        start = perf_counter()
+        built = self.laser_parameters.build_wavelength_tab(index)
+        if built is not None:
+            self.profile.record(f'wavelength {built} tab', perf_counter() - start)
+        elif index == len(self.tissue_map.tab_widget) - 1 and self.tissue_map.build_graph():
+            self.tissue_map.draw_configured_scans(self.vol_acq_params.acquisition_order)
+            self.profile.record('tissue map', perf_counter() - start)
+
+    def plan_scans(self):
+
+        """Add scans covering tissue found in overview to acquisition and draw them in tissue map"""
+
+        scans = self.tissue_map.plan_scans()
+        if scans:
+            self.vol_acq_params.add_scans(scans)
+            self.tissue_map.draw_configured_scans(self.vol_acq_params.acquisition_order)
+
 
     def experimenters_name_popup(self):
 
@@ -207,5 +311,14 @@ class UserInterface:
         return "<hidden>" not in self.viewer.layers[row].name
 
     def close_instrument(self):
+        self.position_service.stop()
+        self.stage_commands.stop()
+        logging.getLogger(__name__).info(f'Stage command queue: {self.stage_commands.stats()}')
+        logging.getLogger(__name__).info(f'Hardware reconfiguration: {self.reconfiguration.stats()}')
+        logging.getLogger(__name__).info(f'Waveform cache: {waveform_cache.stats()}')
+        self.reconfiguration.close()   # Nothing may touch ni tasks while instrument closes
+        self.laser_parameters.laser_io.stop()
+        logging.getLogger(__name__).info(f'Laser I/O: {self.laser_parameters.laser_io.stats()}')
         self.instrument.cfg.save()
         self.instrument.close()
+        waveform_cache.close()     # Give instrument module back its own generate_waveforms
@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import threading
+import uuid
+from time import time
+import numpy as np
+from widgets.tissue_planning import tile_rectangles
+
+JOURNAL_PATH = os.path.join(os.path.expanduser('~'), 'Documents', 'dispim_files', 'acquisition_queue.jsonl')
+
+
+class AcquisitionJournal:
+
+    def __init__(self, path: str = JOURNAL_PATH):
+
+        """Append only record of the acquisition queue on disk so a run interrupted by a crash or reboot can be resumed.
+        Every state change is one json line written with a single append and fsynced before returning. A line torn by
+        a crash is skipped when the journal is read back.
+            :param path: journal file
+        """
+
+        self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending_scans = None   # Result of pending until journal is written again
+
+    def start_queue(self, scans: list):
+
+        """Replace journal with a new queue. Written to a temporary file and renamed so an old journal is never half
+        overwritten
+        :param scans: scans in the order they will run
+        :return: id given to each scan"""
+
+        ids = [uuid.uuid4().hex[:12] for _ in scans]
+        lines = [self._line({'event': 'queued', 'scan_id': scan_id, 'index': i, 'scan': scan})
+                 for i, (scan_id, scan) in enumerate(zip(ids, scans))]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp = self.path + '.tmp'
+        with self.lock:
+            with open(temp, 'wb') as journal:
+                journal.write(b''.join(lines))
+                journal.flush()
+                os.fsync(journal.fileno())
+            os.replace(temp, self.path)
+            self.pending_scans = None
+        return ids
+
+    def append(self, event: str, scan_id: str = None, **values):
+
+        """Durably record a state change: running, tile, finished or complete
+        :param event: name of state change
+        :param scan_id: scan it applies to
+        :param values: extra values stored with event e.g. tile index"""
+
+        line = self._line({'event': event, 'scan_id': scan_id, **values})
+        with self.lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.pending_scans = None
+
+    def _line(self, record: dict):
+
+        return (json.dumps({**record, 'time': time()}, default=str) + '\n').encode()
+
+    def read(self):
+
+        """Replay journal into queue state
+        :return: scans in queue order as dicts with scan_id, scan, state (queued, running or finished), tiles done
+        and tile grid once running, and whether the whole queue completed"""
+
+        scans = {}
+        complete = False
+        if not os.path.exists(self.path):
+            return [], True
+        with self.lock, open(self.path, 'rb') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self.log.warning(f'Skipping torn journal line {line[:80]}')
+                    continue
+                event, scan_id = record['event'], record.get('scan_id')
+                if event == 'queued':
+                    scans[scan_id] = {'scan_id': scan_id, 'index': record['index'], 'scan': record['scan'],
+                                      'state': 'queued', 'tiles_done': 0}
+                elif event == 'complete':
+                    complete = True
+                elif scan_id in scans:
+                    if event == 'tile':
+                        scans[scan_id]['tiles_done'] = max(scans[scan_id]['tiles_done'], record['tile'] + 1)
+                    else:
+                        scans[scan_id]['state'] = event
+                    if 'grid' in record:
+                        scans[scan_id]['grid'] = record['grid']
+        return sorted(scans.values(), key=lambda scan: scan['index']), complete
+
+    def pending(self):
+
+        """Scans of an interrupted queue that did not finish, in queue order. Empty if last queue completed. Journal
+        is only read again after it was written"""
+
+        pending = self.pending_scans
+        if pending is None:
+            scans, complete = self.read()
+            pending = [] if complete else [scan for scan in scans if scan['state'] != 'finished']
+            self.pending_scans = pending
+        return list(pending)
+
+
+class TileJournaler:
+
+    def __init__(self, journal: AcquisitionJournal, progress_events, scan_id: str):
+
+        """Journals each tile of a running scan as its tile event arrives on the progress event bus
+            :param journal: journal tiles are recorded in
+            :param progress_events: ProgressEventBus the acquisition reports to
+            :param scan_id: id of scan running
+        """
+
+        self.journal = journal
+        self.progress_events = progress_events
+        self.scan_id = scan_id
+        self.tiles_done = 0
+
+    def __enter__(self):
+
+        self.progress_events.subscribe(self.on_event, headless=True)
+        return self
+
+    def __exit__(self, *exc):
+
+        self.progress_events.unsubscribe(self.on_event, headless=True)
+
+    def on_event(self, event: dict):
+
+        if event['event'] != 'tile':
+            return
+        for tile in range(self.tiles_done, event['tiles_done']):
+            self.journal.append('tile', self.scan_id, tile=tile)
+        self.tiles_done = max(self.tiles_done, event['tiles_done'])
+
+
+def tile_sequence(xtiles: int, ytiles: int, stacks: int = 1):
+
+    """Grid position of every tile in the order instrument counts them in tiles_acquired. Positions go along x first
+    like the tissue map tiles. When channels are acquired sequentially each position is counted once per channel and
+    the positions are taken to be repeated channel by channel, so a position only counts as done once its last channel
+    is, whichever way round the instrument goes
+    :param xtiles: tiles in scan along x
+    :param ytiles: tiles in scan along y
+    :param stacks: stacks acquired at each position, the channel count for sequential acquisitions
+    :return: list of [x, y] tile indexes"""
+
+    return [[x, y] for _ in range(stacks) for y in range(ytiles) for x in range(xtiles)]
+
+
+def remaining_scans(scan: dict, tiles_done: int, xtiles: int, ytiles: int, x_step_um: float, y_step_um: float,
+                    sequence: list = None):
+
+    """Split an interrupted scan into scans covering only tiles not done yet. Tiles that are left are covered with
+    rectangles so any acquisition order works as long as the sequence journaled with the scan matches it
+    :param scan: scan as stored in acquisition_order
+    :param tiles_done: tiles finished before interruption
+    :param xtiles: tiles in scan along x
+    :param ytiles: tiles in scan along y
+    :param x_step_um: grid step between tiles along x
+    :param y_step_um: grid step between tiles along y
+    :param sequence: tile_sequence of scan. Journals written before it was recorded go along x first
+    :return: list of scans. Empty if all tiles are done"""
+
+    if tiles_done <= 0:
+        return [scan]
+    sequence = tile_sequence(xtiles, ytiles) if sequence is None else sequence
+    stacks = np.zeros((xtiles, ytiles), dtype=np.int64)    # Stacks acquired at each position
+    needed = np.zeros((xtiles, ytiles), dtype=np.int64)
+    for index, (x, y) in enumerate(sequence):
+        needed[x, y] += 1
+        stacks[x, y] += index < tiles_done
+    start = scan['start_pos_um']
+    pieces = []
+    for x0, x1, y0, y1 in tile_rectangles(stacks < needed):
+        pieces.append({**scan, 'start_pos_um': {**start, 'x': round(start['x'] + x0 * x_step_um, 1),
+                                                'y': round(start['y'] + y0 * y_step_um, 1)},
+                       'volume_x_um': round((x1 - x0) * x_step_um, 1),
+                       'volume_y_um': round((y1 - y0) * y_step_um, 1)})
+    return pieces
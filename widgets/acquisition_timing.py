@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import threading
+from time import time
+import numpy as np
+
+HISTORY_PATH = os.path.join(os.path.expanduser('~'), 'Documents', 'dispim_files', 'acquisition_timing.jsonl')
+
+
+def scan_features(cfg, x_tiles: int, y_tiles: int, z_tiles: int):
+
+    """What a scan's timing depends on, taken from config and tile counts. A tile is what instrument counts in
+    tiles_acquired: one stack of every channel when interleaved and one stack of one channel when sequential"""
+
+    channels = len(cfg.imaging_wavelengths)
+    interleaved = cfg.acquisition_style == 'interleaved'
+    return {'tiles': x_tiles * y_tiles * (1 if interleaved else channels),
+            'frames': z_tiles * (channels if interleaved else 1),    # Frames in each tile
+            'channels': channels,
+            'exposure_s': float(getattr(cfg, 'exposure_time', 0) or 0),
+            'filetype': str(cfg.imaging_specs.get('filetype', '')),
+            'style': str(cfg.acquisition_style)}
+
+
+class TimingHistory:
+
+    def __init__(self, path: str = HISTORY_PATH, min_runs: int = 3, ridge: float = 1e-3):
+
+        """Local store of how long tiles took in past runs and a least squares model of seconds per tile fit to it
+            :param path: jsonl file runs are appended to
+            :param min_runs: runs needed before model is used instead of instrument estimate
+            :param ridge: regularization keeping fit stable while there are few runs
+        """
+
+        self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self.path = path
+        self.min_runs = min_runs
+        self.ridge = ridge
+        self.lock = threading.Lock()
+        self.runs = None
+        self.model = None
+
+    def load(self):
+
+        """Read past runs once"""
+
+        with self.lock:
+            if self.runs is None:
+                self.runs = []
+                if os.path.exists(self.path):
+                    with open(self.path) as history:
+                        for line in history:
+                            try:
+                                self.runs.append(json.loads(line))
+                            except ValueError:
+                                continue
+            return self.runs
+
+    def record(self, features: dict, tile_times_s: list):
+
+        """Store timing of a finished run
+        :param features: scan_features of run
+        :param tile_times_s: seconds each tile took"""
+
+        if len(tile_times_s) == 0:
+            return
+        run = {**features, 'tiles_timed': len(tile_times_s), 'tile_s': float(np.median(tile_times_s)),
+               'total_s': float(np.sum(tile_times_s)), 'time': time()}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.lock:
+            with open(self.path, 'a') as history:
+                history.write(json.dumps(run) + '\n')
+            if self.runs is not None:
+                self.runs.append(run)
+            self.model = None   # Refit with new run
+
+    def design(self, runs: list, filetypes: list, styles: list):
+
+        """Rows of least squares problem. Time per tile is a fixed overhead plus a cost per frame that grows with
+        exposure and changes with file type, with an offset for each acquisition style"""
+
+        rows = []
+        for run in runs:
+            frames = run['frames']
+            rows.append([1, frames, frames * run['exposure_s']] +
+                        [frames * (run['filetype'] == filetype) for filetype in filetypes[1:]] +
+                        [float(run['style'] == style) for style in styles[1:]])
+        return np.array(rows, dtype=float)
+
+    def fit(self):
+
+        """Fit seconds per tile to history weighting runs by how many tiles were timed
+        :return: (coefficients, filetypes, styles) or None if there aren't enough runs"""
+
+        runs = self.load()
+        with self.lock:
+            if self.model is not None or len(runs) < self.min_runs:
+                return self.model
+            filetypes = sorted({run['filetype'] for run in runs})
+            styles = sorted({run['style'] for run in runs})
+            a = self.design(runs, filetypes, styles)
+            b = np.array([run['tile_s'] for run in runs])
+            weights = np.sqrt([run['tiles_timed'] for run in runs])
+            a_reg = np.vstack([a * weights[:, None], np.sqrt(self.ridge) * np.eye(a.shape[1])])
+            b_reg = np.concatenate([b * weights, np.zeros(a.shape[1])])
+            coefficients = np.linalg.lstsq(a_reg, b_reg, rcond=None)[0]
+            self.model = (coefficients, filetypes, styles)
+            self.log.info(f'Fit seconds per tile to {len(runs)} past runs: {np.round(coefficients, 4)}')
+            return self.model
+
+    def predict_tile_s(self, features: dict):
+
+        """Predicted seconds per tile or None if model can't be used yet"""
+
+        model = self.fit()
+        if model is None:
+            return None
+        coefficients, filetypes, styles = model
+        if features['filetype'] not in filetypes or features['style'] not in styles:
+            return None     # Never seen so model can't say
+        return max(float(self.design([features], filetypes, styles)[0] @ coefficients), 0.)
+
+    def predict_days(self, features: dict, fallback: float = None):
+
+        """Predicted time of whole scan in days, falling back to given estimate without a usable model
+        :return: (days, True if from history)"""
+
+        tile_s = self.predict_tile_s(features)
+        if tile_s is None:
+            return fallback, False
+        return tile_s * features['tiles'] / 86400, True
+
+
+class TileTimer:
+
+    def __init__(self, tile_s: float = None, alpha: float = .2):
+
+        """Smooths seconds per tile with an exponentially weighted moving average to give a steady ETA
+            :param tile_s: predicted seconds per tile used until tiles finish
+            :param alpha: weight of newest tile
+        """
+
+        self.tile_s = tile_s
+        self.alpha = alpha
+        self.tiles_done = 0
+        self.last = None
+        self.times = []     # Seconds each tile took
+
+    def update(self, tiles_done: int, now: float = None):
+
+        """Feed latest count of finished tiles"""
+
+        now = time() if now is None else now
+        if self.last is None:
+            self.last = now
+        if tiles_done > self.tiles_done:
+            per_tile = (now - self.last) / (tiles_done - self.tiles_done)
+            self.times += [per_tile] * (tiles_done - self.tiles_done)
+            self.tile_s = per_tile if self.tile_s is None else self.alpha * per_tile + (1 - self.alpha) * self.tile_s
+            self.tiles_done, self.last = tiles_done, now
+
+    def remaining_s(self, tiles: int):
+
+        """Seconds left for tiles total or None if nothing to go on yet. Time already spent on the tile in progress
+        is taken off"""
+
+        if self.tile_s is None:
+            return None
+        in_progress = min(time() - self.last, self.tile_s) if self.last is not None and tiles > self.tiles_done else 0
+        return max(max(tiles - self.tiles_done, 0) * self.tile_s - in_progress, 0.)
@@ -0,0 +1,75 @@
+import threading
+import numpy as np
+
+
+class StreamingAutocontrast:
+
+    def __init__(self, percentiles: tuple = (1, 99.9), decay: float = .8, stride: int = 4, threshold: float = .05):
+
+        """Per channel contrast limits from an incremental histogram of the livestream. Histograms are updated in
+        the livestream worker so the gui never reduces a full frame.
+            :param percentiles: lower and upper percentile used as contrast limits
+            :param decay: weight of previous histogram when a new frame is added. Lower reacts faster
+            :param stride: only every stride-th row and column of a frame is counted
+            :param threshold: fraction of current contrast range limits have to move before they are pushed
+        """
+
+        self.percentiles = percentiles
+        self.decay = decay
+        self.stride = stride
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.limits = {}  # Newest limits of every channel
+        self.applied = {}  # Limits last pushed to the viewer
+
+    def reset(self):
+
+        with self.lock:
+            self.histograms = {}
+            self.limits = {}
+            self.applied = {}
+
+    def update(self, channel, frame: np.ndarray):
+
+        """Add frame to histogram of channel and recompute limits. Called from livestream worker thread
+        :param channel: key of channel, usually the wavelength
+        :param frame: latest integer frame from camera"""
+
+        if not np.issubdtype(frame.dtype, np.unsignedinteger):
+            return
+        sample = frame[::self.stride, ::self.stride].ravel()
+        bins = 2 ** (8 * frame.dtype.itemsize) if frame.dtype.itemsize <= 2 else int(sample.max()) + 1
+        counts = np.bincount(sample, minlength=bins)
+
+        with self.lock:
+            hist = self.histograms.get(channel)
+            if hist is None or hist.shape != counts.shape:
+                hist = counts.astype(np.float64)
+            else:
+                hist *= self.decay
+                hist += counts
+            self.histograms[channel] = hist
+
+            cdf = np.cumsum(hist)
+            lower, upper = np.searchsorted(cdf, [cdf[-1] * p / 100 for p in self.percentiles])
+            self.limits[channel] = (int(lower), int(max(upper, lower + 1)))
+
+    def changed(self, channel):
+
+        """Limits of channel if they moved more than threshold since they were last pushed
+        :param channel: key of channel, usually the wavelength
+        :return: (lower, upper) or None if limits haven't moved enough"""
+
+        with self.lock:
+            limits = self.limits.get(channel)
+            applied = self.applied.get(channel)
+            if limits is None:
+                return None
+            if applied is not None:
+                span = max(applied[1] - applied[0], 1)
+                if abs(limits[0] - applied[0]) <= self.threshold * span and \
+                        abs(limits[1] - applied[1]) <= self.threshold * span:
+                    return None
+            self.applied[channel] = limits
+            return limits
@@ -0,0 +1,189 @@
+import threading
+import numpy as np
+
+
+def downsample_mean(frame: np.ndarray, out: np.ndarray):
+
+    """Write 2x2 block mean of frame into out. Rows and columns that don't fill a block are cut off
+    :param frame: 2d image
+    :param out: array of shape (rows//2, columns//2) the mean is written into"""
+
+    h, w = out.shape
+    if np.issubdtype(frame.dtype, np.integer):
+        acc = frame[0:2 * h:2, 0:2 * w:2].astype(np.uint32)
+        acc += frame[1:2 * h:2, 0:2 * w:2]
+        acc += frame[0:2 * h:2, 1:2 * w:2]
+        acc += frame[1:2 * h:2, 1:2 * w:2]
+        acc >>= 2
+    else:
+        acc = frame[:2 * h, :2 * w].reshape(h, 2, w, 2).mean(axis=(1, 3))
+    np.copyto(out, acc, casting='unsafe')
+
+
+class FrameRingBuffer:
+
+    def __init__(self, slots: int = 4, levels: int = 1):
+
+        """Preallocated per channel ring buffer between the livestream worker and the viewer. The worker writes
+        frames into a free slot and the viewer only takes the newest one, so frames the gui can't keep up with are
+        dropped and counted instead of queued in the Qt event loop.
+            :param slots: number of frames held per channel. At least three so the newest frame and the frame being
+            displayed are never written over
+        """
+
+        if slots < 3:
+            raise ValueError('Frame ring buffer needs at least three slots')
+
+        self.slots = slots
+        self.levels = max(int(levels), 1)
+        self.display_level = 0  # Pyramid level handed out by read
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.generation = 0     # Bumped whenever a channel's slots are replaced
+        self.written = 0
+        self.dropped = 0
+
+    def allocate(self, channel, shape: tuple, dtype=np.uint16):
+
+        """Preallocate slots for a channel. Existing slots are reused if the frame shape and type are the same
+        :param channel: key of channel, usually the wavelength
+        :param shape: shape of a single frame
+        :param dtype: data type of frames"""
+
+        with self.lock:
+            return self._allocate(channel, tuple(shape), np.dtype(dtype))
+
+    def _allocate(self, channel, shape: tuple, dtype):
+
+        ch = self.channels.get(channel)
+        reuse = ch is not None and ch['frames'].shape[1:] == shape and ch['frames'].dtype == dtype
+        frames = ch['frames'] if reuse else np.zeros((self.slots, *shape), dtype=dtype)
+        self.generation += 1
+        self.channels[channel] = {'frames': frames,
+                                  'pyramid': self._pyramid(shape, dtype),  # Downsampled frames, level 1 and up
+                                  'built': np.zeros(self.slots, dtype=np.int64),  # Levels built of frame in slot
+                                  'seq': np.full(self.slots, -1, dtype=np.int64),
+                                  'count': 0,  # Frames written to channel
+                                  'latest': -1,  # Slot of newest frame
+                                  'reading': ch['reading'] if reuse else -1,  # Slot handed out to the viewer
+                                  'unread': False,
+                                  'read_seq': -1,  # Sequence number of frame handed out to the viewer
+                                  'dropped': 0,
+                                  'generation': self.generation}
+        return self.channels[channel]
+
+    def _pyramid(self, shape: tuple, dtype):
+
+        pyramid = []
+        for level in range(1, self.levels):
+            shape = (shape[0] // 2, shape[1] // 2)
+            pyramid.append(np.zeros((self.slots, *shape), dtype=dtype))
+        return pyramid
+
+    def set_levels(self, levels: int):
+
+        """Change number of pyramid levels frames can be read at. Frames already written are kept
+        :param levels: number of levels including full resolution"""
+
+        with self.lock:
+            self.levels = max(int(levels), 1)
+            for ch in self.channels.values():
+                ch['pyramid'] = self._pyramid(ch['frames'].shape[1:], ch['frames'].dtype)
+                ch['built'][:] = 0
+
+    def set_display_level(self, level: int):
+
+        """Set pyramid level handed out by read. Clamped to levels being built
+        :param level: 0 is full resolution"""
+
+        self.display_level = max(int(level), 0)
+
+    def reset(self):
+
+        """Reset counters and sequence numbers while keeping the preallocated slots"""
+
+        with self.lock:
+            for channel, ch in list(self.channels.items()):
+                self._allocate(channel, ch['frames'].shape[1:], ch['frames'].dtype)
+            self.written = 0
+            self.dropped = 0
+
+    def write(self, channel, frame: np.ndarray):
+
+        """Copy frame into the next free slot of channel. Called from the livestream worker thread
+        :param channel: key of channel, usually the wavelength
+        :param frame: latest frame from camera
+        :return: sequence number of written frame"""
+
+        while True:
+            with self.lock:
+                ch = self.channels.get(channel)
+                if ch is None or ch['frames'].shape[1:] != frame.shape or ch['frames'].dtype != frame.dtype:
+                    ch = self._allocate(channel, frame.shape, frame.dtype)
+                generation = ch['generation']
+                slot = (ch['latest'] + 1) % self.slots
+                if slot == ch['reading']:  # Never write over frame being displayed
+                    slot = (slot + 1) % self.slots
+                ch['seq'][slot] = -1  # Invalidate slot while copying
+                ch['built'][slot] = 0
+
+            # Copy outside of lock. Slot is neither the newest nor the displayed slot so the gui never touches it
+            np.copyto(ch['frames'][slot], frame)
+
+            with self.lock:
+                if self.channels[channel]['generation'] != generation:
+                    continue    # Slots were replaced by reset while copying so copy again into the new ones
+                if ch['unread']:  # Newest frame was never displayed
+                    ch['dropped'] += 1
+                    self.dropped += 1
+                seq = ch['count']
+                ch['count'] += 1
+                ch['seq'][slot] = seq
+                ch['latest'] = slot
+                ch['unread'] = True
+                self.written += 1
+                return seq
+
+    def read(self, channel):
+
+        """Take newest frame of channel if it hasn't been read yet. Returned frame is a view into the buffer and
+        stays valid until the next read of the channel. Pyramid levels are only built for the level read
+        :param channel: key of channel, usually the wavelength
+        :return: (frame, sequence number, pyramid level) or None if there is no new frame"""
+
+        with self.lock:
+            ch = self.channels.get(channel)
+            if ch is None or not ch['unread']:
+                return None
+            slot = ch['latest']
+            ch['reading'] = slot
+            ch['unread'] = False
+            pyramid, built = ch['pyramid'], ch['built']
+            level = min(self.display_level, len(pyramid))
+            ch['read_seq'] = int(ch['seq'][slot])
+            frame = ch['frames'][slot]
+
+        # Downsample outside of lock. Slot is being read so the worker doesn't write it
+        for index in range(level):
+            if built[slot] <= index:
+                downsample_mean(frame, pyramid[index][slot])
+                built[slot] = index + 1
+            frame = pyramid[index][slot]
+        return frame, ch['read_seq'], level
+
+    def last_read(self, channel):
+
+        """Sequence number of frame last handed out for channel"""
+
+        ch = self.channels.get(channel)
+        return -1 if ch is None else ch['read_seq']
+
+    def stats(self):
+
+        """Number of frames written and dropped in total and per channel"""
+
+        with self.lock:
+            return {'written': self.written,
+                    'dropped': self.dropped,
+                    'channels': {k: {'written': v['count'], 'dropped': v['dropped']}
+                                 for k, v in self.channels.items()}}
@@ -0,0 +1,146 @@
+import qtpy.QtCore as QtCore
+from collections import deque
+from time import perf_counter
+
+DEFAULT_FPS = 30
+
+
+class FramePacer:
+
+    def __init__(self, update, fps: float = DEFAULT_FPS, report=None):
+
+        """Repaints viewer layers at a fixed display rate instead of on every camera frame. Frames arriving between
+        ticks are merged so every layer is repainted at most once per tick, and layers whose frame hasn't changed
+        are not repainted at all.
+            :param update: function called with an (image, layer) tuple, usually WidgetBase.update_layer
+            :param fps: target display rate
+            :param report: optional function called about once a second with pacer stats
+        """
+
+        self.update = update
+        self.report = report
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.tick)
+        self.set_fps(fps)
+
+        self.sources = []  # Ring buffers polled every tick
+        self.pending = {}  # Newest pushed frame of each layer
+        self.displayed = {}  # Fingerprint of frame displayed in each layer
+        self.paint_times = deque(maxlen=256)
+        self.last_report = perf_counter()
+        self.reset_stats()
+
+    def set_fps(self, fps: float):
+
+        """Set target display rate
+        :param fps: frames per second"""
+
+        self.fps = max(float(fps), 1.0)
+        self.timer.setInterval(round(1000 / self.fps))
+
+    def reset_stats(self):
+
+        self.repaints = 0  # Layer repaints
+        self.ticks = 0  # Ticks that repainted at least one layer
+        self.coalesced = 0  # Frames replaced by a newer frame before the tick
+        self.unchanged = 0  # Frames skipped because they were already displayed
+        self.paint_times.clear()
+
+    def add_source(self, buffer):
+
+        """Poll a FrameRingBuffer every tick
+        :param buffer: ring buffer holding newest frame of every channel"""
+
+        if buffer not in self.sources:
+            self.sources.append(buffer)
+
+    def start(self):
+
+        self.reset_stats()
+        self.pending = {}
+        self.displayed = {}
+        self.last_report = perf_counter()
+        self.timer.start()
+
+    def stop(self):
+
+        self.timer.stop()
+        self.tick()  # Flush frames that arrived after last tick
+
+    def is_active(self):
+
+        return self.timer.isActive()
+
+    def push(self, args):
+
+        """Queue frame to be displayed on the next tick. Connect to the yielded signal of a worker
+        :param args: (image, layer) tuple"""
+
+        if args is None:
+            return
+        (image, layer) = args
+        if layer in self.pending:
+            self.coalesced += 1
+        self.pending[layer] = (image, self.fingerprint(image))
+
+    def fingerprint(self, image):
+
+        """Cheap identifier of frame content so repeated frames are not repainted"""
+
+        try:
+            return id(image), hash(image[::64, ::64].tobytes())
+        except (TypeError, IndexError, AttributeError):
+            return id(image), None
+
+    def tick(self):
+
+        """Repaint every layer with a new frame once"""
+
+        frames = self.pending
+        self.pending = {}
+        for buffer in self.sources:
+            for layer in list(buffer.channels.keys()):
+                latest = buffer.read(layer)
+                if latest is not None:
+                    if layer in frames:
+                        self.coalesced += 1
+                    frames[layer] = (latest[0], (id(buffer), latest[1]), latest[2])
+
+        painted = False
+        for layer, (image, fingerprint, *level) in frames.items():
+            if fingerprint == self.displayed.get(layer) and fingerprint[-1] is not None:
+                self.unchanged += 1
+                continue
+            self.displayed[layer] = fingerprint
+            self.update((image, layer, *level))
+            self.repaints += 1
+            painted = True
+
+        now = perf_counter()
+        if painted:
+            self.ticks += 1
+            self.paint_times.append(now)
+        if self.report is not None and now - self.last_report >= 1:
+            self.last_report = now
+            self.report(self.stats())
+
+    def achieved_fps(self):
+
+        """Rate of ticks that repainted the viewer over the last couple of seconds"""
+
+        if len(self.paint_times) < 2:
+            return 0.0
+        now = perf_counter()
+        recent = [t for t in self.paint_times if now - t <= 2]
+        if len(recent) < 2:
+            return 0.0
+        return (len(recent) - 1) / (recent[-1] - recent[0])
+
+    def stats(self):
+
+        return {'target_fps': self.fps,
+                'achieved_fps': round(self.achieved_fps(), 1),
+                'repaints': self.repaints,
+                'skipped': self.coalesced + self.unchanged,
+                'coalesced': self.coalesced,
+                'unchanged': self.unchanged}
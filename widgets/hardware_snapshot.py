@@ -0,0 +1,90 @@
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from time import perf_counter
+
+
+class HardwareSnapshot:
+
+    def __init__(self, max_workers: int = 16):
+
+        """Values read from hardware once at startup so widgets don't each ask the devices while they are built.
+        Queries of one device run in order on one thread while devices are queried in parallel, and the query time of
+        every value is kept.
+            :param max_workers: most devices queried at the same time
+        """
+
+        self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self.max_workers = max_workers
+        self.futures = {}   # Key to future of value
+        self.latency = {}   # Key to (device, seconds query took)
+        self.start = None
+        self.elapsed = None
+
+    def prefetch(self, devices: dict):
+
+        """Start querying devices without waiting for them
+        :param devices: device name to list of (key, function, *args). Functions of a device are called in order"""
+
+        self.start = perf_counter()
+        executor = ThreadPoolExecutor(max_workers=max(min(len(devices), self.max_workers), 1),
+                                      thread_name_prefix='hardware_snapshot')
+        for device, queries in devices.items():
+            futures = []
+            for key, function, *args in queries:
+                self.futures[key] = Future()
+                futures.append((key, self.futures[key], function, args))
+            executor.submit(self._query_device, device, futures)
+        executor.shutdown(wait=False)
+
+    def _query_device(self, device: str, queries: list):
+
+        for key, future, function, args in queries:
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = perf_counter()
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                self.log.warning(f'Startup query {key} of {device} failed: {e}')
+                future.set_exception(e)
+            self.latency[key] = (device, perf_counter() - start)
+
+    def wait(self, timeout: float = 30):
+
+        """Wait for every query to finish
+        :return: seconds from start of prefetch until every query finished"""
+
+        done, not_done = wait(self.futures.values(), timeout=timeout)
+        if not_done:
+            self.log.warning(f'{len(not_done)} startup queries did not finish in {timeout} s')
+        elif self.elapsed is None and self.start is not None:
+            self.elapsed = perf_counter() - self.start
+            self.log.info(f'Queried {len(self.devices())} devices in {self.elapsed:.2f} s')
+        return self.elapsed
+
+    def get(self, key: str, fetch, timeout: float = 30):
+
+        """Prefetched value of key. Falls back to querying device if key wasn't prefetched or its query failed
+        :param fetch: function querying device for value
+        :param timeout: seconds to wait on prefetch before querying device"""
+
+        future = self.futures.get(key)
+        if future is not None:
+            try:
+                return future.result(timeout=timeout)
+            except Exception as e:
+                self.log.debug(f'Querying {key} again after prefetch failed: {e}')
+        return fetch()
+
+    def devices(self):
+
+        return {device for device, _ in self.latency.values()}
+
+    def stats(self):
+
+        """Query time of every value grouped by device"""
+
+        stats = {}
+        for key, (device, seconds) in self.latency.items():
+            stats.setdefault(device, {})[key] = round(1000 * seconds, 1)
+        return {device: {'total_ms': round(sum(keys.values()), 1), **keys} for device, keys in stats.items()}
@@ -5,6 +5,9 @@ from qtpy.QtGui import QIntValidator
 from tigerasi.device_codes import JoystickInput
 import qtpy.QtCore as QtCore
 from ispim.ispim_config import IspimConfig
+from widgets.stage_commands import StageCommandExecutor
+from widgets.reconfiguration import ReconfigurationScheduler
+from widgets.hardware_snapshot import HardwareSnapshot
 
 def get_dict_attr(class_def, attr):
     # for obj in [obj] + obj.__class__.mro():
@@ -15,8 +18,13 @@ def get_dict_attr(class_def, attr):
 
 class InstrumentParameters(WidgetBase):
 
-    def __init__(self, frame_grabber, column_pixels, simulated, instrument, config):
+    def __init__(self, frame_grabber, column_pixels, simulated, instrument, config,
+                 stage_commands: StageCommandExecutor = None, reconfiguration: ReconfigurationScheduler = None,
+                 snapshot: HardwareSnapshot = None):
 
+        self.stage_commands = StageCommandExecutor(instrument) if stage_commands is None else stage_commands
+        self.snapshot = HardwareSnapshot() if snapshot is None else snapshot    # Hardware values read at startup
+        self.reconfiguration = reconfiguration
         self.frame_grabber = frame_grabber
         self.column_pixels = column_pixels
         self.simulated = simulated
@@ -92,10 +100,7 @@ class InstrumentParameters(WidgetBase):
                                                  live=self.instrument.livestream_enabled.is_set())
             self.cfg.slit_width_pix = new_sw
 
-            if self.instrument.livestream_enabled.is_set():
-                self.instrument._setup_waveform_hardware(
-                    self.instrument.active_lasers,
-                    live=True)
+            self.reconfigure_hardware()
 
     def exposure_time_widget(self):
 
@@ -125,10 +130,7 @@ class InstrumentParameters(WidgetBase):
             self.cfg.line_time_us = line_interval
             self.cfg.exposure_time_s = new_et
 
-            if self.instrument.livestream_enabled.is_set():
-                self.instrument._setup_waveform_hardware(
-                    self.instrument.active_lasers,
-                    live=True)
+            self.reconfigure_hardware()
 
     def shutter_direction_widgets(self):
 
@@ -159,10 +161,7 @@ class InstrumentParameters(WidgetBase):
         self.frame_grabber.set_scan_direction(stream_id, direction, self.instrument.livestream_enabled.is_set())
         self.cfg.scan_direction = direction
 
-        if self.instrument.livestream_enabled.is_set():
-            self.instrument._setup_waveform_hardware(
-                self.instrument.active_lasers,
-                live=True)
+        self.reconfigure_hardware()
 
     def filetype_widget(self):
 
@@ -190,10 +189,11 @@ class InstrumentParameters(WidgetBase):
         """Tab to remap joystick"""
 
 
-        tiger_axes = [k for k,v in self.instrument.tigerbox.get_joystick_axis_mapping().items() if v == JoystickInput.NONE]
+        joystick_mapping = self.snapshot.get('joystick_mapping', lambda: self.stage_commands.query(
+            self.instrument.tigerbox.get_joystick_axis_mapping))
+        tiger_axes = [k for k,v in joystick_mapping.items() if v == JoystickInput.NONE]
         tiger_axes.append('NONE')
 
-        joystick_mapping = self.instrument.tigerbox.get_joystick_axis_mapping()
         self.joystick_axes = {'JOYSTICK_X':'', 'JOYSTICK_Y':'', 'Z_WHEEL':'', 'F_WHEEL':''}
 
         self.axis_combobox = {}
@@ -249,7 +249,8 @@ class InstrumentParameters(WidgetBase):
         stage_ax = self.axis_combobox[joystick_axis].currentText()
         if stage_ax == 'NONE':
             # Unmap previous coordinate and add coordinate to all comboboxes
-            self.instrument.tigerbox.bind_axis_to_joystick_input(**{self.joystick_axes[joystick_axis]: JoystickInput.NONE})
+            self.stage_commands.configure(self.instrument.tigerbox.bind_axis_to_joystick_input,
+                                          **{self.joystick_axes[joystick_axis]: JoystickInput.NONE})
             for joystick, box in self.axis_combobox.items():
                 if joystick == joystick_axis:
                     continue # don't add duplicate of axis
@@ -258,8 +259,8 @@ class InstrumentParameters(WidgetBase):
                 box.blockSignals(False)
         elif self.joystick_axes[joystick_axis] == 'NONE':
             # Map new stage axis to joystick
-            self.instrument.tigerbox.bind_axis_to_joystick_input(
-                **{stage_ax: JoystickInput[joystick_axis]})
+            self.stage_commands.configure(self.instrument.tigerbox.bind_axis_to_joystick_input,
+                                          **{stage_ax: JoystickInput[joystick_axis]})
             for joystick, box in self.axis_combobox.items():
                 if joystick == joystick_axis:
                     continue  # don't add duplicate of axis
@@ -268,8 +269,9 @@ class InstrumentParameters(WidgetBase):
                 box.blockSignals(False)
         else:       # Neither stageax or joystick is none
             #Set previous stage axis to map to none and set new axis to joystick axis
-            self.instrument.tigerbox.bind_axis_to_joystick_input(**{self.joystick_axes[joystick_axis]:JoystickInput.NONE,
-                                                                        stage_ax:JoystickInput[joystick_axis]})
+            self.stage_commands.configure(self.instrument.tigerbox.bind_axis_to_joystick_input,
+                                          **{self.joystick_axes[joystick_axis]:JoystickInput.NONE,
+                                             stage_ax:JoystickInput[joystick_axis]})
             for joystick, box in self.axis_combobox.items():
                 if joystick == joystick_axis:
                     continue  # don't add duplicate of axis
@@ -0,0 +1,196 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, wait
+from time import perf_counter
+
+
+def mirror_key(command: str):
+
+    """Getter a command's value is mirrored under so a write of set_setpoint shows up as get_setpoint"""
+
+    return 'get_' + command[len('set_'):] if command.startswith('set_') else command
+
+
+class LaserIO:
+
+    def __init__(self, name: str, device, window: int = 200, max_writes: int = 4):
+
+        """Worker thread owning the serial link of one laser. Writes of the same command are coalesced so only the
+        latest value is sent, and every result is mirrored in state so widgets never have to ask the laser.
+            :param name: key of laser e.g. wavelength or main for the combiner
+            :param device: laser driver
+            :param window: number of latencies kept
+            :param max_writes: most writes sent in a row while queries wait
+        """
+
+        self.name = name
+        self.device = device
+        self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self.state = {}     # Getter name to last value read from or written to laser
+        self.confirmed = {}     # Getter name to last value laser accepted or returned
+        self.writes = OrderedDict()     # Command name to (value, future) of newest pending write
+        self.queries = deque()
+        self.max_writes = max_writes
+        self.writes_in_row = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.latency = deque(maxlen=window)
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name=f'laser_io_{name}', daemon=True)
+        self.thread.start()
+
+    def write(self, command: str, value):
+
+        """Queue write replacing any pending write of the same command. Mirror shows value right away
+        :param command: setter of device e.g. set_setpoint
+        :return: future resolved once value is sent. Replaced writes resolve with the newer write"""
+
+        with self.condition:
+            self.state[mirror_key(command)] = value
+            if command in self.writes:
+                self.coalesced += 1
+                future = self.writes.pop(command)[1]
+            else:
+                future = Future()
+            self.writes[command] = (value, future)
+            self.condition.notify()
+        return future
+
+    def query(self, command: str):
+
+        """Queue read of device
+        :param command: getter of device e.g. get_setpoint
+        :return: future with value read"""
+
+        future = Future()
+        with self.condition:
+            self.queries.append((command, future))
+            self.condition.notify()
+        return future
+
+    def _run(self):
+
+        while True:
+            with self.condition:
+                while not self.stopped and not self.writes and not self.queries:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                # Writes go first so a query after a write reads the new value, but a query gets a turn after
+                # max_writes writes so a slider being dragged can't hold queries back
+                if self.writes and (not self.queries or self.writes_in_row < self.max_writes):
+                    command, (value, future) = self.writes.popitem(last=False)
+                    args = (value,)
+                    self.writes_in_row += 1
+                else:
+                    (command, future), args = self.queries.popleft(), ()
+                    self.writes_in_row = 0
+            if not future.set_running_or_notify_cancel():
+                continue
+            key = mirror_key(command)
+            start = perf_counter()
+            try:
+                result = getattr(self.device, command)(*args)
+                with self.condition:
+                    self.confirmed[key] = args[0] if args else result
+                    if not args:
+                        self.state[key] = result
+                future.set_result(result)
+            except Exception as e:
+                self.log.error(f'Laser {self.name} {command}{args} failed: {e}')
+                if args:
+                    self._rollback(command, key)
+                future.set_exception(e)
+            self.latency.append(perf_counter() - start)
+
+    def _rollback(self, command: str, key: str):
+
+        """Put back last value laser accepted after a failed write unless a newer write of command is pending"""
+
+        with self.condition:
+            self.failed += 1
+            if command in self.writes:
+                return
+            if key in self.confirmed:
+                self.state[key] = self.confirmed[key]
+            else:
+                self.state.pop(key, None)
+
+    def stop(self):
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join(timeout=2)
+
+    def stats(self):
+
+        latency = list(self.latency)
+        return {'coalesced': self.coalesced, 'failed': self.failed, 'commands': len(latency),
+                'mean_ms': round(1000 * sum(latency) / len(latency), 2) if latency else None,
+                'max_ms': round(1000 * max(latency), 2) if latency else None}
+
+
+class LaserIOPool:
+
+    def __init__(self, lasers: dict):
+
+        """One LaserIO per laser so a slow serial link only holds up its own laser
+            :param lasers: key to laser driver, like instrument.lasers
+        """
+
+        self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self.devices = {name: LaserIO(name, device) for name, device in lasers.items()}
+
+    def write(self, name: str, command: str, value):
+
+        return self.devices[name].write(command, value)
+
+    def state(self, name: str, command: str, default=None):
+
+        """Last known value of command from mirror"""
+
+        return self.devices[name].state.get(command, default)
+
+    def read(self, name: str, command: str, timeout: float = 30):
+
+        """Query laser and wait for value"""
+
+        return self.devices[name].query(command).result(timeout=timeout)
+
+    def missing(self, queries: dict):
+
+        """Queries whose values aren't in mirror yet
+        :param queries: laser key to list of getters
+        :return: queries of lasers in pool left to read"""
+
+        missing = {name: [command for command in commands if command not in self.devices[name].state]
+                   for name, commands in queries.items() if name in self.devices}
+        return {name: commands for name, commands in missing.items() if commands}
+
+    def prefetch(self, queries: dict, timeout: float = 30):
+
+        """Read values of every laser at once. Queries of one laser run in order while lasers run in parallel
+        :param queries: laser key to list of getters
+        :return: seconds it took"""
+
+        start = perf_counter()
+        futures = [self.devices[name].query(command) for name, commands in queries.items()
+                   for command in commands if name in self.devices]
+        done, not_done = wait(futures, timeout=timeout)
+        if not_done:
+            self.log.warning(f'{len(not_done)} laser queries did not finish in {timeout} s')
+        elapsed = perf_counter() - start
+        self.log.info(f'Queried {len(queries)} lasers in {elapsed:.2f} s')
+        return elapsed
+
+    def stop(self):
+
+        for device in self.devices.values():
+            device.stop()
+
+    def stats(self):
+
+        return {name: device.stats() for name, device in self.devices.items()}
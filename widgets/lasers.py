@@ -1,4 +1,5 @@
 from widgets.widget_base import WidgetBase
+from widgets.reconfiguration import ReconfigurationScheduler
 from PyQt5.QtCore import Qt, QSize
 from qtpy.QtWidgets import QPushButton, QCheckBox, QLabel, QComboBox, QSpinBox, QDockWidget, QSlider, QLineEdit, \
     QTabWidget, QVBoxLayout, QMessageBox, QDial, QFrame, QInputDialog, QWidget
@@ -6,20 +7,39 @@ import qtpy.QtCore as QtCore
 import logging
 import numpy as np
 from math import floor, ceil
-from sympy import symbols, Eq, solve
+from widgets.power_curve import PowerCurve
+from widgets.laser_io import LaserIOPool
+
+
+def laser_state_queries(wavelengths, lasers: dict, simulated: bool):
+
+    """Getters read from every laser to build laser widgets
+    :param wavelengths: possible wavelengths in config
+    :param lasers: key to laser driver, like instrument.lasers
+    :return: laser key to list of getters"""
+
+    queries = {str(wl): ['get_max_setpoint'] if simulated else ['get_setpoint', 'get_max_setpoint']
+               for wl in wavelengths}
+    if not simulated and 'main' in lasers:
+        queries['main'] = ['get_percentage_split']
+    return queries
 
 
 class Lasers(WidgetBase):
 
-    def __init__(self, viewer, cfg, instrument, simulated):
+    def __init__(self, viewer, cfg, instrument, simulated, reconfiguration: ReconfigurationScheduler = None,
+                 laser_io: LaserIOPool = None):
 
         """
             :param viewer: napari viewer
             :param cfg: config object from instrument
             :param instrument: instrument bing used
             :param simulated: if instrument is in simulate mode
+            :param reconfiguration: shared scheduler reprogramming hardware after config changes
+            :param laser_io: workers talking to each laser. One is created if not given
         """
 
+        self.reconfiguration = reconfiguration
         self.viewer = viewer
         self.cfg = cfg
         self.instrument = instrument
@@ -27,6 +47,8 @@ class Lasers(WidgetBase):
         self.possible_wavelengths = self.cfg.laser_wavelengths
         self.imaging_wavelengths = self.cfg.imaging_wavelengths
         self.lasers = self.instrument.lasers
+        self.laser_io = LaserIOPool(self.lasers) if laser_io is None else laser_io
+        self.prefetched = False
         self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
 
         self.wavelength_selection = {}
@@ -37,9 +59,10 @@ class Lasers(WidgetBase):
         self.combiner_power_split = {}
         self.selected_wl_layout = None
         self.tab_widget = None
-        self.laser_power_conversion = {}
+        self.laser_power_conversion = {}   # Power curve of each laser with coefficients in config
         self.dial_widgets = {}
         self.dials = {}
+        self.wavelength_docks = {}     # Wavelength to tab dock its dials are built into when tab is first shown
 
     def laser_wl_select(self):
 
@@ -121,15 +144,13 @@ class Lasers(WidgetBase):
     def add_wavelength_tabs(self, tab_widget: QTabWidget):
 
         """Adds laser parameters tabs onto main window for all possible wavelengths
-        :param imaging_dock: main window to tabify laser parameter """
+        :param imaging_dock: main window to tabify laser parameter. Dials are built by build_wavelength_tab"""
 
         self.tab_widget = tab_widget
         for wl in self.possible_wavelengths:
             wl = str(wl)
-            wl_dock = self.scan_wavelength_params(wl)
-            scroll_box = self.scroll_box(wl_dock)
             scrollable_dock = QDockWidget()
-            scrollable_dock.setWidget(scroll_box)
+            self.wavelength_docks[wl] = scrollable_dock
             self.tab_widget.addTab(scrollable_dock, f'Wavelength {wl}')
             self.tab_widget.tabBarClicked.connect(self.change_viewer_layer)
             self.tab_map[wl] = self.tab_widget.indexOf(scrollable_dock)
@@ -140,6 +161,18 @@ class Lasers(WidgetBase):
 
         return self.tab_widget
 
+    def build_wavelength_tab(self, index: int):
+
+        """Build dials of wavelength tab if it hasn't been built yet
+        :param index: index of tab being shown
+        :return: wavelength built or None"""
+
+        for wl, tab_index in self.tab_map.items():
+            if tab_index == index and wl not in self.dials:
+                scroll_box = self.scroll_box(self.scan_wavelength_params(wl))
+                self.wavelength_docks[wl].setWidget(scroll_box)
+                return wl
+
     def change_viewer_layer(self, index):
 
         """Change selected layer based on what laser tab your on"""
@@ -208,19 +241,17 @@ class Lasers(WidgetBase):
 
         widget.setText(str(value/1000))
 
-    def calculate_laser_current(self, func, num = 0):
+    def calculate_laser_current(self, curve: PowerCurve, num = 0):
 
-        """Will find the solution of a polynomial function between 0 and 100
-        coresponding to curent % of laser
+        """Will find the current % of laser between 0 and 100 giving power
 
-        :param func: polynomial function coresponding to laser power vs current """
+        :param curve: power vs current curve of laser
+        :param num: power in mW"""
 
-        percent = None
-        solutions = solve(func - num)  # solutions for laser value
-        for sol in solutions:
-            if round(sol) in range(0, 101):
-                percent = sol
-                return percent
+        try:
+            return curve.percent(num)
+        except ValueError as e:
+            self.log.warning(str(e))
 
         # If value between 0-100 doesn't exist return error message
         msgBox = QMessageBox()
@@ -230,12 +261,25 @@ class Lasers(WidgetBase):
         msgBox.setStandardButtons(QMessageBox.Ok)
         return msgBox.exec()
 
+    def prefetch_state(self):
+
+        """Read setpoints of every laser and combiner split at once instead of one laser after the other. Only
+        asks the lasers the first time and skips values already read, e.g. by the startup snapshot"""
+
+        if self.prefetched:
+            return
+        queries = self.laser_io.missing(laser_state_queries(self.possible_wavelengths, self.lasers, self.simulated))
+        if queries:
+            self.laser_io.prefetch(queries)
+        self.prefetched = True
+
     def laser_power_slider(self):
 
         """Create slider for every possible laser and hides ones not in use
         :param lasers: dictionary of lasers created """
 
         laser_power_layout = {}
+        self.prefetch_state()
 
         for wl in self.possible_wavelengths:
             wl = str(wl)
@@ -248,17 +292,16 @@ class Lasers(WidgetBase):
             else:
                 coeffiecients = {}
 
-            # Populating function with coefficients and exponents
-            x = symbols('x')
-            func = 0
-            for order, co in coeffiecients.items():
-                func = func + float(co) * x ** int(order)
+            # Compile curve once so conversions don't solve polynomial
+            func = PowerCurve(coeffiecients) if coeffiecients != {} else None
+            self.laser_power_conversion[wl] = func
 
-            intensity = float(self.lasers[wl].get_setpoint()) if not self.simulated else 15
-            value = intensity if coeffiecients == {} else round(func.subs(x, intensity))
+            intensity = float(self.laser_io.state(wl, 'get_setpoint', 0)) if not self.simulated else 15
+            max_setpoint = float(self.laser_io.state(wl, 'get_max_setpoint', 100))
+            value = intensity if coeffiecients == {} else round(func.power(intensity))
             unit = '%' if coeffiecients == {} and self.cfg.laser_specs[wl]['intensity_mode'] == 'current' else 'mW'
             min = 0
-            max = self.lasers[wl].get_max_setpoint() if coeffiecients == {} and not self.simulated else round(func.subs(x, float(self.lasers[wl].get_max_setpoint())))
+            max = max_setpoint if coeffiecients == {} else round(func.power(max_setpoint))
 
             # Create slider and label
             self.laser_power[f'{wl} label'], self.laser_power[wl] = self.create_widget(
@@ -323,9 +366,9 @@ class Lasers(WidgetBase):
                 if power == QMessageBox.Ok:
                     return
 
-                self.lasers[wl].set_setpoint(float(round(power)))
+                self.laser_io.write(wl, 'set_setpoint', float(round(power)))
             else:
-                self.lasers[wl].set_setpoint(float(round(value)))
+                self.laser_io.write(wl, 'set_setpoint', float(round(value)))
 
     def laser_power_splitter(self):
 
@@ -333,7 +376,8 @@ class Lasers(WidgetBase):
         Create slider for laser combiner power split
                 """
 
-        split_percentage = self.lasers['main'].get_percentage_split() if not self.simulated else '15%'
+        self.prefetch_state()
+        split_percentage = self.laser_io.state('main', 'get_percentage_split', '15%') if not self.simulated else '15%'
         self.combiner_power_split['Left label'] = QLabel(
             f'Left: {100 - float(split_percentage[0:-1])}%')  # Left laser is set to 100 - percentage entered
         self.combiner_power_split['slider'] = QSlider()
@@ -359,5 +403,5 @@ class Lasers(WidgetBase):
         self.combiner_power_split['Left label'].setText(f'Left: {100 - int(value)}%')
 
         if released:
-            self.lasers['main'].set_percentage_split(value)
+            self.laser_io.write('main', 'set_percentage_split', value)
             self.log.info(f'Laser power split set. Right: {value}%  Left: {100 - int(value)}%')
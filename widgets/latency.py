@@ -0,0 +1,149 @@
+import csv
+import json
+import threading
+import numpy as np
+from collections import OrderedDict, deque
+from time import perf_counter
+
+STAGES = ('requested', 'received', 'yielded', 'update', 'drawn')
+HOPS = {'camera': ('requested', 'received'),  # Waiting on camera and instrument generator for next frame
+        'worker': ('received', 'yielded'),  # Frame handed from instrument until it is in the ring buffer
+        'queue': ('yielded', 'update'),  # Waiting for the gui to pick it up
+        'render': ('update', 'drawn')}  # Napari update until the canvas has been drawn
+
+
+class LatencyMonitor:
+
+    def __init__(self, window: int = 2000, max_open: int = 256):
+
+        """Timestamps frames at five points of the live pipeline: when the livestream worker asks the instrument for
+        the next frame, when the instrument hands it over, when the worker has published it, when update_layer is
+        called with it, and when the canvas has drawn it. The camera hop includes waiting for the exposure, so end to
+        end latency is counted from when the frame was received. Every stamp is a single attribute check while
+        disabled so it can stay in production builds.
+            :param window: number of completed frames kept for histogram and export
+            :param max_open: frames that never got displayed are forgotten after this many newer frames
+        """
+
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.max_open = max_open
+        self.open = OrderedDict()  # Frames not yet drawn
+        self.records = deque(maxlen=window)
+        self.start = perf_counter()
+
+    def set_enabled(self, enabled: bool):
+
+        with self.lock:
+            self.enabled = enabled
+            self.open.clear()
+
+    def clear(self):
+
+        with self.lock:
+            self.open.clear()
+            self.records.clear()
+            self.start = perf_counter()
+
+    def begin(self, frame_id, requested: float, received: float, yielded: float):
+
+        """Record first three stamps of a frame. Called from livestream worker
+        :param frame_id: (channel, sequence number) of frame
+        :param requested: time worker asked instrument for the frame
+        :param received: time frame was handed over by the instrument
+        :param yielded: time frame was available to the gui"""
+
+        if not self.enabled:
+            return
+        with self.lock:
+            self.open[frame_id] = [requested, received, yielded, None, None]
+            while len(self.open) > self.max_open:
+                self.open.popitem(last=False)
+
+    def update(self, frame_id):
+
+        """Stamp frame when update_layer is called with it"""
+
+        if not self.enabled:
+            return
+        with self.lock:
+            stamps = self.open.get(frame_id)
+            if stamps is not None:
+                stamps[STAGES.index('update')] = perf_counter()
+
+    def drawn(self, event=None):
+
+        """Stamp every updated frame when the canvas has finished drawing. Connect to the canvas draw event"""
+
+        if not self.enabled:
+            return
+        now = perf_counter()
+        with self.lock:
+            update, drawn = STAGES.index('update'), STAGES.index('drawn')
+            for frame_id in [k for k, v in self.open.items() if v[update] is not None]:
+                stamps = self.open.pop(frame_id)
+                stamps[drawn] = now
+                self.records.append((frame_id, stamps))
+
+    def totals_ms(self):
+
+        """End to end latency of completed frames in ms, from frame received to drawn"""
+
+        received, drawn = STAGES.index('received'), STAGES.index('drawn')
+        with self.lock:
+            return np.array([(s[drawn] - s[received]) * 1000 for _, s in self.records])
+
+    def histogram(self, bins: int = 20):
+
+        """Histogram of end to end latency of recent frames
+        :return: (counts, bin edges in ms)"""
+
+        totals = self.totals_ms()
+        if totals.size == 0:
+            return np.zeros(bins), np.linspace(0, 1, bins + 1)
+        return np.histogram(totals, bins=bins)
+
+    def summary(self):
+
+        """Mean latency of every hop in ms"""
+
+        with self.lock:
+            records = list(self.records)
+        if not records:
+            return {}
+        stamps = np.array([s for _, s in records])
+        summary = {hop: float(np.mean(stamps[:, STAGES.index(b)] - stamps[:, STAGES.index(a)]) * 1000)
+                   for hop, (a, b) in HOPS.items()}
+        summary['total'] = float(np.mean(stamps[:, STAGES.index('drawn')] - stamps[:, STAGES.index('received')]) * 1000)
+        summary['frames'] = len(records)
+        return summary
+
+    def export_csv(self, path: str):
+
+        """Write stamps of recent frames in ms since monitor start"""
+
+        with self.lock:
+            records = list(self.records)
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['channel', 'frame', *[f'{stage}_ms' for stage in STAGES]])
+            for (channel, seq), stamps in records:
+                writer.writerow([channel, seq, *[round((t - self.start) * 1000, 3) for t in stamps]])
+
+    def export_chrome_trace(self, path: str):
+
+        """Write recent frames as chrome trace json. Open in chrome://tracing or perfetto. Every channel is a
+        thread and every hop a complete event"""
+
+        with self.lock:
+            records = list(self.records)
+        events = []
+        for (channel, seq), stamps in records:
+            for hop, (a, b) in HOPS.items():
+                start = stamps[STAGES.index(a)]
+                end = stamps[STAGES.index(b)]
+                events.append({'name': hop, 'cat': 'liveview', 'ph': 'X', 'pid': 0, 'tid': str(channel),
+                               'ts': (start - self.start) * 1e6, 'dur': (end - start) * 1e6,
+                               'args': {'frame': seq}})
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
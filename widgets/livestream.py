@@ -1,28 +1,41 @@
 from widgets.widget_base import WidgetBase
+from widgets.frame_buffer import FrameRingBuffer
+from widgets.frame_pacer import FramePacer, DEFAULT_FPS
+from widgets.autocontrast import StreamingAutocontrast
+from widgets.latency import LatencyMonitor
+from widgets.stage_position import StagePositionService
+from widgets.hardware_snapshot import HardwareSnapshot
+from widgets.reconfiguration import ReconfigurationScheduler
 from qtpy.QtWidgets import QPushButton, QComboBox, QSpinBox, QLineEdit, QTabWidget,QListWidget,QListWidgetItem, \
-    QAbstractItemView, QScrollArea, QSlider, QLabel, QCheckBox, QToolButton, QDial
+    QAbstractItemView, QScrollArea, QSlider, QLabel, QCheckBox, QToolButton, QDial, QFileDialog
 import qtpy.QtGui as QtGui
 import qtpy.QtCore as QtCore
-from nidaqmx.constants import TaskMode, FrequencyUnits, Level
-from ispim.compute_waveforms import generate_waveforms
+from widgets.waveform_cache import generate_waveforms
 import numpy as np
 from math import ceil
-from skimage.io import imsave
 from napari.qt.threading import thread_worker, create_worker
-from time import sleep
+from pyqtgraph import PlotWidget, BarGraphItem
+from time import sleep, perf_counter
 import logging
 import os
 import datetime
+from widgets.startup_profile import lazy_import
+
+skimage_io = lazy_import('skimage.io')
 
 class Livestream(WidgetBase):
 
-    def __init__(self, viewer, cfg, instrument, simulated: bool):
+    def __init__(self, viewer, cfg, instrument, simulated: bool, position_service: StagePositionService = None,
+                 snapshot: HardwareSnapshot = None, reconfiguration: ReconfigurationScheduler = None):
 
         """
             :param viewer: napari viewer
             :param cfg: config object from instrument
             :param instrument: instrument bing used
             :param simulated: if instrument is in simulate mode
+            :param position_service: shared poller of stage position
+            :param snapshot: hardware values read at startup
+            :param reconfiguration: shared scheduler reprogramming hardware. Its ni_lock guards ni tasks
         """
 
         self.cfg = cfg
@@ -42,17 +55,31 @@ class Livestream(WidgetBase):
         self.set_scan_start = {}  # Holds widgets related to setting volume limits during scan
         self.live_view_lasers = []  # list containing lasers to play during livestream
         self.stage_position = None
+        self.sample_pos = None
         self.tab_widget = None
-        self.sample_pos_worker = None
+        self.position_service = position_service if position_service is not None \
+            else StagePositionService(instrument)
+        self.snapshot = HardwareSnapshot() if snapshot is None else snapshot
+        self.reconfiguration = ReconfigurationScheduler(instrument) if reconfiguration is None else reconfiguration
         self.end_scan = None
 
         self.livestream_worker = None
+        self.frame_buffer = FrameRingBuffer()   # Frames waiting to be displayed
+        self.autocontrast = StreamingAutocontrast()
+        self.autocontrast_enabled = False
+        self.frame_pacer = FramePacer(self.display_frame, report=self.update_display_rate)
+        self.latency = LatencyMonitor()
+        self.latency_panel = {}
+        self.frame_pacer.add_source(self.frame_buffer)   # Pulls newest frames from buffer at display rate
+        self.display_rate = {}
+        self.multiscale_levels = 3  # Full resolution, 2x and 4x downsampled
         self.scale = [self.cfg.tile_specs['x_field_of_view_um'] / self.cfg.sensor_row_count,
                       self.cfg.tile_specs['y_field_of_view_um'] / self.cfg.sensor_column_count]
 
         # Put nidaq in correct state for liveview.
         # Configuring the ni tasks during other threads is buggy so avoid doing if possible
-        self.instrument._setup_waveform_hardware(self.cfg.imaging_wavelengths, live=True)
+        with self.reconfiguration.ni_lock:
+            self.instrument._setup_waveform_hardware(self.cfg.imaging_wavelengths, live=True)
 
     def set_tab_widget(self, tab_widget: QTabWidget):
 
@@ -64,21 +91,13 @@ class Livestream(WidgetBase):
         directions = ['x', 'y', 'z']
         if index == 0:
             try:
-                sleep(1)    # Sleep to allow threads to quit
-
-                self.stage_position = self.instrument.sample_pose.get_position()
+                self.stage_position = self.position_service.get_position(max_age_s=1)
                 # Update stage labels if stage has moved
                 for direction in directions:
                     self.pos_widget[direction].setValue(int(self.stage_position[direction] * 1 / 10))
             except ValueError:
                 pass    # Pass if stage coughs up garbage
 
-            if self.instrument.livestream_enabled.is_set() and self.instrument.scout_mode != True:
-                self.sample_pos_worker.resume()
-
-        if index != 0 and self.instrument.livestream_enabled.is_set() and self.instrument.scout_mode != True:
-            self.sample_pos_worker.pause()
-
 
     def liveview_widget(self):
 
@@ -134,6 +153,19 @@ class Livestream(WidgetBase):
 
         self.live_view['scan_start'] = self.create_layout(struct='V', **self.set_scan_start)
 
+        # Target display rate of liveview and achieved rate
+        self.display_rate['label'], self.display_rate['fps'] = self.create_widget(DEFAULT_FPS, QSpinBox,
+                                                                                  'Display FPS:')
+        self.display_rate['fps'].setRange(1, 240)
+        self.display_rate['fps'].valueChanged.connect(self.frame_pacer.set_fps)
+        self.display_rate['achieved'] = QLabel()
+        self.display_rate['autocontrast'] = QCheckBox('Autocontrast')
+        self.display_rate['autocontrast'].stateChanged.connect(self.set_autocontrast)
+        self.display_rate['multiscale'] = QCheckBox('Multiscale')
+        self.display_rate['multiscale'].setToolTip('Display downsampled frames when zoomed out')
+        self.display_rate['multiscale'].stateChanged.connect(self.set_multiscale)
+        self.live_view['display_rate'] = self.create_layout(struct='V', **self.display_rate)
+
         return self.create_layout(struct='H', **self.live_view)
 
     def start_live_view(self):
@@ -155,32 +187,48 @@ class Livestream(WidgetBase):
 
         # Reconfigure buffer of ni for livestream
         _, ao_voltages = generate_waveforms(self.cfg, self.live_view_lasers)
-        self.instrument.ni.rereserve_buffer(len(ao_voltages[0]))
-
-        self.instrument.start_livestream(self.live_view_lasers, self.set_scan_start['scouting'].isChecked()) # Needs to be list
+        with self.reconfiguration.ni_lock:
+            self.instrument.ni.rereserve_buffer(len(ao_voltages[0]))
+            self.instrument.start_livestream(self.live_view_lasers, self.set_scan_start['scouting'].isChecked()) # Needs to be list
 
-        self.sample_pos_worker = self._sample_pos_worker()
-        self.sample_pos_worker.start()
-        if self.tab_widget.currentIndex() != 0:
-            self.sample_pos_worker.pause()
-        self.sample_pos_worker.finished.connect(self.instrument.stop_livestream)
+        self.position_service.subscribe(self.update_stage_position)
 
         self.live_view['start'].clicked.connect(self.stop_live_view)
         # Only allow stopping once everything is initialized
         # to avoid crashing gui
 
-        self.livestream_worker = create_worker(self.instrument._livestream_worker)
-        self.livestream_worker.yielded.connect(self.update_layer)
-        self.livestream_worker.start()
+        self.start_frame_pipeline()
         # Disable moving stage while in liveview
 
+    def start_frame_pipeline(self):
+
+        """Start moving frames from instrument livestream to the viewer. Instrument livestream has to be started"""
+
+        self.frame_buffer.reset()
+        self.livestream_worker = self._frame_buffer_worker()
+        self.livestream_worker.start()
+        self.frame_pacer.start()
+
+    def stop_frame_pipeline(self):
+
+        """Stop moving frames to the viewer and log how many were displayed"""
+
+        self.livestream_worker.quit()
+        self.frame_pacer.stop()
+        stats = self.frame_buffer.stats()
+        self.log.info(f'Livestream displayed {stats["written"] - stats["dropped"]} of {stats["written"]} frames. '
+                      f'{stats["dropped"]} stale frames dropped')
+        self.log.info(f'Livestream display rate: {self.frame_pacer.stats()}')
+
     def stop_live_view(self):
 
         """Stop livestreaming"""
         self.disable_button(button=self.live_view['start'])
         self.live_view['start'].clicked.disconnect(self.stop_live_view)
-        self.livestream_worker.quit()
-        self.sample_pos_worker.quit()
+        self.stop_frame_pipeline()
+        self.position_service.unsubscribe(self.update_stage_position)
+        with self.reconfiguration.ni_lock:     # Waits for a running reprogram to finish
+            self.instrument.stop_livestream()
         self.live_view['start'].setText('Start Live View')
 
         self.live_view['start'].clicked.connect(self.start_live_view)
@@ -188,6 +236,154 @@ class Livestream(WidgetBase):
         self.move_stage['slider'].setEnabled(True)
         self.move_stage['position'].setEnabled(True)
 
+    @thread_worker
+    def _frame_buffer_worker(self):
+
+        """Write frames from instrument into ring buffer. Frames aren't passed through the yielded signal so a
+        camera faster than the gui can't flood the Qt event queue"""
+
+        frames = self.instrument._livestream_worker()
+        while True:
+            requested = perf_counter()  # Stamped around next so camera and generator time is its own hop
+            try:
+                args = next(frames)
+            except StopIteration:
+                return
+            if args is not None:
+                received = perf_counter()
+                (image, layer) = args
+                seq = self.frame_buffer.write(layer, image)
+                if self.latency.enabled:
+                    self.latency.begin((layer, seq), requested, received, perf_counter())
+                if self.autocontrast_enabled:
+                    self.autocontrast.update(layer, image)
+            yield   # Yield so thread can stop
+
+    def display_frame(self, args):
+
+        """Update layer with frame from frame pacer and push autocontrast limits if they have moved"""
+
+        if self.latency.enabled:
+            self.latency.update((args[1], self.frame_buffer.last_read(args[1])))
+        self.update_layer(args)
+        if self.autocontrast_enabled:
+            limits = self.autocontrast.changed(args[1])
+            key = f'Wavelength {args[1]}'
+            if limits is not None and key in self.viewer.layers:
+                self.viewer.layers[key].contrast_limits = limits
+
+    def latency_widget(self):
+
+        """Panel showing a rolling histogram of liveview latency with export to csv and chrome trace"""
+
+        self.latency_panel['record'] = QCheckBox('Record Latency')
+        self.latency_panel['record'].stateChanged.connect(self.record_latency)
+        self.latency_panel['graph'] = PlotWidget()
+        self.latency_panel['graph'].setLabel('bottom', 'Latency [ms]')
+        self.latency_panel['graph'].setMinimumHeight(150)
+        self.latency_panel['summary'] = QLabel()
+        self.latency_panel['csv'] = QPushButton('Export CSV')
+        self.latency_panel['csv'].clicked.connect(lambda: self.export_latency('csv'))
+        self.latency_panel['trace'] = QPushButton('Export Chrome Trace')
+        self.latency_panel['trace'].clicked.connect(lambda: self.export_latency('trace'))
+
+        self.latency_timer = QtCore.QTimer()
+        self.latency_timer.setInterval(1000)
+        self.latency_timer.timeout.connect(self.update_latency_panel)
+
+        return self.create_layout(struct='V', **self.latency_panel)
+
+    def canvas_draw_event(self):
+
+        """Draw event of vispy canvas of the viewer"""
+
+        canvas = self.viewer.window.qt_viewer.canvas
+        canvas = getattr(canvas, '_scene_canvas', canvas)  # Newer napari wraps the vispy canvas
+        return canvas.events.draw
+
+    def record_latency(self, state):
+
+        """Start or stop stamping frames. Draw event is only connected while recording
+        :param state: state of QCheckbox. 2 is checked and 0 unchecked"""
+
+        if state == 2:
+            self.latency.clear()
+            self.latency.set_enabled(True)
+            self.canvas_draw_event().connect(self.latency.drawn)
+            self.latency_timer.start()
+        else:
+            self.latency.set_enabled(False)
+            self.canvas_draw_event().disconnect(self.latency.drawn)
+            self.latency_timer.stop()
+
+    def update_latency_panel(self):
+
+        """Redraw latency histogram and mean latency of every hop"""
+
+        counts, edges = self.latency.histogram()
+        self.latency_panel['graph'].clear()
+        self.latency_panel['graph'].addItem(BarGraphItem(x0=edges[:-1], x1=edges[1:], height=counts,
+                                                         brush='cornflowerblue'))
+        summary = self.latency.summary()
+        if summary:
+            self.latency_panel['summary'].setText(', '.join(f'{k}: {round(v, 1)}' + ('' if k == 'frames' else ' ms')
+                                                            for k, v in summary.items()))
+
+    def export_latency(self, filetype: str):
+
+        """Save recorded latencies
+        :param filetype: csv or trace"""
+
+        file_filter = 'CSV (*.csv)' if filetype == 'csv' else 'Chrome Trace (*.json)'
+        path, _ = QFileDialog.getSaveFileName(None, 'Export Latency', '', file_filter)
+        if path == '':
+            return
+        if filetype == 'csv':
+            self.latency.export_csv(path)
+        else:
+            self.latency.export_chrome_trace(path)
+
+    def set_autocontrast(self, state):
+
+        """Turn on autocontrast computed from a streaming histogram in the livestream worker
+        :param state: state of QCheckbox. 2 is checked and 0 unchecked"""
+
+        self.autocontrast.reset()
+        self.autocontrast_enabled = state == 2
+
+    def set_multiscale(self, state):
+
+        """Build a frame pyramid in the livestream worker and display the level that fits the current zoom
+        :param state: state of QCheckbox. 2 is checked and 0 unchecked"""
+
+        if state == 2:
+            self.frame_buffer.set_levels(self.multiscale_levels)
+            self.viewer.camera.events.zoom.connect(self.update_display_level)
+            self.update_display_level()
+        else:
+            self.viewer.camera.events.zoom.disconnect(self.update_display_level)
+            self.frame_buffer.set_levels(1)
+            self.frame_buffer.set_display_level(0)
+
+    def update_display_level(self, event=None):
+
+        """Pick coarsest pyramid level that still has at least one frame pixel per screen pixel"""
+
+        screen_px_per_frame_px = self.viewer.camera.zoom * min(self.scale)
+        level = 0
+        while level < self.multiscale_levels - 1 and screen_px_per_frame_px * 2 ** (level + 1) <= 1:
+            level += 1
+        self.frame_buffer.set_display_level(level)
+
+    def update_display_rate(self, stats: dict):
+
+        """Show achieved display rate and frames skipped by the frame pacer"""
+
+        if 'achieved' in self.display_rate:
+            dropped = self.frame_buffer.dropped
+            self.display_rate['achieved'].setText(f'{stats["achieved_fps"]} fps, '
+                                                  f'{stats["skipped"] + dropped} skipped')
+
     def disable_button(self, pressed=None, button = None, pause=3000):
 
         """Function to disable button clicks for a period of time to avoid crashing gui"""
@@ -215,15 +411,16 @@ class Livestream(WidgetBase):
         self.live_view['wavelength'].setStyleSheet(
             f'QComboBox {{ background-color:{self.cfg.laser_specs[str(wavelength)]["color"]}; color : black; }}')
         self.live_view_lasers = [wavelength]
-        if self.instrument.livestream_enabled.is_set():
-            self.instrument.setup_imaging_for_laser(wavelength, True)
+        with self.reconfiguration.ni_lock:
+            if self.instrument.livestream_enabled.is_set():
+                self.instrument.setup_imaging_for_laser(wavelength, True)
 
     def sample_stage_position(self):
 
         """Creates labels and boxs to indicate sample position"""
 
         directions = ['x', 'y', 'z']
-        self.stage_position = self.instrument.sample_pose.get_position()
+        self.stage_position = self.position_service.get_position()
 
         # Create X, Y, Z labels and displays for where stage is
         for direction in directions:
@@ -236,8 +433,7 @@ class Livestream(WidgetBase):
 
         """Set the starting position of the scan"""
 
-        current = self.sample_pos if self.instrument.livestream_enabled.is_set() \
-            else self.instrument.sample_pose.get_position()
+        current = self.position_service.get_position(max_age_s=1)
 
         if self.instrument.start_pos is None:
             self.set_scan_start['clear'].setHidden(False)
@@ -249,35 +445,22 @@ class Livestream(WidgetBase):
 
         self.instrument.set_scan_start(None)
 
-    @thread_worker
-    def _sample_pos_worker(self):
-        """Update position widgets for volumetric imaging or manually moving"""
-        sleep(2)
+    def update_stage_position(self, position: dict):
+
+        """Update position widgets while livestreaming. Called by position service when stage has moved
+        :param position: sample pose position in 1/10 um"""
+
         directions = ['x', 'y', 'z']
-        # While livestreaming and looking at the first tab the stage position updates
-        while self.instrument.livestream_enabled.is_set():
-            moved = False
-            try:
-                self.sample_pos = self.instrument.sample_pose.get_position()
-                for direction in directions:
-                    yield
-                    new_pos = int(self.sample_pos[direction] * 1 / 10)
-                    if self.pos_widget[direction].value() != new_pos:
-                        self.pos_widget[direction].setValue(new_pos)
-                        moved = True
-                        yield
-                if moved:
-                    self.update_slider(self.sample_pos)     # Update slide with newest z depth
-                    if self.instrument.scout_mode:
-                        self.start_stop_ni()
-
-                yield
-            except:
-                # Deal with garbled replies from tigerbox
-
-                yield
-            #sleep(.5)
-            yield
+        moved = False
+        self.sample_pos = position
+        for direction in directions:
+            new_pos = int(self.sample_pos[direction] * 1 / 10)
+            if self.pos_widget[direction].value() != new_pos:
+                self.pos_widget[direction].setValue(new_pos)
+                moved = True
+        if moved:
+            self.update_slider(self.sample_pos)     # Update slide with newest z depth
+            self.reconfiguration.pulse()   # Shows new position in scout mode. Runs off gui thread one at a time
     def screenshot_button(self):
 
         """Button that will take a screenshot of liveviewer"""
@@ -293,7 +476,7 @@ class Livestream(WidgetBase):
         if self.viewer.layers != []:
             screenshot = self.viewer.screenshot()
             self.viewer.add_image(screenshot)
-            imsave(rf'C:\Users\{os.getlogin()}\Projects\screenshot_{self.live_view["wavelength"].currentText()}_'
+            skimage_io.imsave(rf'C:\Users\{os.getlogin()}\Projects\screenshot_{self.live_view["wavelength"].currentText()}_'
                    rf'{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.png', screenshot)
         else:
             self.error_msg('Screenshot', 'No image to screenshot')
@@ -302,8 +485,9 @@ class Livestream(WidgetBase):
 
         """Widget to move stage up and down w/o joystick control"""
 
-        z_position = self.instrument.tigerbox.get_position('z')
-        self.z_limit = self.instrument.sample_pose.get_travel_limits('y') if not self.instrument.simulated else {'y':[0,10]}
+        z_position = self.snapshot.get('tigerbox_z', lambda: self.position_service.commands.query(
+            self.instrument.tigerbox.get_position, 'z'))
+        self.z_limit = self.position_service.get_travel_limits('y') if not self.instrument.simulated else {'y':[0,10]}
         self.z_limit['y'] = [round(x*1000) for x in self.z_limit['y']]
         self.z_range = self.z_limit["y"][1] + abs(self.z_limit["y"][0]) # Shift range up by lower limit so no negative numbers
         self.move_stage['up'] = QLabel(
@@ -320,10 +504,9 @@ class Livestream(WidgetBase):
             f'Lower Limit: {round(self.z_limit["y"][1])}')  # Lower limit will be the more positive limit
 
         self.move_stage['halt'] = QPushButton('HALT')
-        self.move_stage['halt'].clicked.connect(self.update_slider)
+        self.move_stage['halt'].clicked.connect(self.halt_stage)
         self.move_stage['halt'].clicked.connect(lambda pressed=True, button=self.move_stage['halt']:
                                                 self.disable_button(pressed,button))
-        self.move_stage['halt'].clicked.connect(self.instrument.tigerbox.halt)
 
         self.move_stage['position'] = QLineEdit(str(z_position['Z']))
         self.move_stage['position'].setValidator(QtGui.QIntValidator(self.z_limit["y"][0],self.z_limit["y"][1]))
@@ -343,11 +526,11 @@ class Livestream(WidgetBase):
             location = int(self.move_stage['position'].text())
             self.move_stage['slider'].setValue(location)
             self.move_stage_textbox(location)
-        if self.instrument.livestream_enabled.is_set():
-            self.sample_pos_worker.pause()
+        self.position_service.pause()   # Don't query stage while waiting for move to finish
         self.tab_widget.setTabEnabled(len(self.tab_widget)-1, False)
-        self.instrument.tigerbox.move_absolute(z=(location*10))
-        self.move_stage_worker = create_worker(lambda axis='y', pos=float(location*10): self.instrument.wait_to_stop(axis, pos))
+        self.position_service.commands.move(self.instrument.tigerbox.move_absolute, z=(location*10))
+        # Wait polls through command queue so halt isn't stuck behind it
+        self.move_stage_worker = create_worker(self.position_service.commands.wait_for_move, 'y', float(location*10))
         self.move_stage_worker.start()
         self.move_stage_worker.finished.connect(self.enable_stage_slider)
 
@@ -357,8 +540,7 @@ class Livestream(WidgetBase):
         self.move_stage['slider'].setEnabled(True)
         self.move_stage['position'].setEnabled(True)
         self.tab_widget.setTabEnabled(len(self.tab_widget) - 1, True)
-        if self.instrument.livestream_enabled.is_set():
-            self.sample_pos_worker.resume()
+        self.position_service.resume()
 
     def move_stage_textbox(self, location):
 
@@ -368,13 +550,21 @@ class Livestream(WidgetBase):
                                                       round(position.y() + (-5)+((location+ abs(self.z_limit["y"][0]))/
                                                       self.z_range*(self.move_stage['slider'].height()-10)))))
 
+    def halt_stage(self):
+
+        """Halt stage ahead of queued stage commands and move slider to where stage stopped. Halting also ends wait
+        of any move in progress"""
+
+        self.position_service.commands.halt()
+        # Query is queued behind halt. Wait for it off the gui thread
+        self.halt_position_worker = create_worker(self.position_service.get_position, max_age_s=0)
+        self.halt_position_worker.returned.connect(self.update_slider)
+        self.halt_position_worker.start()
+
     def update_slider(self, location:dict):
 
-        """Update position of slider if stage halted. Location passed in as samplepose"""
+        """Update position of slider. Location passed in as samplepose"""
 
-        if type(location) == bool:      # if location is bool, then halt button was pressed
-            self.move_stage_worker.quit()
-            location = self.instrument.tigerbox.get_position('z')
         self.move_stage_textbox(int(location['y']/10))
         self.move_stage['slider'].setValue(int(location['y']/10))
 
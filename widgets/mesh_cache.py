@@ -0,0 +1,181 @@
+import glob
+import hashlib
+import logging
+import os
+import re
+import zipfile
+import numpy as np
+
+CACHE_VERSION = 2   # Bump when preprocessing changes so old caches aren't used
+
+log = logging.getLogger(__name__)
+
+STL_TRIANGLE = np.dtype([('normal', '<f4', (3,)), ('points', '<f4', (3, 3)), ('attribute', '<u2')])
+
+
+def read_stl(path: str):
+
+    """Triangles of binary or ascii stl file
+    :return: array of shape (triangles, 3, 3) with corners of each triangle"""
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) >= 84:
+        count = int(np.frombuffer(data, '<u4', 1, 80)[0])
+        if 84 + count * STL_TRIANGLE.itemsize == len(data):  # Ascii files can start with 'solid' so check size instead
+            return np.frombuffer(data, STL_TRIANGLE, count, 84)['points'].astype(np.float32)
+    corners = re.findall(rb'vertex\s+(\S+)\s+(\S+)\s+(\S+)', data)
+    return np.array(corners, dtype=np.float32).reshape(-1, 3, 3)
+
+
+def deduplicate(triangles: np.ndarray):
+
+    """Merge corners shared by triangles into one vertex
+    :param triangles: corners of each triangle with shape (triangles, 3, 3)
+    :return: vertexes and faces indexing them, without triangles that collapsed to a line or point"""
+
+    corners = np.ascontiguousarray(triangles.reshape(-1, 3), dtype=np.float32) + np.float32(0)  # -0 to 0
+    # Unique of corners viewed as single 12 byte values is much faster than unique along an axis
+    unique, faces = np.unique(corners.view('V12').reshape(-1), return_inverse=True)
+    return unique.view(np.float32).reshape(-1, 3), drop_degenerate(faces.reshape(-1, 3))
+
+
+def drop_degenerate(faces: np.ndarray):
+
+    """Remove faces using a vertex more than once and faces repeated with the same vertexes"""
+
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])]
+    ordered = np.ascontiguousarray(np.sort(faces, axis=1), dtype=np.int64)
+    _, first = np.unique(ordered.view('V24').reshape(-1), return_index=True)
+    return faces[np.sort(first)]
+
+
+def decimate(vertexes: np.ndarray, faces: np.ndarray, target_faces: int):
+
+    """Reduce mesh to at most target faces by vertex clustering. Vertexes in the same cell of a grid are merged into
+    their mean and grid is made coarser until mesh is small enough
+    :param target_faces: most faces mesh can have
+    :return: vertexes and faces of decimated mesh"""
+
+    if len(faces) <= target_faces:
+        return vertexes, faces
+    low = vertexes.min(axis=0)
+    extent = max(float((vertexes.max(axis=0) - low).max()), 1e-9)
+    cells = max(int(np.sqrt(target_faces)), 2)  # Cells along longest axis. Surface faces scale with cells squared
+    while True:
+        cell = extent / cells
+        keys = np.floor((vertexes - low) / cell).astype(np.int64)
+        keys = (keys[:, 0] * (cells + 1) + keys[:, 1]) * (cells + 1) + keys[:, 2]
+        _, cluster = np.unique(keys, return_inverse=True)
+        cluster = cluster.reshape(-1)
+        counts = np.bincount(cluster)
+        merged = np.stack([np.bincount(cluster, vertexes[:, axis]) for axis in range(3)], axis=1) / counts[:, None]
+        merged_faces = drop_degenerate(cluster[faces])
+        if len(merged_faces) <= target_faces or cells <= 2:
+            break
+        cells = max(int(cells / 1.25), 2)
+    # Drop clusters no face uses
+    used = np.unique(merged_faces)
+    remap = np.zeros(len(merged), dtype=np.int64)
+    remap[used] = np.arange(len(used))
+    return merged[used].astype(np.float32), remap[merged_faces]
+
+
+def file_hash(path: str):
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cache_path(path: str, target_faces: int = None, cache_dir: str = None):
+
+    """Cache file of stl. Named by size and modification time of stl so finding the cache doesn't read the stl. Hash
+    of stl is stored in the cache to recognise an unchanged stl whose modification time changed"""
+
+    cache_dir = os.path.join(os.path.dirname(path), 'mesh_cache') if cache_dir is None else cache_dir
+    stat = os.stat(path)
+    name = f'{cache_prefix(path, target_faces)}_{stat.st_size}_{stat.st_mtime_ns}_v{CACHE_VERSION}.npz'
+    return os.path.join(cache_dir, name)
+
+
+def cache_prefix(path: str, target_faces: int = None):
+
+    return f'{os.path.splitext(os.path.basename(path))[0]}_{target_faces if target_faces else "full"}'
+
+
+def read_cache(cached: str):
+
+    """Arrays of uncompressed npz cache memory mapped from disk instead of read into memory
+    :return: dict of array name to read only memmap"""
+
+    arrays = {}
+    with zipfile.ZipFile(cached) as archive, open(cached, 'rb') as f:
+        for member in archive.infolist():
+            if member.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f'{member.filename} is compressed')
+            # Array data follows the zip local header, whose name and extra field lengths can differ from the central
+            # directory's, then the npy header
+            f.seek(member.header_offset + 26)
+            name_length, extra_length = np.frombuffer(f.read(4), '<u2')
+            f.seek(member.header_offset + 30 + int(name_length) + int(extra_length))
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+                np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            name = member.filename[:-len('.npy')]
+            if dtype.hasobject or not shape or 0 in shape:
+                arrays[name] = np.load(archive.open(member), allow_pickle=False)
+            else:
+                arrays[name] = np.memmap(f, dtype, 'r', f.tell(), shape, 'F' if fortran_order else 'C')
+    return arrays
+
+
+def load_mesh(path: str, target_faces: int = None, cache_dir: str = None):
+
+    """Indexed mesh of stl. Preprocessed mesh is cached so stl is only parsed the first time it's loaded. Vertexes are
+    memory mapped from the cache
+    :param path: stl file
+    :param target_faces: decimate mesh to at most this many faces. None keeps every face
+    :param cache_dir: directory of caches. Defaults to mesh_cache next to stl
+    :return: float32 vertexes and faces indexing them"""
+
+    cached = cache_path(path, target_faces, cache_dir)
+    if os.path.exists(cached):
+        try:
+            mesh = read_cache(cached)
+            return mesh['vertexes'], mesh['faces'].astype(np.int64)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            log.warning(f'Rebuilding unreadable mesh cache {cached}: {e}')
+
+    # Stl was touched or copied. Reuse a cache of the same content before parsing it again
+    sha256 = file_hash(path)
+    for old in glob.glob(os.path.join(os.path.dirname(cached), f'{cache_prefix(path, target_faces)}_*.npz')):
+        try:
+            with np.load(old) as mesh:
+                if str(mesh['sha256']) != sha256:
+                    continue
+            os.replace(old, cached)
+            mesh = read_cache(cached)
+            return mesh['vertexes'], mesh['faces'].astype(np.int64)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            continue
+
+    triangles = read_stl(path)
+    vertexes, faces = deduplicate(triangles)
+    if target_faces:
+        vertexes, faces = decimate(vertexes, faces, target_faces)
+    log.info(f'{os.path.basename(path)}: {len(triangles)} triangles to {len(vertexes)} vertexes and {len(faces)} faces')
+
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        temp = cached + '.tmp'
+        with open(temp, 'wb') as f:
+            np.savez(f, vertexes=vertexes.astype(np.float32), sha256=np.array(sha256),
+                     faces=faces.astype(np.uint16 if len(vertexes) <= np.iinfo(np.uint16).max else np.uint32))
+        os.replace(temp, cached)
+    except OSError as e:
+        log.warning(f'Could not cache mesh of {path}: {e}')
+    return vertexes.astype(np.float32), faces.astype(np.int64)
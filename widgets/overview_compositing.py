@@ -0,0 +1,112 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from widgets.overview_io import downsampled
+
+ALPHA = 200     # Opacity of overview textures in tissue map
+OUT_LUT = np.floor(np.arange(256) * 255 / 256).astype(np.uint8)     # Final rescale of blend to levels [0, 256]
+
+# Flip and rotation putting each overview orientation into tissue map texture orientation
+ORIENT = {
+    'xy': lambda array: np.flip(np.rot90(array, 1), axis=0),
+    'xz': lambda array: np.flip(np.rot90(array, 3), axis=1),
+    'yz': lambda array: np.flip(array, axis=0),
+}
+
+
+def sampled_percentiles(array: np.ndarray, percentiles, max_samples: int = 1000000):
+
+    """Percentiles of array estimated from a strided subsample of at most about max_samples pixels"""
+
+    stride = max(int(np.sqrt(array.size / max_samples)), 1)
+    return np.percentile(array[..., ::stride, ::stride], percentiles)
+
+
+@lru_cache(maxsize=32)
+def channel_lut(low: float, high: float, color: tuple, levels: int = 65536):
+
+    """Lookup table of raw pixel value to color scaled uint8 rgb. Values are clipped to [low, high], split into 256
+    bins and scaled by color the same way the float pipeline did
+    :param low: value mapped to black
+    :param high: value mapped to full color
+    :param color: rgb of channel 0-255
+    :param levels: number of raw values e.g. 65536 for uint16"""
+
+    values = np.clip(np.arange(levels, dtype=np.float64), low, high) - low
+    bins = np.floor(values / max((high - low) / 256, np.finfo(float).tiny))     # 0 - 256
+    gray = np.clip(np.floor(bins * 255 / 256), 0, 255)
+    return np.floor(gray[:, None] * (np.asarray(color[:3], dtype=np.float64) / 255)).astype(np.uint8)
+
+
+def channel_rgb(array: np.ndarray, color, limits: tuple = None, percentiles=(5, 90)):
+
+    """Autocontrast single channel and color it
+    :param limits: (low, high) contrast limits. Estimated from percentiles of array if not given
+    :return: (rows, columns, 3) uint8 and contrast limits used"""
+
+    low, high = sampled_percentiles(array, percentiles) if limits is None else limits
+    low, high = float(low), float(high)
+    color = tuple(color[:3])
+    if array.dtype in (np.uint8, np.uint16):
+        return channel_lut(low, high, color, np.iinfo(array.dtype).max + 1)[array], (low, high)
+    lut = channel_lut(0., 256., color, 257)   # Other dtypes are binned first then looked up
+    bins = np.floor((np.clip(array, low, high) - low) / max((high - low) / 256, np.finfo(float).tiny))
+    return lut[bins.astype(np.uint16)], (low, high)
+
+
+def blend(rgbs):
+
+    """Darken channels in one after the other, channel i mixed in with opacity 1/(i+1), using integer math
+    :param rgbs: iterable of (rows, columns, 3) uint8 colored channels
+    :return: (rows, columns, 4) uint8 texture"""
+
+    blended = None
+    for i, rgb in enumerate(rgbs):
+        if blended is None:
+            blended = rgb.astype(np.uint16)
+        else:
+            darker = np.minimum(blended, rgb)
+            blended *= i
+            blended += darker
+            blended //= i + 1
+    texture = np.empty(blended.shape[:2] + (4,), dtype=np.uint8)
+    texture[..., :3] = OUT_LUT[blended]
+    texture[..., 3] = ALPHA
+    return texture
+
+
+def composite(arrays: list, colors: list, orientation: str, max_px: int = 2048, limits: list = None):
+
+    """Combine channels of one overview orientation into one RGBA texture
+    :param arrays: 2d array of each channel. Can be memory mapped or lazy
+    :param colors: rgb color of each channel 0-255
+    :param orientation: xy, xz or yz
+    :param max_px: largest texture dimension. Channels are read with a stride to fit
+    :param limits: contrast limits of each channel. Estimated from arrays if not given
+    :return: (rows, columns, 4) uint8 texture, stride it was read with, and contrast limits of each channel"""
+
+    limits = [None] * len(arrays) if limits is None else limits
+    used = []
+    rgbs = []
+    stride = 1
+    for array, color, limit in zip(arrays, colors, limits):
+        array, stride = downsampled(array, max_px)
+        rgb, limit = channel_rgb(array, color, limit)
+        rgbs.append(rgb)
+        used.append(limit)
+    texture = blend(rgbs)
+    return np.ascontiguousarray(ORIENT[orientation](texture)), stride, used
+
+
+def composite_overviews(overviews: dict, colors: list, workers: int = 3, max_px: int = 2048):
+
+    """Composite every orientation of an overview in parallel
+    :param overviews: orientation to list of 2d channel arrays
+    :param colors: rgb color of each channel 0-255
+    :param max_px: largest texture dimension
+    :return: orientation to (RGBA texture, stride, contrast limits)"""
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(overviews)) or 1) as pool:
+        futures = {orientation: pool.submit(composite, list(arrays), colors, orientation, max_px)
+                   for orientation, arrays in overviews.items()}
+        return {orientation: future.result() for orientation, future in futures.items()}
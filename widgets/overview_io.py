@@ -0,0 +1,45 @@
+import logging
+import numpy as np
+from widgets.startup_profile import lazy_import
+
+tifffile = lazy_import('tifffile')
+log = logging.getLogger(__name__)
+
+
+def open_overview(path: str):
+
+    """Open overview tiff without reading it into memory. Uncompressed tiffs are memory mapped and anything else
+    is opened as a lazy dask array over tifffile's zarr store
+    :param path: path of overview tiff
+    :return: (channels, rows, columns) array like"""
+
+    try:
+        array = tifffile.memmap(path, mode='r')
+    except ValueError:      # Compressed or not contiguous so can't be memory mapped
+        import dask.array as da
+        log.info(f'{path} can not be memory mapped. Opening lazily through zarr')
+        array = da.from_zarr(tifffile.imread(path, aszarr=True))
+    if array.ndim == 2:     # Single channel
+        array = array[None]
+    return array
+
+
+def overview_pyramid(array, min_px: int = 512):
+
+    """Strided views of array halving resolution each level until smallest level fits min_px. Views of memory mapped
+    or dask arrays aren't read until napari displays them
+    :return: list of levels largest first"""
+
+    levels = [array]
+    while max(levels[-1].shape[-2:]) > min_px:
+        levels.append(array[..., ::2 ** len(levels), ::2 ** len(levels)])
+    return levels
+
+
+def downsampled(array, max_px: int = 2048):
+
+    """Read array with a stride so neither dimension is larger than max_px
+    :return: (in memory array, stride)"""
+
+    stride = max(int(np.ceil(max(array.shape[-2:]) / max_px)), 1)
+    return np.asarray(array[..., ::stride, ::stride]), stride
@@ -0,0 +1,151 @@
+import threading
+from math import ceil
+import numpy as np
+
+MAX_PX = 4096   # Longest side of overview projections kept by the gui
+
+
+def block_max(frame: np.ndarray, factor: int, column_factor: int = None):
+
+    """Downsample frame by taking max of factor x column_factor blocks. Edge pixels that don't fill a block are
+    dropped
+    :param column_factor: factor along columns. Same as factor if not given"""
+
+    column_factor = factor if column_factor is None else column_factor
+    if factor == 1 and column_factor == 1:
+        return frame
+    rows, columns = frame.shape[0] // factor, frame.shape[1] // column_factor
+    return frame[:rows * factor, :columns * column_factor].reshape(rows, factor, columns, column_factor).max(
+        axis=(1, 3))
+
+
+def bin_projections(overview: dict, max_px: int = MAX_PX):
+
+    """Bin full resolution overview projections so no side is longer than max_px. x and y share one factor so
+    pixels stay square in xy
+    :param overview: orientation to list of projections of each wavelength in overview_scan layout, xy is (x, y),
+    xz is (x, z) and yz is (z, y)
+    :return: overview of binned copies"""
+
+    shapes = {orientation: arrays[0].shape for orientation, arrays in overview.items() if len(arrays)}
+    lengths = {'x': [], 'y': [], 'z': []}
+    for orientation, shape in shapes.items():
+        for axis, length in zip(orientation if orientation != 'yz' else 'zy', shape):
+            lengths[axis].append(length)
+    xy_bin = max(ceil(max(lengths['x'] + lengths['y'] + [1]) / max_px), 1)
+    z_bin = max(ceil(max(lengths['z'] + [1]) / max_px), 1)
+    factors = {'xy': (xy_bin, xy_bin), 'xz': (xy_bin, z_bin), 'yz': (z_bin, xy_bin)}
+    return {orientation: [np.ascontiguousarray(block_max(np.asarray(array), *factors[orientation]))
+                          for array in arrays] for orientation, arrays in overview.items()}
+
+
+class StreamingProjector:
+
+    def __init__(self, wavelengths: list, xtiles: int, ytiles: int, ztiles: int, x_step_um: float,
+                 y_step_um: float, z_step_um: float, x_fov_um: float, y_fov_um: float, max_px: int = MAX_PX):
+
+        """Builds xy, xz and yz max intensity projections of an overview as the scan runs, to preview it in the
+        tissue map. Only frames the instrument's livestream generator yields are added, which is the newest frame
+        whenever the gui asks for one rather than every frame, so previews are sampled projections and not true max
+        projections. The finished overview comes from the instrument's projections. Projections are binned so no side
+        is longer than max_px. Projections follow overview_scan layout: xy is (x, y), xz is (x, z) and yz is (z, y).
+            :param wavelengths: wavelengths being scanned
+            :param xtiles: number of tiles in x
+            :param ytiles: number of tiles in y
+            :param ztiles: number of frames in each stack
+            :param x_step_um: grid step between tiles in x
+            :param y_step_um: grid step between tiles in y
+            :param z_step_um: step between frames of a stack
+            :param x_fov_um: field of view of frame rows
+            :param y_fov_um: field of view of frame columns
+            :param max_px: longest side of a projection
+        """
+
+        self.wavelengths = [str(wl) for wl in wavelengths]
+        self.xtiles, self.ytiles, self.ztiles = xtiles, ytiles, ztiles
+        self.x_step_um, self.y_step_um, self.z_step_um = x_step_um, y_step_um, z_step_um
+        self.x_fov_um, self.y_fov_um = x_fov_um, y_fov_um
+        self.max_px = max_px
+
+        self.lock = threading.Lock()
+        self.projections = None     # Allocated once frame size is known
+        self.frames = 0
+        self.last_tile = None
+        self.tiles_done = 0
+        self.version = 0    # Incremented with every frame so readers know when projections changed
+
+    def allocate(self, frame_shape: tuple, dtype):
+
+        """Size projections from frame size and tiling"""
+
+        rows, columns = frame_shape
+        self.x_px_um = self.x_fov_um / rows
+        self.y_px_um = self.y_fov_um / columns
+        x_len = ((self.xtiles - 1) * self.x_step_um + self.x_fov_um) / self.x_px_um
+        y_len = ((self.ytiles - 1) * self.y_step_um + self.y_fov_um) / self.y_px_um
+        self.bin = max(ceil(max(x_len, y_len) / self.max_px), 1)
+        self.z_bin = max(ceil(self.ztiles / self.max_px), 1)
+        x_len, y_len = ceil(x_len / self.bin), ceil(y_len / self.bin)
+        z_len = ceil(self.ztiles / self.z_bin)
+        self.projections = {wl: {'xy': np.zeros((x_len, y_len), dtype=dtype),
+                                 'xz': np.zeros((x_len, z_len), dtype=dtype),
+                                 'yz': np.zeros((z_len, y_len), dtype=dtype)} for wl in self.wavelengths}
+
+    def tile_position(self, tile: int):
+
+        """Grid position of tile. Tiles are numbered along x first like the tissue map tiles"""
+
+        return tile % self.xtiles, tile // self.xtiles
+
+    def add_frame(self, frame: np.ndarray, wavelength, tile: int, layer: int):
+
+        """Max frame into projections
+        :param frame: camera frame with rows along x and columns along y
+        :param wavelength: wavelength of frame
+        :param tile: index of tile frame belongs to
+        :param layer: index of frame in stack of tile"""
+
+        wavelength = str(wavelength)
+        if wavelength not in self.wavelengths or tile is None or layer is None:
+            return
+        with self.lock:
+            if self.projections is None:
+                self.allocate(frame.shape, frame.dtype)
+            binned = block_max(frame, self.bin)
+            x, y = self.tile_position(tile)
+            x0 = round(x * self.x_step_um / (self.x_px_um * self.bin))
+            y0 = round(y * self.y_step_um / (self.y_px_um * self.bin))
+            projection = self.projections[wavelength]
+            z = min(layer // self.z_bin, projection['xz'].shape[1] - 1)
+
+            xy = projection['xy'][x0:x0 + binned.shape[0], y0:y0 + binned.shape[1]]
+            rows, columns = xy.shape    # Clipped at edge of volume
+            np.maximum(xy, binned[:rows, :columns], out=xy)
+            xz = projection['xz'][x0:x0 + rows, z]
+            np.maximum(xz, binned[:rows, :columns].max(axis=1), out=xz)
+            yz = projection['yz'][z, y0:y0 + columns]
+            np.maximum(yz, binned[:rows, :columns].max(axis=0), out=yz)
+
+            if tile != self.last_tile:
+                self.tiles_done += self.last_tile is not None
+                self.last_tile = tile
+            self.frames += 1
+            self.version += 1
+
+    def snapshot(self):
+
+        """Copy of projections in overview_array layout
+        :return: orientation to list of projections of each wavelength or None if no frames yet"""
+
+        with self.lock:
+            if self.projections is None:
+                return None
+            return {orientation: [self.projections[wl][orientation].copy() for wl in self.wavelengths]
+                    for orientation in ['xy', 'xz', 'yz']}
+
+    def scale_mm(self):
+
+        """Size of a projection pixel along x, y and z of the sample in mm"""
+
+        return {'x': self.x_px_um * self.bin / 1000, 'y': self.y_px_um * self.bin / 1000,
+                'z': self.z_step_um * self.z_bin / 1000}
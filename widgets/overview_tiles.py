@@ -0,0 +1,175 @@
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from math import tan, radians, log2, floor
+import numpy as np
+from qtpy.QtCore import QObject, Signal
+from qtpy.QtGui import QMatrix4x4
+from widgets.overview_compositing import ORIENT, channel_rgb, blend
+from widgets.startup_profile import lazy_import
+
+gl = lazy_import('pyqtgraph.opengl')
+
+
+class OverviewTilePyramid(QObject):
+
+    loaded = Signal(object)     # Emitted from loader thread with (key, texture)
+
+    def __init__(self, plot, arrays: list, colors: list, limits: list, orientation: str, transform: QMatrix4x4,
+                 fallback=None, tile_px: int = 512, budget_mb: float = 256):
+
+        """Streams an overview into the tissue map as a pyramid of tiles. Each tile is its own texture read at the
+        resolution matching the camera distance, so native resolution is only loaded where the map is zoomed in.
+            :param plot: GLViewWidget of tissue map
+            :param arrays: 2d array of each channel at full resolution. Can be memory mapped or lazy
+            :param colors: rgb color of each channel 0-255
+            :param limits: contrast limits of each channel so tiles match the fallback texture
+            :param orientation: xy, xz or yz
+            :param transform: full resolution texture pixel to gui coordinates
+            :param fallback: coarse image item of whole overview shown while tiles load
+            :param tile_px: size of tile textures
+            :param budget_mb: memory tiles are allowed to hold before least recently used are evicted
+        """
+
+        super().__init__()
+        self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self.plot = plot
+        self.arrays = [ORIENT[orientation](array) for array in arrays]    # Views in texture orientation
+        self.colors = colors
+        self.limits = limits
+        self.transform = transform
+        self.matrix = np.array(transform.data()).reshape(4, 4).T
+        self.fallback = fallback
+        self.tile_px = tile_px
+        self.budget = budget_mb * 1e6
+
+        self.shape = self.arrays[0].shape[:2]
+        self.max_level = 0
+        while max(self.shape) / 2 ** self.max_level > tile_px:
+            self.max_level += 1
+        # Size of full resolution texture pixel in gui coordinates
+        self.texel_mm = np.linalg.norm(self.matrix[:3, :2], axis=0).max()
+
+        self.tiles = OrderedDict()  # (level, row, column) to image item, least recently used first
+        self.pending = set()
+        self.visible = set()
+        self.memory = 0
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='overview_tiles')
+        self.loaded.connect(self.add_tile)
+
+    def level(self):
+
+        """Pyramid level whose texels are about one screen pixel at current camera distance"""
+
+        opts = self.plot.opts
+        px_per_mm = self.plot.height() / (2 * opts['distance'] * tan(radians(opts['fov'] / 2)))
+        texel_px = self.texel_mm * px_per_mm
+        if texel_px <= 0:
+            return self.max_level
+        return int(min(max(floor(log2(1 / texel_px)), 0), self.max_level))
+
+    def wanted(self, level: int):
+
+        """Tiles of level close enough to camera center to be on screen"""
+
+        stride = 2 ** level
+        span = self.tile_px * stride    # Tile size in full resolution pixels
+        rows, columns = np.meshgrid(np.arange(0, self.shape[0], span), np.arange(0, self.shape[1], span),
+                                    indexing='ij')
+        corners = np.stack([rows.ravel(), columns.ravel()], axis=-1)
+        centers = np.column_stack([corners + span / 2, np.zeros(len(corners)), np.ones(len(corners))])
+        world = (self.matrix @ centers.T).T[:, :3]
+
+        opts = self.plot.opts
+        center = opts['center']
+        aspect = max(self.plot.width() / max(self.plot.height(), 1), 1)
+        radius = 1.5 * opts['distance'] * tan(radians(opts['fov'] / 2)) * aspect + span * self.texel_mm
+        distance = np.linalg.norm(world - np.array([center.x(), center.y(), center.z()]), axis=1)
+        return {(level, int(r), int(c)) for r, c in corners[distance <= radius]}
+
+    def update(self):
+
+        """Show tiles matching the camera and queue loading of missing ones. Coarse fallback is shown until all
+        wanted tiles have loaded"""
+
+        if self.plot is None:
+            return
+        level = self.level()
+        wanted = set() if level >= self.max_level else self.wanted(level)
+        for key in wanted - self.tiles.keys() - self.pending:
+            self.pending.add(key)
+            self.loader.submit(self._load, key)
+        for key in self.visible - wanted:
+            if key in self.tiles:
+                self.tiles[key].setVisible(False)
+        complete = wanted.issubset(self.tiles.keys())
+        for key in wanted & self.tiles.keys():
+            self.tiles[key].setVisible(complete)
+            self.tiles.move_to_end(key)
+        if self.fallback is not None:
+            self.fallback.setVisible(not complete or not wanted)
+        self.visible = wanted
+        self.evict()
+
+    def _load(self, key):
+
+        """Read and composite one tile. Runs on loader thread"""
+
+        level, row, column = key
+        stride = 2 ** level
+        span = self.tile_px * stride
+        try:
+            region = (slice(row, row + span, stride), slice(column, column + span, stride))
+            texture = blend(channel_rgb(np.asarray(array[region]), color, limits)[0]
+                            for array, color, limits in zip(self.arrays, self.colors, self.limits))
+        except Exception as e:
+            self.log.error(f'Loading overview tile {key} failed: {e}')
+            texture = None
+        self.loaded.emit((key, texture))
+
+    def add_tile(self, loaded):
+
+        """Create image item of loaded tile on gui thread"""
+
+        key, texture = loaded
+        self.pending.discard(key)
+        if texture is None or self.plot is None:
+            return
+        level, row, column = key
+        stride = 2 ** level
+        transform = QMatrix4x4(self.transform)
+        transform.translate(row, column, 0)
+        transform.scale(stride, stride, 1)
+        image = gl.GLImageItem(np.ascontiguousarray(texture), glOptions='translucent')
+        image.setTransform(transform)
+        image.setVisible(False)
+        self.plot.addItem(image)
+        self.tiles[key] = image
+        self.memory += texture.nbytes
+        self.update()
+
+    def evict(self):
+
+        """Remove least recently used tiles not on screen until under memory budget"""
+
+        for key in list(self.tiles.keys()):
+            if self.memory <= self.budget:
+                break
+            if key in self.visible:
+                continue
+            image = self.tiles.pop(key)
+            self.memory -= image.data.nbytes
+            if image in self.plot.items:
+                self.plot.removeItem(image)
+
+    def clear(self):
+
+        """Remove all tiles and stop loading"""
+
+        self.loader.shutdown(wait=False, cancel_futures=True)
+        for image in self.tiles.values():
+            if image in self.plot.items:
+                self.plot.removeItem(image)
+        self.tiles.clear()
+        self.memory = 0
+        self.plot = None
@@ -0,0 +1,45 @@
+import numpy as np
+
+
+class PowerCurve:
+
+    def __init__(self, coefficients: dict, domain: tuple = (0, 100), samples: int = 4097):
+
+        """Laser power vs current curve compiled once from config coefficients. Power is evaluated as a numpy
+        polynomial and current is found from power with a precomputed lookup table, so conversions don't have to
+        solve the polynomial.
+            :param coefficients: order of term to coefficient, as in laser_specs coeffecients
+            :param domain: range of current percent the laser can be set to
+            :param samples: points of lookup table across domain
+        """
+
+        orders = {int(order): float(co) for order, co in coefficients.items()}
+        terms = np.zeros(max(orders, default=0) + 1)
+        for order, co in orders.items():
+            terms[order] = co
+        self.polynomial = np.polynomial.Polynomial(terms)
+        self.domain = domain
+
+        # Inverse table only keeps points where power rises above everything before it, so it's strictly increasing
+        # and the lowest current reaching a power is used where the curve dips or flattens
+        current = np.linspace(domain[0], domain[1], samples)
+        power = self.polynomial(current)
+        rising = np.concatenate([[True], power[1:] > np.maximum.accumulate(power)[:-1]])
+        self.table_power = power[rising]
+        self.table_current = current[rising]
+
+    def power(self, percent: float):
+
+        """Power in mW at current percent"""
+
+        return float(self.polynomial(percent))
+
+    def percent(self, power_mw: float):
+
+        """Current percent giving power
+        :raises ValueError: if no current in domain reaches power"""
+
+        if not self.table_power[0] <= power_mw <= self.table_power[-1]:
+            raise ValueError(f'No current percent correlates to {power_mw} mW. Laser ranges from '
+                             f'{self.table_power[0]:.1f} to {self.table_power[-1]:.1f} mW')
+        return float(np.interp(power_mw, self.table_power, self.table_current))
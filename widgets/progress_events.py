@@ -0,0 +1,147 @@
+import logging
+import threading
+from time import time
+from qtpy.QtCore import QObject, Signal, QTimer
+
+
+class ProgressEventBus(QObject):
+
+    updated = Signal(dict)  # Latest progress state, emitted on the gui thread at most once per tick
+
+    def __init__(self, rate_hz: float = 4):
+
+        """Acquisitions report frame, tile and scan boundaries here as they happen. Headless subscribers get every
+        event on the thread that emitted it. Widgets connect to updated, which coalesces events into one state update
+        per gui tick so widgets are only touched from the gui thread.
+            :param rate_hz: how often widgets are updated while events arrive
+        """
+
+        super().__init__()
+        self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.headless = []
+        self.events = 0
+        self.updates = 0
+        self.dirty = False
+        self.tile_timer = None
+        self.state = {}
+        self.reset()
+
+        self.timer = QTimer()
+        self.timer.setInterval(round(1000 / rate_hz))
+        self.timer.timeout.connect(self.flush)
+        self.timer.start()
+
+    def reset(self):
+
+        self.state = {'running': False, 'scan': 0, 'scans': 0, 'tiles_done': 0, 'tiles': 0, 'layer': 0,
+                      'frames_per_tile': 1, 'fraction': 0., 'eta_s': None, 'start_time': None, 'event': None}
+
+    def subscribe(self, callback, headless: bool = False):
+
+        """Get progress
+        :param callback: called with state dict. Headless callbacks are called with every event dict instead
+        :param headless: call on emitting thread for every event rather than on gui thread at update rate"""
+
+        if headless:
+            with self.lock:
+                self.headless.append(callback)
+        else:
+            self.updated.connect(callback)
+
+    def unsubscribe(self, callback, headless: bool = False):
+
+        if headless:
+            with self.lock:
+                if callback in self.headless:
+                    self.headless.remove(callback)
+        else:
+            self.updated.disconnect(callback)
+
+    def emit(self, kind: str, **values):
+
+        """Record event and update progress state. Safe to call from any thread
+        :param kind: run_start, scan_start, frame, tile, scan_end or run_end
+        :param values: state values event changes"""
+
+        event = {'event': kind, 'time': time(), **values}
+        with self.lock:
+            self.state.update(values, event=kind)
+            state = self.state
+            done = state['tiles_done'] + min(state['layer'] / max(state['frames_per_tile'], 1), 1)
+            state['fraction'] = min(done / state['tiles'], 1.) if state['tiles'] else 0.
+            if self.tile_timer is not None:
+                state['eta_s'] = self.tile_timer.remaining_s(state['tiles'])
+            self.events += 1
+            self.dirty = True
+            headless = list(self.headless)
+        for callback in headless:
+            try:
+                callback(event)
+            except Exception as e:
+                self.log.error(f'Progress subscriber {callback} failed on {kind}: {e}')
+
+    def start_run(self, scans: int):
+
+        """Start of an acquisition of scans"""
+
+        with self.lock:
+            self.reset()
+        self.emit('run_start', running=True, scans=scans, start_time=time())
+
+    def start_scan(self, scan: int, tiles: int, frames_per_tile: int, timer=None):
+
+        """Start of one scan
+        :param scan: index of scan in run
+        :param tiles: tiles in scan as counted by instrument tiles_acquired
+        :param frames_per_tile: frames in each tile
+        :param timer: TileTimer fed finished tiles to give an ETA"""
+
+        if timer is not None:
+            timer.update(0)     # Start timing first tile
+        with self.lock:
+            self.tile_timer = timer
+        self.emit('scan_start', scan=scan, tiles=tiles, frames_per_tile=frames_per_tile, tiles_done=0, layer=0)
+
+    def frame(self, layer: int, tiles_done: int):
+
+        """A frame was acquired. Emitted as a tile event when the tile count moved on
+        :param layer: index of frame in its tile
+        :param tiles_done: tiles finished so far in scan"""
+
+        with self.lock:
+            previous, timer = self.state['tiles_done'], self.tile_timer
+        if tiles_done > previous:
+            if timer is not None:
+                timer.update(tiles_done)
+            self.emit('tile', tiles_done=tiles_done, layer=layer)
+        else:
+            self.emit('frame', layer=layer)
+
+    def end_scan(self):
+
+        with self.lock:
+            tiles = self.state['tiles']
+        self.emit('scan_end', tiles_done=tiles, layer=0)
+
+    def end_run(self):
+
+        with self.lock:
+            self.tile_timer = None
+        self.emit('run_end', running=False, eta_s=0.)
+
+    def flush(self):
+
+        """Emit latest state if anything happened since last tick. Runs on gui thread"""
+
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            state = dict(self.state)
+        self.updates += 1
+        self.updated.emit(state)
+
+    def stats(self):
+
+        return {'events': self.events, 'updates': self.updates}
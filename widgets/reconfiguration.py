@@ -0,0 +1,133 @@
+import logging
+import threading
+from time import sleep, perf_counter
+import qtpy.QtCore as QtCore
+from qtpy.QtCore import QObject, Signal
+
+
+class ReconfigurationScheduler(QObject):
+
+    applied = Signal(float)     # Emitted with time reprogram took in ms
+
+    def __init__(self, instrument, delay_ms: int = 150):
+
+        """Collects config changes made while livestreaming and reprograms the waveform hardware once they settle.
+        Reprogramming runs off the gui thread and changes made while it runs trigger one more reprogram after it.
+        Configuring ni tasks from several threads at once is buggy, so everything that starts, stops or configures
+        ni tasks holds ni_lock, including livestream start and stop on the gui thread.
+            :param instrument: instrument being used
+            :param delay_ms: quiet period after the last change before hardware is reprogrammed
+        """
+
+        super().__init__()
+        self.instrument = instrument
+        self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
+
+        self.timer = QtCore.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay_ms)
+        self.timer.timeout.connect(self.apply)
+        self.applied.connect(self.finished)
+
+        self.ni_lock = threading.RLock()
+        self.thread = None
+        self.closed = False
+        self.busy = False
+        self.dirty = False  # Config changed while hardware was being reprogrammed
+        self.needs_setup = False    # Next run reprograms hardware. Otherwise it only runs ni for a period
+        self.pulses = 0
+        self.requests = 0
+        self.reconfigurations = 0
+        self.failed = 0     # Reprograms that raised. Not counted as saved
+        self.last_ms = None
+
+    def set_delay(self, delay_ms: int):
+
+        self.timer.setInterval(delay_ms)
+
+    def request(self):
+
+        """Note config has changed. Restarts quiet period so a burst of changes reprograms hardware once"""
+
+        if not self.instrument.livestream_enabled.is_set():
+            return
+        self.requests += 1
+        self.needs_setup = True
+        self.timer.start()
+
+    def pulse(self):
+
+        """Run ni for a period in scout mode so a stage move is shown. Pulses asked for while hardware is busy
+        collapse into one run after it"""
+
+        if not self.instrument.livestream_enabled.is_set() or not self.instrument.scout_mode:
+            return
+        self.pulses += 1
+        self.apply()
+
+    def apply(self):
+
+        """Start reprogramming hardware with latest config unless a reprogram is already running"""
+
+        if self.busy:
+            self.dirty = True
+            return
+        if self.closed or not self.instrument.livestream_enabled.is_set():
+            return
+        self.busy = True
+        self.dirty = False
+        setup, self.needs_setup = self.needs_setup, False
+        self.thread = threading.Thread(target=self._reprogram, args=(setup,), name='reconfiguration', daemon=True)
+        self.thread.start()
+
+    def finished(self, elapsed_ms: float):
+
+        self.busy = False
+        self.last_ms = elapsed_ms
+        if self.dirty:
+            self.apply()
+
+    def _reprogram(self, setup: bool):
+
+        """Reprogram hardware if setup and run ni for a period in scout mode
+        :param setup: reprogram waveform hardware with latest config"""
+
+        start = perf_counter()
+        try:
+            with self.ni_lock:
+                # Livestream may have been stopped while waiting on lock
+                if self.instrument.livestream_enabled.is_set():
+                    scout_mode = self.instrument.scout_mode
+                    if setup:
+                        self.instrument._setup_waveform_hardware(self.instrument.active_lasers, live=True,
+                                                                 scout_mode=scout_mode)
+                        self.reconfigurations += 1
+                    if scout_mode:  # Run ni for a period so new waveforms are shown
+                        self.instrument.ni.start()
+                        sleep(self.instrument.cfg.get_period_time())
+                        self.instrument.ni.stop()
+        except Exception as e:
+            if setup:
+                self.failed += 1
+            self.log.error(f'Reprogramming waveform hardware failed: {e}')
+        self.applied.emit((perf_counter() - start) * 1000)
+
+    def close(self):
+
+        """Cancel pending reprogram and wait for running one so instrument can be closed"""
+
+        self.closed = True
+        self.timer.stop()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def stats(self):
+
+        """Number of changes requested, reprograms done, reprograms failed, and reprograms saved by coalescing changes"""
+
+        return {'requests': self.requests,
+                'reconfigurations': self.reconfigurations,
+                'failed': self.failed,
+                'pulses': self.pulses,
+                'saved': max(self.requests - self.reconfigurations - self.failed, 0),
+                'last_ms': None if self.last_ms is None else round(self.last_ms, 1)}
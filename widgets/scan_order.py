@@ -0,0 +1,94 @@
+import numpy as np
+
+AXES = ['x', 'y', 'z']
+
+
+def scan_points(scans: list):
+
+    """Where the stage enters and leaves each scan. Scans start at start_pos_um and end on their last tile, which is
+    taken to be the far x and y corner of the volume at the starting depth
+    :return: (scans, 3) entry and exit positions in um"""
+
+    entry = np.array([[scan['start_pos_um'][k] for k in AXES] for scan in scans], dtype=float).reshape(-1, 3)
+    volume = np.array([[scan['volume_x_um'], scan['volume_y_um'], 0] for scan in scans], dtype=float).reshape(-1, 3)
+    return entry, entry + volume
+
+
+def travel_matrix(scans: list, start_um: dict = None, speed_um_s: dict = None, settle_s: float = .5):
+
+    """Estimated time to move between scans. Axes move together so a move takes as long as its slowest axis
+    :param scans: scans with start_pos_um and volume_x/y/z_um
+    :param start_um: current stage position. Travel from it is the last row of the matrix
+    :param speed_um_s: stage speed along each axis
+    :param settle_s: time for stage to settle after every move
+    :return: (scans + 1, scans) array where [i, j] is time from end of scan i to start of scan j"""
+
+    speed = np.array([(speed_um_s or {}).get(k, 1000.) for k in AXES])
+    entry, exit = scan_points(scans)
+    start = np.array([[start_um[k] for k in AXES]]) if start_um is not None else entry[:1]
+    origins = np.concatenate([exit, start])
+    times = (np.abs(origins[:, None, :] - entry[None, :, :]) / speed).max(axis=-1) + settle_s
+    times[np.arange(len(scans)), np.arange(len(scans))] = 0
+    return times
+
+
+def route_time(order: list, times: np.ndarray):
+
+    """Total travel time visiting scans in order starting from the stage position row of times"""
+
+    previous = np.array([len(times) - 1, *order[:-1]], dtype=int)  # Stays int when route has one scan
+    return float(times[previous, order].sum()) if len(order) else 0.
+
+
+def optimize_order(scans: list, start_um: dict = None, pinned: set = (), speed_um_s: dict = None,
+                   settle_s: float = .5, max_rounds: int = 50):
+
+    """Reorder scans to cut stage travel. A nearest neighbor route is improved with 2-opt segment reversals.
+    Pinned scans keep their place in the queue and only the others are moved around them
+    :param scans: scans with start_pos_um and volume_x/y/z_um in current order
+    :param start_um: current stage position
+    :param pinned: indices of scans that keep their place
+    :param speed_um_s: stage speed along each axis
+    :param settle_s: time for stage to settle after every move
+    :param max_rounds: limit of 2-opt passes over the route
+    :return: new order as indices into scans, travel time of current order and of new order in seconds"""
+
+    times = travel_matrix(scans, start_um, speed_um_s, settle_s)
+    current = list(range(len(scans)))
+    free = [i for i in current if i not in pinned]     # Scans that can move and the places in queue they can go
+
+    def assemble(free_order):
+        order = current.copy()
+        for slot, scan in zip(free, free_order):
+            order[slot] = scan
+        return order
+
+    # Nearest neighbor fills free slots in queue order from wherever the stage is at that point
+    remaining = set(free)
+    greedy = []
+    position = len(times) - 1
+    for slot in current:
+        if slot in pinned:
+            position = slot
+            continue
+        position = min(remaining, key=lambda scan: (times[position, scan], scan))
+        remaining.remove(position)
+        greedy.append(position)
+
+    # 2-opt over free scans. Travel isn't symmetric so every candidate route is timed in full
+    best, best_time = greedy, route_time(assemble(greedy), times)
+    for _ in range(max_rounds):
+        improved = False
+        for i in range(len(best) - 1):
+            for j in range(i + 1, len(best)):
+                candidate = best[:i] + best[i:j + 1][::-1] + best[j + 1:]
+                candidate_time = route_time(assemble(candidate), times)
+                if candidate_time < best_time - 1e-9:
+                    best, best_time, improved = candidate, candidate_time, True
+        if not improved:
+            break
+
+    before = route_time(current, times)
+    if best_time >= before:     # Keep queue as is unless it's actually faster
+        return current, before, before
+    return assemble(best), before, best_time
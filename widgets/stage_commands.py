@@ -0,0 +1,200 @@
+import logging
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import Future, CancelledError
+from queue import PriorityQueue
+from time import perf_counter, sleep
+
+HALT = 0    # Priority classes of stage commands. Lower runs first
+CONFIG = 1  # Settings like joystick mapping. Unlike moves, halts don't drop them
+MOVE = 2
+QUERY = 3
+PRIORITY_NAMES = {HALT: 'halt', CONFIG: 'config', MOVE: 'move', QUERY: 'query'}
+
+
+class StageCommandExecutor:
+
+    def __init__(self, instrument, window: int = 500):
+
+        """Single thread that issues every tigerbox and sample pose command so serial I/O is ordered. Halts jump
+        ahead of configuration writes, then moves, then queries, and identical pending queries are coalesced into one.
+        Halts don't take stage_query_lock, and halts queued while a command waits on the lock run right away, so code
+        in ispim holding the lock can't hold up a halt.
+            :param instrument: instrument with tigerbox, sample_pose and stage_query_lock
+            :param window: number of latencies kept per priority class
+        """
+
+        self.instrument = instrument
+        self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
+
+        self.queue = PriorityQueue()
+        self.order = itertools.count()      # Keeps fifo order within a priority class
+        self.lock = threading.Lock()
+        self.pending = {}   # Key of pending query to its future
+        self.halts = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.latency = {priority: deque(maxlen=window) for priority in PRIORITY_NAMES}
+
+        self.thread = threading.Thread(target=self._run, name='stage_commands', daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args, priority: int = QUERY, key=None, **kwargs):
+
+        """Queue stage command
+        :param function: function talking to stage e.g. instrument.tigerbox.move_absolute
+        :param priority: HALT, CONFIG, MOVE or QUERY
+        :param key: identifies query so a pending identical query is reused instead of queued again
+        :return: future with result of function"""
+
+        with self.lock:
+            if key is not None and priority == QUERY and key in self.pending:
+                self.coalesced += 1
+                return self.pending[key]
+            future = Future()
+            if key is not None and priority == QUERY:
+                self.pending[key] = future
+            self.queue.put((priority, next(self.order), (function, args, kwargs, key, future, perf_counter())))
+        return future
+
+    def query(self, function, *args, timeout: float = None, **kwargs):
+
+        """Queue query and wait for result. Identical pending queries are shared
+        :return: result of function"""
+
+        key = (getattr(function, '__qualname__', repr(function)), args, tuple(sorted(kwargs.items())))
+        return self.submit(function, *args, priority=QUERY, key=key, **kwargs).result(timeout)
+
+    def move(self, function, *args, **kwargs):
+
+        return self.submit(function, *args, priority=MOVE, **kwargs)
+
+    def configure(self, function, *args, **kwargs):
+
+        """Queue write of stage setting, e.g. joystick mapping. Kept when stage is halted"""
+
+        return self.submit(function, *args, priority=CONFIG, **kwargs)
+
+    def halt(self):
+
+        """Halt stage ahead of everything queued. Moves still waiting are dropped so they can't undo the halt
+        :return: future of halt command"""
+
+        with self.lock:
+            self.halts += 1
+            kept = []
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item[0] == MOVE and item[2][4].cancel():
+                    self.cancelled += 1
+                else:
+                    kept.append(item)
+            for item in kept:
+                self.queue.put(item)
+            future = Future()
+            self.queue.put((HALT, next(self.order), (self.instrument.tigerbox.halt, (), {}, None, future,
+                                                     perf_counter())))
+        return future
+
+    def wait_for_move(self, axis: str, position: float, tolerance: float = 10, timeout: float = 120,
+                      period: float = .1):
+
+        """Block until sample pose axis reaches position, stops moving, or stage is halted. Position is polled
+        through the queue so waiting doesn't hold the serial port
+        :param axis: sample pose axis
+        :param position: target in 1/10 um
+        :param tolerance: distance from target counted as arrived in 1/10 um
+        :return: last position of axis"""
+
+        halts = self.halts
+        start = perf_counter()
+        last = None
+        still = 0
+        while perf_counter() - start < timeout and self.halts == halts:
+            try:
+                current = self.query(self.instrument.sample_pose.get_position)[axis]
+            except Exception as e:
+                self.log.debug(f'Position query while waiting for move failed: {e}')
+                sleep(period)
+                continue
+            if abs(current - position) <= tolerance:
+                return current
+            still = still + 1 if current == last else 0
+            if still >= 5:      # Stage stopped short of target e.g. at a limit
+                return current
+            last = current
+            sleep(period)
+        return last
+
+    def depth(self):
+
+        return self.queue.qsize()
+
+    def stats(self):
+
+        """Queue depth and latency from queueing to completion per priority class in ms"""
+
+        stats = {'depth': self.depth(), 'coalesced': self.coalesced, 'cancelled': self.cancelled}
+        for priority, name in PRIORITY_NAMES.items():
+            latency = list(self.latency[priority])
+            stats[name] = {'count': len(latency),
+                           'mean_ms': round(sum(latency) / len(latency), 2) if latency else None,
+                           'max_ms': round(max(latency), 2) if latency else None}
+        return stats
+
+    def stop(self):
+
+        """Finish thread after queued commands"""
+
+        self.queue.put((QUERY + 1, next(self.order), None))
+        self.thread.join(timeout=2)
+
+    def _run(self):
+
+        while True:
+            priority, _, command = self.queue.get()
+            if command is None:
+                return
+            self._execute(priority, command)
+
+    def _execute(self, priority: int, command: tuple):
+
+        function, args, kwargs, key, future, queued = command
+        with self.lock:
+            if key is not None:
+                self.pending.pop(key, None)
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            if priority == HALT:    # Don't wait behind acquisition or overview code holding lock
+                result = function(*args, **kwargs)
+            else:
+                result = self._with_stage_lock(priority, function, args, kwargs)
+        except CancelledError as e:
+            self.cancelled += 1
+            future.set_exception(e)
+        except Exception as e:
+            if priority != QUERY:
+                self.log.error(f'Stage {PRIORITY_NAMES[priority]} command {function} failed: {e}')
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        self.latency[priority].append((perf_counter() - queued) * 1000)
+
+    def _with_stage_lock(self, priority: int, function, args: tuple, kwargs: dict):
+
+        """Call function holding stage_query_lock. Halts queued while waiting for lock run right away, and a move
+        waiting when a halt runs is dropped so it can't undo the halt"""
+
+        while not self.instrument.stage_query_lock.acquire(timeout=.05):
+            with self.lock:
+                halt = self.queue.get_nowait() if self.queue.queue and self.queue.queue[0][0] == HALT else None
+            if halt is not None:
+                self._execute(HALT, halt[2])
+                if priority == MOVE:
+                    raise CancelledError('Move dropped by halt')
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.instrument.stage_query_lock.release()
@@ -0,0 +1,149 @@
+import logging
+import threading
+from time import time
+from qtpy.QtCore import QObject, Signal
+from widgets.stage_commands import StageCommandExecutor
+
+
+class StagePositionService(QObject):
+
+    position_changed = Signal(dict)  # Emitted when stage has moved
+    position_updated = Signal(dict)  # Emitted on every poll
+
+    def __init__(self, instrument, rate_hz: float = 5, commands: StageCommandExecutor = None):
+
+        """Single background poller of the sample stage shared by all widgets. Latest position is cached with a
+        timestamp and published to subscribers through Qt signals, so callbacks run on the gui thread.
+            :param instrument: instrument with sample_pose
+            :param rate_hz: how often the stage is polled while there are subscribers
+            :param commands: queue all stage I/O goes through. One is created if not given
+        """
+
+        super().__init__()
+        self.instrument = instrument
+        self.commands = StageCommandExecutor(instrument) if commands is None else commands
+        self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self.set_rate(rate_hz)
+
+        self.position = None
+        self.timestamp = None
+        self.travel_limits = {}
+        self.subscribers = 0
+        self.paused = 0
+        self.polls = 0
+        self.errors = 0
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def set_rate(self, rate_hz: float):
+
+        """Set poll rate of stage
+        :param rate_hz: polls per second"""
+
+        self.period = 1 / max(rate_hz, .1)
+
+    def subscribe(self, callback, changes_only: bool = True):
+
+        """Call function with latest position dict. Polling starts with the first subscriber
+        :param callback: function called on the gui thread with position in 1/10 um
+        :param changes_only: only call when stage has moved instead of on every poll"""
+
+        signal = self.position_changed if changes_only else self.position_updated
+        signal.connect(callback)
+        with self.lock:
+            self.subscribers += 1
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._poll_loop, name='stage_position', daemon=True)
+            self.thread.start()
+        self.wake.set()
+
+    def unsubscribe(self, callback, changes_only: bool = True):
+
+        signal = self.position_changed if changes_only else self.position_updated
+        try:
+            signal.disconnect(callback)
+        except (TypeError, RuntimeError):  # Wasn't connected
+            return
+        with self.lock:
+            self.subscribers = max(self.subscribers - 1, 0)
+
+    def pause(self):
+
+        """Stop polling, e.g. while a move is being waited on. Every pause needs a resume"""
+
+        with self.lock:
+            self.paused += 1
+
+    def resume(self):
+
+        with self.lock:
+            self.paused = max(self.paused - 1, 0)
+        self.wake.set()
+
+    def stop(self):
+
+        """Stop polling thread"""
+
+        self.stop_event.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+
+    def _poll_loop(self):
+
+        while not self.stop_event.is_set():
+            if self.subscribers > 0 and self.paused == 0 and not getattr(self.instrument, 'setting_up_livestream', False):
+                self.poll()
+                self.wake.wait(self.period)
+            else:
+                self.wake.wait()    # Sleep until something subscribes or resumes
+            self.wake.clear()
+
+    def poll(self, raise_errors: bool = False):
+
+        """Query stage once and publish position
+        :param raise_errors: raise error of query instead of logging it
+        :return: position in 1/10 um or None if query failed"""
+
+        try:
+            position = self.commands.query(self.instrument.sample_pose.get_position)
+        except Exception as e:    # Garbled replies from tigerbox
+            self.errors += 1
+            self.log.debug(f'Stage position query failed: {e}')
+            if raise_errors:
+                raise
+            return None
+
+        self.polls += 1
+        moved = position != self.position
+        self.position = position
+        self.timestamp = time()
+        self.position_updated.emit(dict(position))
+        if moved:
+            self.position_changed.emit(dict(position))
+        return position
+
+    def get_position(self, max_age_s: float = None):
+
+        """Latest position of stage. Stage is only queried if cached position is older than max_age_s
+        :param max_age_s: maximum age of cached position. None accepts any cached position
+        :return: position dict in 1/10 um"""
+
+        if self.position is not None and (max_age_s is None or time() - self.timestamp <= max_age_s):
+            return dict(self.position)
+        position = self.poll(raise_errors=self.position is None)
+        return dict(position if position is not None else self.position)
+
+    def get_travel_limits(self, *axes):
+
+        """Travel limits of stage axes. Limits don't change so they are only queried once
+        :return: dictionary of axis to [lower, upper] in mm"""
+
+        missing = [axis for axis in axes if axis not in self.travel_limits]
+        if missing:
+            self.travel_limits.update(self.commands.query(self.instrument.sample_pose.get_travel_limits, *missing))
+        return {axis: list(self.travel_limits[axis]) for axis in axes}
@@ -0,0 +1,86 @@
+import importlib
+from contextlib import contextmanager
+from time import perf_counter
+
+import_times = {}   # Module name to seconds spent importing it on first use
+
+
+class LazyModule:
+
+    def __init__(self, name: str):
+
+        """Stand in for a module that is only imported the first time one of its attributes is used
+            :param name: module to import e.g. pyqtgraph.opengl
+        """
+
+        self._name = name
+        self._module = None
+
+    def _load(self):
+
+        if self._module is None:
+            start = perf_counter()
+            self._module = importlib.import_module(self._name)
+            import_times[self._name] = perf_counter() - start
+        return self._module
+
+    def __getattr__(self, attribute):
+
+        return getattr(self._load(), attribute)
+
+    def __repr__(self):
+
+        return f'<lazy module {self._name} {"loaded" if self._module is not None else "not loaded"}>'
+
+
+def lazy_import(name: str):
+
+    """Module that imports on first use so heavy dependencies don't slow down startup"""
+
+    return LazyModule(name)
+
+
+class StartupProfile:
+
+    def __init__(self, enabled: bool = False, start: float = None):
+
+        """Times steps of building the gui and prints them with the time lazy modules took to import
+            :param enabled: print profile. Timing is cheap so steps are always recorded
+            :param start: perf_counter time startup began. Defaults to now
+        """
+
+        self.enabled = enabled
+        self.steps = []
+        self.reported = False
+        self.start = perf_counter() if start is None else start
+
+    def record(self, name: str, seconds: float):
+
+        self.steps.append((name, seconds))
+        if self.enabled and self.reported:    # Deferred builds print as they happen
+            print(f'[startup] {name}: {seconds * 1000:.0f} ms')
+
+    @contextmanager
+    def step(self, name: str):
+
+        """Time a step of startup
+        :param name: what is being built"""
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - start)
+
+    def report(self):
+
+        """Print time of every step so far and of modules imported lazily"""
+
+        self.reported = True
+        if not self.enabled:
+            return
+        print(f'[startup] Window ready after {(perf_counter() - self.start) * 1000:.0f} ms')
+        for name, seconds in self.steps:
+            print(f'[startup]   {name}: {seconds * 1000:.0f} ms')
+        for name, seconds in import_times.items():
+            print(f'[startup]   import {name} on first use: {seconds * 1000:.0f} ms')
@@ -1,43 +1,90 @@
 import logging
 from widgets.widget_base import WidgetBase
-from qtpy.QtWidgets import QPushButton, QTabWidget, QWidget, QLineEdit, QComboBox, QMessageBox, QCheckBox
-import pyqtgraph.opengl as gl
+from widgets.frame_pacer import FramePacer
+from widgets.stage_position import StagePositionService
+from widgets.overview_compositing import composite_overviews
+from widgets.overview_io import open_overview, overview_pyramid
+from widgets.overview_tiles import OverviewTilePyramid
+from widgets.overview_projection import StreamingProjector, bin_projections
+from widgets.tissue_planning import plan_scans
+from widgets.progress_events import ProgressEventBus
+from widgets.acquisition_timing import TileTimer
+from widgets.startup_profile import lazy_import
+from widgets.mesh_cache import load_mesh
+from qtpy.QtWidgets import QPushButton, QTabWidget, QWidget, QLineEdit, QComboBox, QMessageBox, QCheckBox, QVBoxLayout
 import numpy as np
 import pyqtgraph as pg
 from napari.qt.threading import thread_worker,create_worker
 from time import sleep
 from pyqtgraph.Qt import QtCore, QtGui
 import qtpy.QtGui
-import stl
 from math import cos, sin, pi, tan, radians
 import os
-import blend_modes
-import tifffile
 import json
-from nidaqmx.constants import TaskMode, FrequencyUnits, Level
-from ispim.compute_waveforms import generate_waveforms
+from widgets.waveform_cache import generate_waveforms
+
+gl = lazy_import('pyqtgraph.opengl')
+tifffile = lazy_import('tifffile')
+
+# Start and end corners of the 12 edges of a unit box
+BOX_EDGES = np.array([[[0, 0, 0], [1, 0, 0]], [[0, 1, 0], [1, 1, 0]], [[0, 0, 1], [1, 0, 1]], [[0, 1, 1], [1, 1, 1]],
+                      [[0, 0, 0], [0, 1, 0]], [[1, 0, 0], [1, 1, 0]], [[0, 0, 1], [0, 1, 1]], [[1, 0, 1], [1, 1, 1]],
+                      [[0, 0, 0], [0, 0, 1]], [[1, 0, 0], [1, 0, 1]], [[0, 1, 0], [0, 1, 1]], [[1, 1, 0], [1, 1, 1]]],
+                     dtype=float).reshape(-1, 3)
 
 class TissueMap(WidgetBase):
 
-    def __init__(self, instrument, viewer):
+    def __init__(self, instrument, viewer, position_service: StagePositionService = None,
+                 overview_budget_mb: float = 1024, progress_events: ProgressEventBus = None,
+                 mesh_faces: int = 20000):
+
+        """
+            :param instrument: instrument bing used
+            :param viewer: napari viewer
+            :param position_service: shared poller of stage position
+            :param overview_budget_mb: memory overview tiles streamed at full resolution can use
+            :param progress_events: bus overview progress is reported to
+            :param mesh_faces: most faces objective and holder meshes are drawn with. None draws every face
+        """
 
         self.instrument = instrument
         self.viewer = viewer
         self.cfg = self.instrument.cfg
         self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
         self.tab_widget = None
-        self.map_pos_worker = None
+        self.position_service = position_service if position_service is not None \
+            else StagePositionService(instrument)
+        self.map_gui_coord = None   # Last drawn position of stage
+        self.map_start_pos = None   # Last drawn start position of scan
         self.pos = None
         self.plot = None
+        self.graph_container = None     # Holds map until it's built the first time tissue map tab is shown
         self.gl_overview = []
+        self.overview_tiles = []    # Tile pyramids streaming overviews at resolution of zoom
+        self.overview_budget_mb = overview_budget_mb
+        self.mesh_faces = mesh_faces
+        self.projector = None   # Builds overview projections while overview scan runs
+        self.overview_preview = {}
+        self.preview_version = None
+        self.preview_timer = QtCore.QTimer()
+        self.preview_timer.setInterval(2000)
+        self.preview_timer.timeout.connect(self.update_overview_preview)
         self.map_pos_alive = False
+        self.progress_events = progress_events
         self.overview_array = {}
+        self.overview_geometry = None   # Stage position and pixel size of overview used to plan scans from it
+        self.frame_pacer = FramePacer(self.update_layer)   # Repaint overview preview at display rate
 
         self.rotate = {}
         self.map = {}
         self.origin = {}
         self.overview = {}
-        self.tiles = []
+        self.tiles = []     # Tile grid and label items drawn in map
+        self.tile_grid = None
+        self.tile_labels = []
+        self.tile_layout = None
+        self.tile_label_px = 40     # Smallest size of tile on screen that tile numbers are drawn at
+        self.max_tile_labels = 2500
         self.scan_areas = []
         self.initial_volume = [self.cfg.volume_x_um, self.cfg.volume_y_um, self.cfg.volume_z_um]
         self.tile_offset = self.remap_axis({'x': (.5 * 0.001 * (self.cfg.tile_specs['x_field_of_view_um'])),
@@ -55,22 +102,30 @@ class TissueMap(WidgetBase):
         """Check if tab clicked is tissue map tab and start stage update when on tissue map tab
         :param index: clicked tab index. Tissue map is last tab"""
 
-        sleep(1)
         last_index = len(self.tab_widget) - 1
+        if index == last_index and self.projector is not None:
+            return  # Overview is running so stage isn't followed
         if index == last_index:  # Start stage update when on tissue map tab
-            self.map_pos_worker = self._map_pos_worker()
-            self.map_pos_alive = True
-            self.map_pos_worker.finished.connect(self.map_pos_worker_finished)
-            self.map_pos_worker.start()
+            self.start_map_updates()
 
         else:  # Quit updating tissue map if not on tissue map tab
-            if self.map_pos_worker is not None:
-                self.map_pos_worker.quit()
+            self.stop_map_updates()
 
-    def map_pos_worker_finished(self):
-        """Sets map_pos_alive to false when worker finishes"""
-        print('map_pos_worker_finished')
-        self.map_pos_alive = False
+    def start_map_updates(self):
+
+        """Subscribe tissue map to stage position updates"""
+
+        if not self.map_pos_alive:
+            self.map_pos_alive = True
+            self.position_service.subscribe(self.update_map_position, changes_only=False)
+
+    def stop_map_updates(self):
+
+        """Unsubscribe tissue map from stage position updates"""
+
+        if self.map_pos_alive:
+            self.map_pos_alive = False
+            self.position_service.unsubscribe(self.update_map_position, changes_only=False)
 
     def overview_widget(self):
 
@@ -81,7 +136,12 @@ class TissueMap(WidgetBase):
         self.overview['view'] = QComboBox()
         self.overview['view'].activated.connect(self.view_overview)
 
-        return self.create_layout(struct='V', **self.overview)
+        self.planning = {'plan': QPushButton('Plan scans from overview'),
+                         'tight_z': QCheckBox('Tight z range')}
+        self.planning['tight_z'].setChecked(True)
+        self.planning['tight_z'].setToolTip('Limit depth of planned scans to where tissue is in the overview')
+
+        return self.create_layout(struct='V', **self.overview, plan=self.create_layout(struct='H', **self.planning))
 
     def start_overview(self):
 
@@ -101,25 +161,45 @@ class TissueMap(WidgetBase):
             return
 
         self.overview['start'].blockSignals(False)
-        self.map_pos_worker.quit()  # Stopping tissue map update
-        for i in range(0, len(self.tab_widget)): self.tab_widget.setTabEnabled(i, False)  # Disable tabs during scan
+        self.stop_map_updates()  # Stopping tissue map update
+        # Disable tabs during scan except tissue map so overview can be watched as it builds
+        for i in range(0, len(self.tab_widget) - 1): self.tab_widget.setTabEnabled(i, False)
+
+        self.set_tiling(2)  # Grid steps and tile counts of overview
+        self.projector = StreamingProjector(self.cfg.imaging_wavelengths, self.xtiles, self.ytiles, self.ztiles,
+                                            self.x_grid_step_um, self.y_grid_step_um, self.cfg.z_step_size_um,
+                                            self.cfg.tile_specs['x_field_of_view_um'],
+                                            self.cfg.tile_specs['y_field_of_view_um'])
+        self.preview_version = None
+        self.map_pose = self.position_service.get_position(max_age_s=1)  # Start of overview
+        self.preview_start = self.remap_axis({k: v * 0.0001 for k, v in self.map_pose.items()})
 
         self.overview_worker = self._overview_worker()
         self.overview_worker.finished.connect(lambda:self.overview_finish())    # Napari threads have finished signals
         self.overview_worker.start()
         sleep(2)
         self.viewer.layers.clear()     # Clear existing layers
-        self.volumetric_image_worker = create_worker(self.instrument._acquisition_livestream_worker)
-        self.volumetric_image_worker.yielded.connect(self.update_layer)
+        self.volumetric_image_worker = self._overview_frame_worker()
+        self.volumetric_image_worker.yielded.connect(self.frame_pacer.push)
         self.volumetric_image_worker.start()
+        self.frame_pacer.start()
+        self.preview_timer.start()
 
-        self.overview['start'].released.emit()  # Start progress bar
+        if self.progress_events is not None:
+            self.progress_events.start_run(1)
+            self.progress_events.start_scan(0, self.xtiles * self.ytiles, self.ztiles, timer=TileTimer())
 
     def overview_finish(self, overview_path = None):
 
         """Function to be executed at the end of the overview"""
 
         for i in range(0, len(self.tab_widget)): self.tab_widget.setTabEnabled(i, True)  # Enabled tabs
+        if self.frame_pacer.is_active():
+            self.frame_pacer.stop()
+        self.clear_overview_preview()
+        if self.progress_events is not None and overview_path is None:
+            self.progress_events.end_scan()
+            self.progress_events.end_run()
 
         self.set_tiling(2)  # Update tiles and gridsteps
 
@@ -128,24 +208,27 @@ class TissueMap(WidgetBase):
                 tag = tif.pages[0].tags['ImageDescription']
                 meta_dict = json.loads(tag.value)
                 orientations = [overview_path[overview_path.find('overview_img_')-3:overview_path.find('overview_img_')-1]]
-                self.overview_array[orientations[0]] = tif.asarray()
-                self.xtiles = meta_dict['tile']['x']
-                self.ytiles = meta_dict['tile']['y']
-                z_volume = meta_dict['volume']['z']
-                gui_coord = self.remap_axis({k: v * 0.0001 for k, v in meta_dict['position'].items()})
-                wavelengths = [x for x in overview_path[:-5].split('_') if x.isdigit() and int(x) in self.cfg.laser_wavelengths]
-                self.instrument.overview_imgs.append(overview_path)
-
-                # only not x if yz and x scale doens't matter in that case
-                x_px_len = self.overview_array[orientations[0]][0].shape[0] if orientations[0][0] == 'x' else 1
-                # in xy and yz, y is always second dimension
-                y_px_len = self.overview_array[orientations[0]][0].shape[1]
-                z_px_len = self.overview_array[orientations[0]][0].shape[1] if orientations[0][0] == 'x' else \
+            # Memory map instead of reading so multi GB overviews are only paged in when viewed
+            self.overview_array[orientations[0]] = open_overview(overview_path)
+            self.xtiles = meta_dict['tile']['x']
+            self.ytiles = meta_dict['tile']['y']
+            z_volume = meta_dict['volume']['z']
+            gui_coord = self.remap_axis({k: v * 0.0001 for k, v in meta_dict['position'].items()})
+            origin_um = {k: v * 0.1 for k, v in meta_dict['position'].items()}
+            wavelengths = [x for x in overview_path[:-5].split('_') if x.isdigit() and int(x) in self.cfg.laser_wavelengths]
+            self.instrument.overview_imgs.append(overview_path)
+
+            # only not x if yz and x scale doens't matter in that case
+            x_px_len = self.overview_array[orientations[0]][0].shape[0] if orientations[0][0] == 'x' else 1
+            # in xy and yz, y is always second dimension
+            y_px_len = self.overview_array[orientations[0]][0].shape[1]
+            z_px_len = self.overview_array[orientations[0]][0].shape[1] if orientations[0][0] == 'x' else \
                 self.overview_array[orientations[0]][0].shape[0]
 
         else:
             z_volume = self.cfg.imaging_specs[f'volume_z_um']
             gui_coord = self.remap_axis({k: v * 0.0001 for k, v in self.map_pose.items()})
+            origin_um = {k: v * 0.1 for k, v in self.map_pose.items()}
             wavelengths = self.cfg.imaging_wavelengths
             orientations = ['xy', 'xz', 'yz']
             x_px_len = self.overview_array['xz'][0].shape[0]
@@ -159,7 +242,70 @@ class TissueMap(WidgetBase):
         scale_x = (((((self.xtiles - 1) * self.x_grid_step_um) + self.cfg.tile_size_x_um)) / x_px_len) / 1000
         scale_z = (((z_volume) / z_px_len)) / 1000
         scale_y = (((((self.ytiles - 1) * self.y_grid_step_um) + self.cfg.tile_size_y_um)) / y_px_len) / 1000
-        overview_specs = {
+        overview_specs = self.overview_specs(scale_x, scale_y, scale_z)
+        # Dropped overviews only know pixel size along the axes of their orientation
+        px_um = {} if self.overview_geometry is None or overview_path is None else dict(self.overview_geometry['px_um'])
+        scale = {'x': scale_x * 1000, 'y': scale_y * 1000, 'z': scale_z * 1000}
+        px_um.update({k: scale[k] for k in set(''.join(orientations))})
+        self.overview_geometry = {'origin_um': origin_um, 'z_volume_um': z_volume, 'px_um': px_um}
+
+        for orientation in orientations:
+            for wl, array in zip(wavelengths, self.overview_array[orientation]):
+                key = f'Overview {wl} {orientation}'
+                # Lower resolutions are strided views so full resolution is only read when zoomed in
+                levels = overview_pyramid(np.rot90(array, overview_specs[orientation]['k']))
+                self.viewer.add_image(levels if len(levels) > 1 else levels[0], name=key,
+                                      multiscale=len(levels) > 1,
+                                      scale=[round(overview_specs[orientation]['scale'][0] * 1000, 3),
+                                             round(overview_specs[orientation]['scale'][1] * 1000, 3)])
+                # scale so it won't be squished in viewer
+
+        # Auto contrast and blend channels into tissue map textures off the gui thread
+        wl_color = 'purple'
+        colors = [qtpy.QtGui.QColor(wl_color).getRgb()[:3]] * len(wavelengths)
+        overviews = {orientation: self.overview_array[orientation] for orientation in orientations}
+        self.composite_worker = create_worker(composite_overviews, overviews, colors)
+        self.composite_worker.returned.connect(lambda textures, specs=overview_specs, coord=gui_coord,
+                                                      arrays=overviews, colors=colors:
+                                               self.add_overview_textures(textures, specs, coord, arrays, colors))
+        self.composite_worker.errored.connect(lambda e: self.log.error(f'Compositing overview failed: {e}'))
+        self.composite_worker.start()
+
+        self.start_map_updates()  # Restart map update
+
+    def plan_scans(self):
+
+        """Plan scans covering only tiles of the loaded overview with tissue in them
+        :return: list of scans with start_pos_um and volume_x/y/z_um. Empty if there is no xy overview"""
+
+        if 'xy' not in self.overview_array or self.overview_geometry is None:
+            self.error_msg('No overview', 'Take or drop in an xy overview before planning scans from it.')
+            return []
+        self.set_tiling(2)  # Grid steps of acquisition
+        geometry = self.overview_geometry
+        fov_um = (self.cfg.tile_specs['x_field_of_view_um'], self.cfg.tile_specs['y_field_of_view_um'])
+        steps = (self.x_grid_step_um, self.y_grid_step_um)
+        shape = self.overview_array['xy'][0].shape
+        # Volume whose tile grid reaches the far edge of the overview
+        volume = [max(shape[i] * geometry['px_um'][k] - fov_um[i], 0) + steps[i] for i, k in enumerate(['x', 'y'])]
+        xtiles, ytiles, _ = self.instrument.get_tile_counts(self.cfg.tile_overlap_x_percent,
+                                                             self.cfg.tile_overlap_y_percent,
+                                                             self.cfg.z_step_size_um, *volume,
+                                                             geometry['z_volume_um'])
+        scans, (kept, total) = plan_scans(self.overview_array, geometry['origin_um'], geometry['px_um'],
+                                          (xtiles, ytiles), steps, fov_um, geometry['z_volume_um'],
+                                          tight_z=self.planning['tight_z'].isChecked())
+        self.log.info(f'Planned {len(scans)} scans imaging {kept} of {total} overview tiles')
+        return scans
+
+    def overview_specs(self, scale_x: float, scale_y: float, scale_z: float):
+
+        """Scale, rotation of GL texture and rotation of napari layer of each overview orientation
+        :param scale_x: size of overview pixel along x in mm
+        :param scale_y: size of overview pixel along y in mm
+        :param scale_z: size of overview pixel along z in mm"""
+
+        return {
             'xy':
                 {'scale': (scale_y, scale_x, 1),
                  'rotation': (90, 0, 1, 0),
@@ -177,52 +323,21 @@ class TissueMap(WidgetBase):
                  }
         }
 
-        colormap_array = {orientation:[None] * len(wavelengths) for orientation in orientations}
-        final_RGBA = {}
-        for orientation in orientations:
-            # Auto contrasting image for tissue map
-            j = 0
-            for wl, array in zip(wavelengths, self.overview_array[orientation]):
-                print(self.map_pos_alive)
-                key = f'Overview {wl} {orientation}'
-                self.viewer.add_image(np.rot90(array, overview_specs[orientation]['k']), name=key,
-                                      scale=[round(overview_specs[orientation]['scale'][0] * 1000, 3),
-                                             round(overview_specs[orientation]['scale'][1] * 1000, 3)])
-                # scale so it won't be squished in viewer
-                wl_color = 'purple'
-                rgb = [x / 255 for x in qtpy.QtGui.QColor(wl_color).getRgb()]
-                max = np.percentile(array, 90)
-                min = np.percentile(array, 5)
-                array.clip(min, max, out=array)
-                array -= min
-                array = np.floor_divide(array, (max - min) / 256, out=array, casting='unsafe')
-
-                if orientation == 'xz':
-                    overview_RGBA = \
-                    pg.makeRGBA(np.flip(np.rot90(array, overview_specs[orientation]['k']), axis=1), levels=[0, 256])[0]
-                elif orientation == 'xy':
-                    overview_RGBA = pg.makeRGBA(np.flip(np.rot90(array, 1), axis=0), levels=[0, 256])[0]
-                else:
-                    overview_RGBA = pg.makeRGBA(np.flip(array, axis=0), levels=[0, 256])[0]
-
-                for i in range(0, len(rgb)):
-                    overview_RGBA[:, :, i] = overview_RGBA[:, :, i] * rgb[i]
-                colormap_array[orientation][j] = overview_RGBA
-                j += 1
-
-            blended = colormap_array[orientation][0]
-            for i in range(1, len(colormap_array[orientation])):
-                alpha = 1 - (i / (i + 1))
-                blended = blend_modes.darken_only(blended.astype('f8'), colormap_array[orientation][i].astype('f8'),
-                                                  alpha)
-            final_RGBA[orientation] = pg.makeRGBA(blended, levels=[0, 256])[0]
-            final_RGBA[orientation][:, :, 3] = 200
-
-
-            image = gl.GLImageItem(final_RGBA[orientation],
-                                   glOptions='translucent')
-            image.scale(overview_specs[orientation]['scale'][0],
-                        overview_specs[orientation]['scale'][1],
+    def add_overview_textures(self, textures: dict, overview_specs: dict, gui_coord: dict, arrays: dict,
+                              colors: list):
+
+        """Place composited overview textures in tissue map. Textures are a coarse view of the whole overview and
+        finer tiles are streamed in over them when zoomed in
+        :param textures: orientation to RGBA texture, stride it was downsampled with and contrast limits
+        :param overview_specs: scale and rotation of each orientation
+        :param gui_coord: gui coordinates of overview start position
+        :param arrays: orientation to full resolution channel arrays
+        :param colors: rgb color of each channel"""
+
+        for orientation, (texture, stride, limits) in textures.items():
+            image = gl.GLImageItem(texture, glOptions='translucent')
+            image.scale(overview_specs[orientation]['scale'][0] * stride,
+                        overview_specs[orientation]['scale'][1] * stride,
                         overview_specs[orientation]['scale'][2], local=False)  # Scale Image
             image.rotate(*overview_specs[orientation]['rotation'])
             image.translate(gui_coord['x'] - self.tile_offset['x'],
@@ -233,22 +348,100 @@ class TissueMap(WidgetBase):
             self.overview['view'].addItem(str(len(self.gl_overview) - 1))
             self.overview['view'].setCurrentIndex(len(self.gl_overview)-1)
 
-        self.map_pos_alive = True
-        self.map_pos_worker = self._map_pos_worker()
-        self.map_pos_worker.finished.connect(self.map_pos_worker_finished)
-        self.map_pos_worker.start()  # Restart map update
+            # Full resolution texture pixel to gui coordinates. Same transforms as image in the order they're applied
+            transform = QtGui.QMatrix4x4()
+            transform.translate(gui_coord['x'] - self.tile_offset['x'],
+                                gui_coord['y'] - self.tile_offset['y'],
+                                gui_coord['z'] - self.tile_offset['z'])
+            transform.rotate(*overview_specs[orientation]['rotation'])
+            transform.scale(*overview_specs[orientation]['scale'])
+            self.overview_tiles.append(OverviewTilePyramid(self.plot, list(arrays[orientation]), colors, limits,
+                                                           orientation, transform, fallback=image,
+                                                           budget_mb=self.overview_budget_mb / len(textures)))
+        self.update_overview_tiles()
 
+    def update_overview_tiles(self):
+
+        """Stream overview tiles matching current zoom"""
+
+        for pyramid in self.overview_tiles:
+            pyramid.update()
+
+    @thread_worker
+    def _overview_frame_worker(self):
+
+        """Pass overview frames on for display and max them into the streaming projections"""
+
+        for frame, wavelength in self.instrument._acquisition_livestream_worker():
+            if self.projector is not None:
+                self.projector.add_frame(frame, wavelength, getattr(self.instrument, 'tiles_acquired', None),
+                                         getattr(self.instrument, 'latest_frame_layer', None))
+            if self.progress_events is not None and self.instrument.total_tiles is not None:
+                self.progress_events.frame(self.instrument.latest_frame_layer or 0,
+                                           self.instrument.tiles_acquired or 0)
+            yield frame, wavelength
+
+    def update_overview_preview(self):
+
+        """Composite projections built so far into tissue map while overview scan runs"""
+
+        if self.projector is None or self.projector.version == self.preview_version:
+            return
+        if getattr(self, 'preview_worker', None) is not None and self.preview_worker.is_running:
+            return  # Still compositing last preview
+        overviews = self.projector.snapshot()
+        if overviews is None:
+            return
+        self.preview_version = self.projector.version
+        colors = [qtpy.QtGui.QColor('purple').getRgb()[:3]] * len(self.projector.wavelengths)
+        self.preview_worker = create_worker(composite_overviews, overviews, colors)
+        self.preview_worker.returned.connect(self.show_overview_preview)
+        self.preview_worker.start()
+
+    def show_overview_preview(self, textures: dict):
+
+        """Replace preview textures in tissue map with latest composite"""
+
+        if self.projector is None:     # Overview finished while compositing
+            return
+        scale = self.projector.scale_mm()
+        specs = self.overview_specs(scale['x'], scale['y'], scale['z'])
+        for orientation, (texture, stride, _) in textures.items():
+            if orientation not in self.overview_preview:
+                self.overview_preview[orientation] = gl.GLImageItem(texture, glOptions='translucent')
+                self.plot.addItem(self.overview_preview[orientation])
+            image = self.overview_preview[orientation]
+            image.setData(texture)
+            image.resetTransform()
+            image.scale(specs[orientation]['scale'][0] * stride,
+                        specs[orientation]['scale'][1] * stride,
+                        specs[orientation]['scale'][2], local=False)
+            image.rotate(*specs[orientation]['rotation'])
+            image.translate(self.preview_start['x'] - self.tile_offset['x'],
+                            self.preview_start['y'] - self.tile_offset['y'],
+                            self.preview_start['z'] - self.tile_offset['z'])
+
+    def clear_overview_preview(self):
+
+        """Remove preview of overview once final overview is drawn"""
+
+        self.preview_timer.stop()
+        for image in self.overview_preview.values():
+            if image in self.plot.items:
+                self.plot.removeItem(image)
+        self.overview_preview = {}
+        self.projector = None
 
     @thread_worker
     def _overview_worker(self):
 
-        while self.map_pos_alive == True:   # Stalling til map pos worker quits
-            sleep(.5)
         self.x_grid_step_um, self.y_grid_step_um = self.instrument.get_xy_grid_step(self.cfg.tile_overlap_x_percent,
                                                                                     self.cfg.tile_overlap_y_percent)
 
 
-        self.overview_array = self.instrument.overview_scan()
+        # Only binned projections are kept so overview memory stays bounded after the scan. ispim builds the full
+        # resolution projections while scanning and those are released here
+        self.overview_array = bin_projections(self.instrument.overview_scan())
 
         self.volumetric_image_worker.quit()
 
@@ -374,10 +567,7 @@ class TissueMap(WidgetBase):
 
         # State is 0 if checkmark is unpressed
         if state == 0:
-            for item in self.tiles:
-                if item in self.plot.items:
-                    self.plot.removeItem(item)
-            self.tiles = []
+            self.clear_tiles()
 
     def set_point(self):
 
@@ -397,119 +587,159 @@ class TissueMap(WidgetBase):
 
         self.map['label'].clear()  # Clear text box
 
-    @thread_worker
-    def _map_pos_worker(self):
+    def update_map_position(self, position: dict):
 
-        """Update position of stage for tissue map, draw scanning volume, and tiling"""
-        gui_coord = None
-        while True:
-            if self.instrument.setting_up_livestream:
-                yield
-                continue
+        """Update position of stage for tissue map, draw scanning volume, and tiling. Called by position service on
+        every poll while tissue map tab is shown
+        :param position: sample pose position in 1/10 um"""
 
-            try:
-                gui_coord = self.instrument.sample_pose.get_position()
-                if self.map_pose != self.instrument.sample_pose.get_position() and self.instrument.scout_mode:
-                    # if stage has moved and scout mode is on
-                    self.start_stop_ni()
-                with self.instrument.stage_query_lock:
-                    self.map_pose = self.instrument.sample_pose.get_position()
-                # Convert 1/10um to mm
-                coord = {k: v * 0.0001 for k, v in self.map_pose.items()}  # if not self.instrument.simulated \
-                #     else np.random.randint(-60000, 60000, 3)
-
-                gui_coord = self.remap_axis(coord)  # Remap sample_pos to gui coords
-                self.pos.setTransform(qtpy.QtGui.QMatrix4x4(cos(pi/4), 0, -sin(pi/4), gui_coord['x'] - self.tile_offset['x'],
-                                                              0, 1, 0, gui_coord['y'] - self.tile_offset['y'],
-                                                              sin(pi/4), 0, cos(pi/4), gui_coord['z']- self.tile_offset['z'],
-                                                              0, 0, 0, 1))
-
-                self.objectives.setTransform(qtpy.QtGui.QMatrix4x4(0, 0, 1, gui_coord['x'],
-                                                              1, 0, 0, gui_coord['y'],
-                                                              0, 1, 0, self.up['z'],
-                                                              0, 0, 0, 1))
-                self.stage.setTransform(qtpy.QtGui.QMatrix4x4(0, 0, 1, self.origin['x'],
-                                                              1, 0, 0, self.origin['y'],
-                                                              0, 1, 0, gui_coord['z'],
-                                                              0, 0, 0, 1))
-                yield
-
-                if self.instrument.start_pos == None:
-
-                    # Translate volume of scan to gui coordinate plane
-                    scanning_volume = self.remap_axis({k: self.cfg.imaging_specs[f'volume_{k}_um'] * .001
-                                                       for k in self.map_pose.keys()})
-
-                    self.scan_vol.setSize(**scanning_volume)
-                    self.scan_vol.setTransform(qtpy.QtGui.QMatrix4x4(1, 0, 0, gui_coord['x'] - self.tile_offset['x'],
-                                                                     0, 1, 0, gui_coord['y'] - self.tile_offset['y'],
-                                                                     0, 0, 1, gui_coord['z'] - self.tile_offset['z'],
-                                                                     0, 0, 0, 1))
-                    if self.checkbox['tiling'].isChecked():
-                        if old_coord != gui_coord or self.tiles == [] or \
-                                self.initial_volume != [self.cfg.volume_x_um, self.cfg.volume_y_um, self.cfg.volume_z_um]:
-                            self.draw_tiles(gui_coord)  # Draw tiles if checkbox is checked if something has changed
-                    yield
-                else:
-
-                    # Remap start position and shift position of scan vol to center of camera fov and convert um to mm
-                    start_pos = {k: v * 0.001 for k, v in self.instrument.start_pos.items()}  # start of scan coords
-                    start_pos = self.remap_axis(
-                        {'x': start_pos['x'] - self.tile_offset['x'],
-                         'y': start_pos['y'] - self.tile_offset['y'],
-                         'z': start_pos['z'] - self.tile_offset['z']})
+        self.map_pose = position
+        if self.plot is None:
+            return
+        # Convert 1/10um to mm
+        coord = {k: v * 0.0001 for k, v in self.map_pose.items()}  # if not self.instrument.simulated \
+        #     else np.random.randint(-60000, 60000, 3)
 
-                    if self.checkbox['tiling'].isChecked():
-                        self.draw_tiles(start_pos)
-                    self.draw_volume(start_pos, self.remap_axis({k: self.cfg.imaging_specs[f'volume_{k}_um'] * .001
-                                                                 for k in self.map_pose.keys()}))
-                    yield
-            except:
-                pass
-                yield
-            finally:
-                old_coord = gui_coord
-                yield  # Yield so thread can stop
+        gui_coord = self.remap_axis(coord)  # Remap sample_pos to gui coords
+        self.pos.setTransform(qtpy.QtGui.QMatrix4x4(cos(pi/4), 0, -sin(pi/4), gui_coord['x'] - self.tile_offset['x'],
+                                                      0, 1, 0, gui_coord['y'] - self.tile_offset['y'],
+                                                      sin(pi/4), 0, cos(pi/4), gui_coord['z']- self.tile_offset['z'],
+                                                      0, 0, 0, 1))
+
+        self.objectives.setTransform(qtpy.QtGui.QMatrix4x4(0, 0, 1, gui_coord['x'],
+                                                      1, 0, 0, gui_coord['y'],
+                                                      0, 1, 0, self.up['z'],
+                                                      0, 0, 0, 1))
+        self.stage.setTransform(qtpy.QtGui.QMatrix4x4(0, 0, 1, self.origin['x'],
+                                                      1, 0, 0, self.origin['y'],
+                                                      0, 1, 0, gui_coord['z'],
+                                                      0, 0, 0, 1))
+
+        volume_changed = self.initial_volume != [self.cfg.volume_x_um, self.cfg.volume_y_um, self.cfg.volume_z_um]
+        if self.instrument.start_pos == None:
+
+            # Translate volume of scan to gui coordinate plane
+            scanning_volume = self.remap_axis({k: self.cfg.imaging_specs[f'volume_{k}_um'] * .001
+                                               for k in self.map_pose.keys()})
+
+            self.scan_vol.setSize(**scanning_volume)
+            self.scan_vol.setTransform(qtpy.QtGui.QMatrix4x4(1, 0, 0, gui_coord['x'] - self.tile_offset['x'],
+                                                             0, 1, 0, gui_coord['y'] - self.tile_offset['y'],
+                                                             0, 0, 1, gui_coord['z'] - self.tile_offset['z'],
+                                                             0, 0, 0, 1))
+            if self.checkbox['tiling'].isChecked():
+                if self.map_gui_coord != gui_coord or self.tiles == [] or volume_changed:
+                    self.draw_tiles(gui_coord)  # Draw tiles if checkbox is checked if something has changed
+        else:
+
+            # Remap start position and shift position of scan vol to center of camera fov and convert um to mm
+            start_pos = {k: v * 0.001 for k, v in self.instrument.start_pos.items()}  # start of scan coords
+            start_pos = self.remap_axis(
+                {'x': start_pos['x'] - self.tile_offset['x'],
+                 'y': start_pos['y'] - self.tile_offset['y'],
+                 'z': start_pos['z'] - self.tile_offset['z']})
+
+            if self.checkbox['tiling'].isChecked():
+                if self.map_start_pos != start_pos or self.tiles == [] or volume_changed:
+                    self.draw_tiles(start_pos)
+            self.map_start_pos = start_pos
+        self.map_gui_coord = gui_coord
+        self.update_tile_labels()   # Zoom may have changed
+        self.update_overview_tiles()
 
     def draw_tiles(self, coord):
 
-        """Draw tiles of proposed scan volume.
-        :param coord: coordinates of bottom corner of volume in sample pose"""
+        """Draw tiles of proposed scan volume. Grid is only rebuilt when tiling changes, otherwise it is translated
+        :param coord: coordinates of bottom corner of volume in gui coords"""
 
         # Check if volume in config has changed
         if self.initial_volume != [self.cfg.volume_x_um, self.cfg.volume_y_um, self.cfg.volume_z_um]:
             self.set_tiling(2)  # Update grid steps and tile numbers
             self.initial_volume = [self.cfg.volume_x_um, self.cfg.volume_y_um, self.cfg.volume_z_um]
 
+        layout = [self.xtiles, self.ytiles, self.ztiles, self.x_grid_step_um, self.y_grid_step_um,
+                  self.cfg.z_step_size_um, self.cfg.tile_specs['x_field_of_view_um'],
+                  self.cfg.tile_specs['y_field_of_view_um']]
+        if self.tiles == [] or layout != self.tile_layout:
+            self.build_tile_grid()
+            self.tile_layout = layout
+
+        for item in self.tiles:
+            item.resetTransform()
+            item.translate(coord['x'], coord['y'], coord['z'])
+        self.update_tile_labels()
+
+    def build_tile_grid(self):
+
+        """Create tile grid as one item of line segments with tile corner at origin. Every tile is a box of 12
+        edges so the whole grid is built from a single vertex array"""
+
+        self.clear_tiles()
+        x_fov_mm = .001 * self.cfg.tile_specs['x_field_of_view_um']
+        y_fov_mm = .001 * self.cfg.tile_specs['y_field_of_view_um']
+
+        # Tiles numbered along x first in sample pose coords
+        y, x = np.divmod(np.arange(self.xtiles * self.ytiles), self.xtiles)
+        offset = self.remap_axis({'x': (x * self.x_grid_step_um * .001) - (.5 * x_fov_mm),
+                                  'y': (y * self.y_grid_step_um * .001) - (.5 * y_fov_mm),
+                                  'z': np.zeros(x.size)})
+        offset = np.stack([offset['x'], offset['y'], offset['z']], axis=-1)
+        size = self.remap_axis({'x': x_fov_mm,
+                                'y': y_fov_mm,
+                                'z': self.ztiles * self.cfg.z_step_size_um * .001})
+        size = np.array([size['x'], size['y'], size['z']])
+
+        vertices = (offset[:, None, :] + BOX_EDGES[None, :, :] * size).reshape(-1, 3)
+        self.tile_grid = gl.GLLinePlotItem(pos=vertices, mode='lines', width=1,
+                                           color=qtpy.QtGui.QColor('cornflowerblue').getRgbF())
+        self.plot.removeItem(self.objectives)
+        self.plot.addItem(self.tile_grid)
+        self.plot.addItem(self.objectives)  # remove and add objectives to see tiles through objective
+        self.tiles.append(self.tile_grid)
+
+        # Labels are only created once zoomed in enough to read them
+        self.tile_label_pos = offset + np.array([0, .5 * y_fov_mm, -.5 * x_fov_mm])   # Offset in gui coords
+        self.tile_label_text = (self.xtiles * y + x).astype(str)
+
+    def update_tile_labels(self):
+
+        """Show tile numbers only when tiles are big enough on screen to read them"""
+
+        if self.tile_grid is None:
+            return
+        visible = self.tile_labels_visible()
+        if visible and self.tile_labels == []:
+            font = qtpy.QtGui.QFont('Helvetica', 15)
+            for pos, text in zip(self.tile_label_pos, self.tile_label_text):
+                label = gl.GLTextItem(pos=pos, text=text, font=font)
+                label.setTransform(self.tile_grid.transform())
+                self.plot.addItem(label)
+                self.tile_labels.append(label)
+            self.tiles.extend(self.tile_labels)
+        for label in self.tile_labels:
+            label.setVisible(visible)
+
+    def tile_labels_visible(self):
+
+        """If tiles take up more than tile_label_px on screen at current zoom"""
+
+        if len(self.tile_label_text) > self.max_tile_labels:
+            return False
+        # Pixels per mm at the camera center for a perspective camera
+        px_per_mm = self.plot.height() / (2 * self.plot.opts['distance'] * tan(radians(self.plot.opts['fov'] / 2)))
+        tile_mm = .001 * min(self.cfg.tile_specs['x_field_of_view_um'], self.cfg.tile_specs['y_field_of_view_um'])
+        return tile_mm * px_per_mm >= self.tile_label_px
+
+    def clear_tiles(self):
+
+        """Remove tile grid and labels from map"""
+
         for item in self.tiles:
             if item in self.plot.items:
                 self.plot.removeItem(item)
-        self.tiles.clear()
-        for x in range(0, self.xtiles):
-            for y in range(0, self.ytiles):
-                tile_offset = self.remap_axis(
-                    {'x': (x * self.x_grid_step_um * .001) - (.5 * 0.001 * (self.cfg.tile_specs['x_field_of_view_um'])),
-                     'y': (y * self.y_grid_step_um * .001) - (.5 * 0.001 * (self.cfg.tile_specs['y_field_of_view_um'])),
-                     'z': 0})
-                tile_pos = {
-                    'x': tile_offset['x'] + coord['x'],
-                    'y': tile_offset['y'] + coord['y'],
-                    'z': tile_offset['z'] + coord['z']
-                }
-                num_pos = [tile_pos['x'],
-                           tile_pos['y'] + (.5 * 0.001 * (self.cfg.tile_specs['y_field_of_view_um'])),
-                           tile_pos['z'] - (.5 * 0.001 * (self.cfg.tile_specs['x_field_of_view_um']))]
-
-                tile_volume = self.remap_axis({'x': self.cfg.tile_specs['x_field_of_view_um'] * .001,
-                                               'y': self.cfg.tile_specs['y_field_of_view_um'] * .001,
-                                               'z': self.ztiles * self.cfg.z_step_size_um * .001})
-                self.tiles.append(self.draw_volume(tile_pos, tile_volume))
-                self.tiles[-1].setColor(qtpy.QtGui.QColor('cornflowerblue'))
-                self.plot.removeItem(self.objectives)
-                self.plot.addItem(self.tiles[-1])
-                self.plot.addItem(self.objectives)  # remove and add objectives to see tiles through objective
-                self.tiles.append(gl.GLTextItem(pos=num_pos, text=str((self.xtiles*y)+x), font=qtpy.QtGui.QFont('Helvetica', 15)))
-                self.plot.addItem(self.tiles[-1])       # Can't draw text while moving graph
+        self.tiles = []
+        self.tile_grid = None
+        self.tile_labels = []
 
     def draw_volume(self, coord: dict, size: dict):
 
@@ -523,6 +753,8 @@ class TissueMap(WidgetBase):
     def draw_configured_scans(self, scans: dict):
         """Draw configured scans in tissue map"""
 
+        if self.plot is None:
+            return  # Map isn't built yet. Scans are drawn when it is
         for scan in self.scan_areas:
             if scan in self.plot.items:
                 self.plot.removeItem(scan)
@@ -602,18 +834,39 @@ class TissueMap(WidgetBase):
 
         return remap_coords
 
+    def deferred_graph(self):
+
+        """Empty widget the map is put in by build_graph, so the GL scene and meshes are only made once the tissue map
+        is looked at"""
+
+        self.graph_container = QWidget()
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.graph_container.setLayout(layout)
+        return self.graph_container
+
+    def build_graph(self):
+
+        """Build map into container from deferred_graph if it hasn't been built
+        :return: True if map was built by this call"""
+
+        if self.plot is not None or self.graph_container is None:
+            return False
+        self.graph_container.layout().addWidget(self.graph())
+        return True
+
     def graph(self):
 
         self.plot = gl.GLViewWidget()
         self.plot.opts['distance'] = 40
-        self.map_pose = self.instrument.sample_pose.get_position()
+        self.map_pose = self.position_service.get_position()
         coord = {k: v * 0.0001 for k, v in self.map_pose.items()}
         gui_coord = self.remap_axis(coord)
         self.plot.opts['center'] = QtGui.QVector3D(gui_coord['x'], gui_coord['y'], gui_coord['z'])  #Centering map on stage position
 
 
         limits = self.remap_axis({'x': [0, 45], 'y': [0, 60], 'z': [0, 55]}) if self.instrument.simulated else \
-            self.remap_axis(self.instrument.sample_pose.get_travel_limits(*['x', 'y', 'z']))
+            self.remap_axis(self.position_service.get_travel_limits(*['x', 'y', 'z']))
 
         low = {}
         up = {}
@@ -647,26 +900,23 @@ class TissueMap(WidgetBase):
         self.plot.addItem(self.pos)
 
         try:
-            objectives = stl.mesh.Mesh.from_file(rf'C:\Users\{os.getlogin()}\Documents\dispim_files\di-spim-tissue-map.stl')
-            points = objectives.points.reshape(-1, 3)
-            faces = np.arange(points.shape[0]).reshape(-1, 3)
-
+            # Indexed and decimated meshes are cached so stls are only parsed when they change
+            points, faces = load_mesh(rf'C:\Users\{os.getlogin()}\Documents\dispim_files\di-spim-tissue-map.stl',
+                                      self.mesh_faces)
             objectives = gl.MeshData(vertexes=points, faces=faces)
             self.objectives = gl.GLMeshItem(meshdata=objectives, smooth=True, drawFaces=True, drawEdges=False, color=(0.5, 0.5, 0.5, 0.5),
                               shader='edgeHilight', glOptions='translucent')
 
 
-            stage = stl.mesh.Mesh.from_file(rf'C:\Users\{os.getlogin()}\Documents\dispim_files\di-spim-holder.stl')
-            points = stage.points.reshape(-1, 3)
-            faces = np.arange(points.shape[0]).reshape(-1, 3)
-
+            points, faces = load_mesh(rf'C:\Users\{os.getlogin()}\Documents\dispim_files\di-spim-holder.stl',
+                                      self.mesh_faces)
             stage = gl.MeshData(vertexes=points, faces=faces)
             self.stage = gl.GLMeshItem(meshdata=stage, smooth=True, drawFaces=True, drawEdges=False, color=(0.5, 0.5, 0.5, 0.5),
                                        shader='edgeHilight',glOptions='translucent')
             self.plot.addItem(self.objectives)
             self.plot.addItem(self.stage)
 
-        except FileNotFoundError:
+        except OSError:
             # Create self.objectives and self.stage objects but don't add them to graph
             self.objectives = gl.GLBoxItem()
             self.stage = gl.GLBoxItem()
@@ -694,17 +944,14 @@ class TissueMap(WidgetBase):
         else:
             try:
 
-                self.map_pos_worker.finished.connect(lambda path = file_path: self.overview_finish(path))
-                self.map_pos_worker.quit()
+                self.stop_map_updates()
+                self.overview_finish(file_path)
             except OSError:
-                pass
+                self.start_map_updates()
             except:
                 self.error_msg('Unusable Image', "Image dragged does not have the correct metadata. Tiff needs to have "
                                                  "position, volume, and tile data for x, y, z")
-                self.map_pos_worker = self._map_pos_worker()
-                self.map_pos_alive = True
-                self.map_pos_worker.finished.connect(self.map_pos_worker_finished)
-                self.map_pos_worker.start()  # Restart map update
+                self.start_map_updates()  # Restart map update
 
 
         event.accept()
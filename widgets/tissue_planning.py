@@ -0,0 +1,152 @@
+from math import ceil
+import numpy as np
+from widgets.overview_compositing import sampled_percentiles
+from widgets.overview_io import downsampled
+from widgets.startup_profile import lazy_import
+
+ndimage = lazy_import('scipy.ndimage')
+
+
+def otsu_threshold(array: np.ndarray, bins: int = 256, max_samples: int = 1000000):
+
+    """Threshold maximizing between class variance of a strided subsample of array"""
+
+    stride = max(int(np.sqrt(array.size / max_samples)), 1)
+    hist, edges = np.histogram(array[::stride, ::stride], bins)
+    hist = hist.astype(np.float64)
+    centers = (edges[:-1] + edges[1:]) / 2
+    below = np.cumsum(hist)
+    above = below[-1] - below
+    moment = np.cumsum(hist * centers)
+    mean_below = moment / np.maximum(below, 1)
+    mean_above = (moment[-1] - moment) / np.maximum(above, 1)
+    between = below * above * (mean_below - mean_above) ** 2
+    return edges[np.argmax(between) + 1]
+
+
+def foreground_mask(arrays: list, max_px: int = 1024, smooth_px: int = 2):
+
+    """Segment tissue in one overview orientation. Channels are normalized, maxed together, thresholded with Otsu
+    and cleaned up with an opening, a closing and hole filling
+    :param arrays: 2d array of each channel. Can be memory mapped or lazy
+    :param max_px: largest side of mask. Channels are read with a stride to fit
+    :param smooth_px: iterations of opening and closing
+    :return: boolean mask and stride it was read with"""
+
+    combined = None
+    stride = 1
+    for array in arrays:
+        array, stride = downsampled(array, max_px)
+        low, high = sampled_percentiles(array, (1, 99.5))
+        normalized = np.clip((array.astype(np.float32) - low) / max(high - low, np.finfo(np.float32).tiny), 0, 1)
+        combined = normalized if combined is None else np.maximum(combined, normalized, out=combined)
+    mask = combined > otsu_threshold(combined)
+    if smooth_px:
+        mask = ndimage.binary_opening(mask, iterations=smooth_px)
+        mask = ndimage.binary_closing(mask, iterations=smooth_px, border_value=0)
+    return ndimage.binary_fill_holes(mask), stride
+
+
+def tile_coverage(mask: np.ndarray, px_um: tuple, tiles: tuple, step_um: tuple, fov_um: tuple):
+
+    """Fraction of each tile's field of view that is foreground, from a summed area table of the mask
+    :param mask: boolean (x, y) mask starting at the edge of tile (0, 0)
+    :param px_um: size of mask pixel along x and y
+    :param tiles: number of tiles along x and y
+    :param step_um: grid step between tiles along x and y
+    :param fov_um: field of view of a tile along x and y
+    :return: (x tiles, y tiles) array of fractions"""
+
+    table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(mask, axis=0), axis=1, out=table[1:, 1:])
+    bounds = []
+    for axis in range(2):
+        start = np.arange(tiles[axis]) * step_um[axis] / px_um[axis]
+        end = start + fov_um[axis] / px_um[axis]
+        bounds.append((np.clip(np.round(start), 0, mask.shape[axis]).astype(int),
+                       np.clip(np.round(end), 0, mask.shape[axis]).astype(int)))
+    (x0, x1), (y0, y1) = bounds
+    x0, y0 = np.meshgrid(x0, y0, indexing='ij')
+    x1, y1 = np.meshgrid(x1, y1, indexing='ij')
+    area = (x1 - x0) * (y1 - y0)
+    counts = table[x1, y1] - table[x0, y1] - table[x1, y0] + table[x0, y0]
+    return np.divide(counts, area, out=np.zeros(area.shape), where=area > 0)
+
+
+def tile_rectangles(occupied: np.ndarray):
+
+    """Cover occupied tiles with rectangles. Runs of occupied tiles along x are found for each y row and rows with
+    identical runs are merged so each rectangle is one scan
+    :param occupied: boolean (x tiles, y tiles)
+    :return: list of (x start, x end, y start, y end) with exclusive ends"""
+
+    rectangles = []
+    open_runs = {}     # (x start, x end) to y start of runs continuing from previous row
+    for y in range(occupied.shape[1] + 1):
+        runs = set()
+        if y < occupied.shape[1]:
+            edges = np.diff(np.concatenate([[0], occupied[:, y].astype(np.int8), [0]]))
+            runs = set(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+        for run in list(open_runs):
+            if run not in runs:
+                rectangles.append((int(run[0]), int(run[1]), open_runs.pop(run), y))
+        for run in runs - open_runs.keys():
+            open_runs[run] = y
+    return sorted(rectangles, key=lambda r: (r[2], r[0]))
+
+
+def plan_scans(overview: dict, origin_um: dict, px_um: dict, tiles: tuple, step_um: tuple, fov_um: tuple,
+               z_volume_um: float, min_fraction: float = .02, margin_um: float = 50, tight_z: bool = True):
+
+    """Plan scans covering only the tiles of an overview that have tissue in them
+    :param overview: orientation to list of 2d channel arrays laid out like TissueMap.overview_array
+    :param origin_um: stage position of tile (0, 0) of overview
+    :param px_um: size of full resolution overview pixel along x, y and z
+    :param tiles: number of tiles along x and y covering the overview
+    :param step_um: grid step between tiles along x and y
+    :param fov_um: field of view of a tile along x and y
+    :param z_volume_um: depth of overview
+    :param min_fraction: fraction of a tile that has to be tissue for it to be imaged
+    :param margin_um: tissue mask is grown by this much in every direction before tiles are picked
+    :param tight_z: limit each scan to the depth tissue is found at in the xz and yz projections
+    :return: list of scans with start_pos_um and volume_x/y/z_um, and (tiles kept, tiles total)"""
+
+    mask, stride = foreground_mask(overview['xy'])
+    mask_px = (px_um['x'] * stride, px_um['y'] * stride)
+    grow = ceil(margin_um / min(mask_px))
+    if grow and mask.any():
+        mask = ndimage.binary_dilation(mask, iterations=grow)
+    occupied = tile_coverage(mask, mask_px, tiles, step_um, fov_um) >= min_fraction
+
+    depth = {}      # Orientation to (mask, stride) used to find depth of tissue
+    if tight_z:
+        depth = {orientation: foreground_mask(overview[orientation]) for orientation in ['xz', 'yz']
+                 if orientation in overview}
+
+    scans = []
+    for x0, x1, y0, y1 in tile_rectangles(occupied):
+        z0, z1 = 0., z_volume_um
+        ranges = []
+        for orientation, (z_mask, z_stride) in depth.items():
+            lateral = 'x' if orientation == 'xz' else 'y'
+            start, end = (x0, x1) if lateral == 'x' else (y0, y1)
+            axis = 0 if lateral == 'x' else 1
+            px = px_um[lateral] * z_stride
+            span = slice(int(start * step_um[axis] / px), ceil(((end - 1) * step_um[axis] + fov_um[axis]) / px))
+            found = z_mask[span, :].any(axis=0) if lateral == 'x' else z_mask[:, span].any(axis=1)
+            if found.any():
+                z = np.flatnonzero(found)
+                ranges.append((z[0] * px_um['z'] * z_stride, (z[-1] + 1) * px_um['z'] * z_stride))
+        if ranges:
+            # Each projection bounds depth over the whole other axis so their overlap still contains the tissue
+            low, high = max(r[0] for r in ranges), min(r[1] for r in ranges)
+            if low >= high:
+                low, high = min(r[0] for r in ranges), max(r[1] for r in ranges)
+            z0, z1 = max(low - margin_um, 0.), min(high + margin_um, z_volume_um)
+        scans.append({'start_pos_um': {'x': round(float(origin_um['x'] + x0 * step_um[0]), 1),
+                                       'y': round(float(origin_um['y'] + y0 * step_um[1]), 1),
+                                       'z': round(float(origin_um['z'] + z0), 1)},
+                      'volume_x_um': round(float((x1 - x0) * step_um[0]), 1),
+                      'volume_y_um': round(float((y1 - y0) * step_um[1]), 1),
+                      'volume_z_um': round(float(z1 - z0), 1)})
+    return scans, (int(occupied.sum()), int(occupied.size))
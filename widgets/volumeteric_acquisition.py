@@ -1,27 +1,38 @@
 from widgets.widget_base import WidgetBase
+from widgets.frame_pacer import FramePacer
+from widgets.stage_position import StagePositionService
 from qtpy.QtWidgets import QPushButton, QCheckBox, QLabel, QComboBox, QSpinBox, QDockWidget, \
     QSlider, QLineEdit,QMessageBox, QTabWidget, QProgressBar, QToolButton, QMenu, QAction, QDialog, QWidget, QTextEdit, \
     QVBoxLayout,QDialogButtonBox, QTableWidget, QTableWidgetItem, QWidgetAction, QToolBar
 import numpy as np
 from pyqtgraph import PlotWidget, mkPen
-from ispim.compute_waveforms import generate_waveforms
+from widgets.waveform_cache import generate_waveforms
+from widgets.scan_order import optimize_order, travel_matrix, route_time
+from widgets.acquisition_journal import AcquisitionJournal, TileJournaler, remaining_scans, tile_sequence
+from widgets.acquisition_timing import TimingHistory, TileTimer, scan_features
+from widgets.progress_events import ProgressEventBus
 import logging
 from napari.qt.threading import thread_worker, create_worker
 from time import sleep, time
 from datetime import timedelta, datetime
 import calendar
-import qtpy.QtCore as QtCore
 import json
 
 class VolumetericAcquisition(WidgetBase):
 
-    def __init__(self,viewer, cfg, instrument, simulated):
+    def __init__(self,viewer, cfg, instrument, simulated, position_service: StagePositionService = None,
+                 journal: AcquisitionJournal = None, timing: TimingHistory = None,
+                 progress_events: ProgressEventBus = None):
 
         """
             :param viewer: napari viewer
             :param cfg: config object from instrument
             :param instrument: instrument bing used
             :param simulated: if instrument is in simulate mode
+            :param position_service: shared stage position poller. One is created if not given
+            :param journal: on disk record of acquisition queue used to resume interrupted runs
+            :param timing: history of tile timings used to estimate how long scans take
+            :param progress_events: bus acquisition progress is reported to. One is created if not given
         """
 
         self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
@@ -38,6 +49,16 @@ class VolumetericAcquisition(WidgetBase):
         self.delete_scan_bt = {}
         self.cells_changed = []
         self.scans = []     # Scans performed in the UI instance
+        self.frame_pacer = FramePacer(self.update_layer)   # Repaint acquisition preview at display rate
+        self.position_service = StagePositionService(instrument) if position_service is None else position_service
+        self.journal = AcquisitionJournal() if journal is None else journal
+        self.scan_ids = []  # Journal id of each scan in running queue
+        self.timing = TimingHistory() if timing is None else timing
+        self.tile_timer = None  # Times tiles of running scan for ETA
+        self.queue_s = []   # Predicted seconds of each scan in running queue
+        self.progress_events = ProgressEventBus() if progress_events is None else progress_events
+        self.progress_events.subscribe(self.update_progress)
+        self.progress_events.subscribe(self.log_progress, headless=True)
 
     def set_tab_widget(self, tab_widget: QTabWidget):
 
@@ -70,15 +91,29 @@ class VolumetericAcquisition(WidgetBase):
         menu.addAction(add_scan)
         # Create table widget
         col_headers = ['start_pos_um' ,'ext_storage_dir','local_storage_dir','subject_id','tile_prefix','volume_x_um',
-                      'volume_y_um','volume_z_um','channels', '']
+                      'volume_y_um','volume_z_um','channels', 'pinned', '']
         self.scan_table_widget = QTableWidget()
-        self.scan_table_widget.setColumnCount(10)
+        self.scan_table_widget.setColumnCount(len(col_headers))
         self.scan_table_widget.setHorizontalHeaderLabels(col_headers)
         self.scan_table_widget.setRowCount(0)
         # Create a QAction to put scan table in menu
         table = QWidgetAction(self.start_image_qwidget)
         table.setDefaultWidget(self.scan_table_widget)
         menu.addAction(table)
+        # Reorder scans to cut stage travel and show estimated travel time
+        optimize = QAction("Optimize Scan Order", self.start_image_qwidget)
+        optimize.triggered.connect(self.optimize_scan_order)
+        menu.addAction(optimize)
+        self.travel_label = QLabel()
+        travel = QWidgetAction(self.start_image_qwidget)
+        travel.setDefaultWidget(self.travel_label)
+        menu.addAction(travel)
+        menu.aboutToShow.connect(self.update_travel_estimate)
+        # Pick up queue of a run that was interrupted by a crash
+        self.resume_action = QAction("Resume Interrupted Queue", self.start_image_qwidget)
+        self.resume_action.triggered.connect(self.resume_queue)
+        menu.addAction(self.resume_action)
+        menu.aboutToShow.connect(lambda: self.resume_action.setEnabled(self.journal.pending() != []))
         # Set menu
         menu.setMinimumWidth(1000)
         self.volumetric_image['start'].setMenu(menu)
@@ -92,10 +127,15 @@ class VolumetericAcquisition(WidgetBase):
     def setup_additional_scan(self):
         """Add scan to imaging run"""
 
-        with self.instrument.stage_query_lock:
-            position = self.instrument.sample_pose.get_position()
+        position = self.position_service.get_position(max_age_s=.5)
+        self.add_scan({'start_pos_um': {k: round(1/10*v, 1) for k, v in position.items()}})
 
-        scan_info = { 'start_pos_um' : {k:round(1/10*v,1) for k,v in position.items()},
+    def add_scan(self, scan: dict):
+        """Add scan to acquisition order and scan table. Values not in scan are taken from config
+        :param scan: scan values keyed like acquisition_order e.g. start_pos_um and volume_x_um
+        :return: True if scan was added"""
+
+        scan_info = { 'start_pos_um' : scan['start_pos_um'],
                       'ext_storage_dir': self.cfg.ext_storage_dir,
                       'local_storage_dir': self.cfg.local_storage_dir,
                       'subject_id': self.cfg.subject_id,
@@ -105,11 +145,19 @@ class VolumetericAcquisition(WidgetBase):
                       'volume_z_um': self.cfg.volume_z_um,
                       'channels': self.cfg.imaging_wavelengths
         }
-        # Check if scan is will exceed stage limits. Will use config values and current pos
-        if self.exceed_stage_limit_check():
-            return
+        scan_info.update({k: v for k, v in scan.items() if k in scan_info})
+        # Check if scan is will exceed stage limits
+        if self.exceed_stage_limit_check(scan_info['start_pos_um'], {k: scan_info[f'volume_{k}_um']
+                                                                     for k in ['x', 'y', 'z']}):
+            return False
         # Add scan to acquisition dictionary
         self.acquisition_order[len(self.acquisition_order)] = scan_info
+        self.add_table_row(scan_info)
+        return True
+
+    def add_table_row(self, scan_info: dict, pinned: bool = False):
+        """Add row showing scan to scan_table_widget with pin checkbox and delete button"""
+
         self.scan_table_widget.insertRow(self.scan_table_widget.rowCount())
         row = self.scan_table_widget.rowCount()-1
         i = 0
@@ -117,11 +165,23 @@ class VolumetericAcquisition(WidgetBase):
             self.scan_table_widget.setItem(row, i, QTableWidgetItem(str(v)))
             i += 1
 
+        # create pin checkbox so optimizing order leaves scan in place
+        pin = QCheckBox(self.scan_table_widget)
+        pin.setChecked(pinned)
+        self.scan_table_widget.setCellWidget(row, self.scan_table_widget.columnCount()-2, pin)
         # create a delete button
         self.table_delete_button(row)
 
         self.cells_changed = [] # Reset cells changed to ignore items added
 
+    def add_scans(self, scans: list):
+        """Add planned scans to imaging run
+        :param scans: list of scans to add with add_scan
+        :return: number of scans added"""
+
+        self.configure_scans()  # Save edits to existing scans before rows are added
+        return sum(self.add_scan(scan) for scan in scans)
+
     def remove_scan(self, pushed, row):
         """Remove scan of row where button was pushed and reconfigures acquisition order"""
         for i in self.cells_changed:
@@ -133,8 +193,11 @@ class VolumetericAcquisition(WidgetBase):
         for i in keys: # Shift dictionary and cells to match rows
             if i < row: continue
             self.acquisition_order[i-1] = self.acquisition_order[i]
-            self.scan_table_widget.removeCellWidget(i-1, len(self.acquisition_order[i]))  # Remove delete button
+            self.scan_table_widget.removeCellWidget(i-1, self.scan_table_widget.columnCount()-1)  # Remove delete button
             self.table_delete_button(i-1) # create a delete button
+        if keys and keys[-1] > row:
+            del self.acquisition_order[keys[-1]]    # Last scan was shifted down a row
+        self.update_travel_estimate()
 
     def table_delete_button(self, row):
         """Convenient function for creating delete button at certain row in scan_table_widget"""
@@ -144,6 +207,46 @@ class VolumetericAcquisition(WidgetBase):
         self.scan_table_widget.setCellWidget(row, self.scan_table_widget.columnCount()-1, delete)
         delete.clicked.connect(lambda pushed=True, row=row: self.remove_scan(pushed, row))
 
+    def pinned_scans(self):
+        """Rows of scan table that are pinned in place"""
+
+        column = self.scan_table_widget.columnCount()-2
+        return {row for row in range(self.scan_table_widget.rowCount())
+                if self.scan_table_widget.cellWidget(row, column).isChecked()}
+
+    def scan_start_um(self):
+        """Current stage position in um"""
+
+        return {k: v/10 for k, v in self.position_service.get_position(max_age_s=1).items()}
+
+    def update_travel_estimate(self):
+        """Show estimated stage travel time between scans in current order"""
+
+        if len(self.acquisition_order) == 0:
+            self.travel_label.setText('')
+            return
+        times = travel_matrix(list(self.acquisition_order.values()), self.scan_start_um())
+        self.travel_label.setText(f'Estimated stage travel: {route_time(list(range(len(times)-1)), times):.0f} s')
+
+    def optimize_scan_order(self):
+        """Reorder unpinned scans to minimize stage travel and rebuild scan table in new order"""
+
+        if len(self.acquisition_order) < 2:
+            return
+        self.configure_scans()  # Save edits before rows move
+        pinned = self.pinned_scans()
+        scans = list(self.acquisition_order.values())
+        order, before, after = optimize_order(scans, self.scan_start_um(), pinned)
+        self.log.info(f'Reordered scans {order}. Estimated stage travel {before:.0f} s -> {after:.0f} s')
+
+        self.acquisition_order = {i: scans[j] for i, j in enumerate(order)}
+        self.scan_table_widget.blockSignals(True)
+        self.scan_table_widget.setRowCount(0)
+        for j in order:
+            self.add_table_row(scans[j], j in pinned)
+        self.scan_table_widget.blockSignals(False)
+        self.travel_label.setText(f'Estimated stage travel: {before:.0f} s -> {after:.0f} s')
+
     def table_items_changed(self, cell):
         """Function to keep track of changes made in scan_table widget"""
 
@@ -188,12 +291,10 @@ class VolumetericAcquisition(WidgetBase):
         """Check if scan with parameters in the cfg will exceed stage limits
         :param start_pos_um: start position of scan in um"""
 
-        with self.instrument.stage_query_lock:
-            limits_mm = self.instrument.sample_pose.get_travel_limits(*['x', 'y', 'z'])
+        limits_mm = self.position_service.get_travel_limits(*['x', 'y', 'z'])
         limits_um = {k:[v[0]*1000,v[1]*1000] for k, v in limits_mm.items()}
         if start_pos_um == None:
-            with self.instrument.stage_query_lock:
-                start_pos = self.instrument.sample_pose.get_position()
+            start_pos = self.position_service.get_position(max_age_s=.5)
             start_pos_um = {k:v/10 for k,v in start_pos.items()}
         limit_exceeded = []
         for k in limits_um.keys():
@@ -252,23 +353,34 @@ class VolumetericAcquisition(WidgetBase):
 
                     self.volumetric_image['start'].blockSignals(False)
                     return
+        self.queue_s = self.predict_queue_s()
+        self.scan_ids = self.journal.start_queue(list(self.acquisition_order.values()))
+        self.progress_events.start_run(len(self.acquisition_order))
         self.run_worker = self._run()
         self.run_worker.finished.connect(lambda: self.end_scan())  # Napari threads have finished signals
         self.run_worker.start()
 
         self.viewer.layers.clear()  # Clear existing layers
-        self.volumetric_image_worker = create_worker(self.instrument._acquisition_livestream_worker)
-        self.volumetric_image_worker.yielded.connect(self.update_layer)
+        self.volumetric_image_worker = create_worker(self._acquisition_frame_worker)
+        self.volumetric_image_worker.yielded.connect(self.frame_pacer.push)
         self.volumetric_image_worker.start()
+        self.frame_pacer.start()
 
-        self.progress_worker = self._progress_bar_worker()
-        self.progress_worker.start()
+    def _acquisition_frame_worker(self):
+
+        """Pass acquisition frames on for display and report each one as progress"""
+
+        for frame in self.instrument._acquisition_livestream_worker():
+            if self.instrument.total_tiles is not None:     # Counts are from last scan until next one starts
+                self.progress_events.frame(self.instrument.latest_frame_layer or 0,
+                                           self.instrument.tiles_acquired or 0)
+            yield frame
 
     @thread_worker
     def _run(self):
 
         sleep(5)
-        for scan in self.acquisition_order.values():
+        for index, (scan_id, scan) in enumerate(zip(self.scan_ids, self.acquisition_order.values())):
             #Set up config for each scan
             for k, v in scan.items():
                 if k == 'start_pos_um':
@@ -280,20 +392,60 @@ class VolumetericAcquisition(WidgetBase):
                 self.tab_widget.setTabEnabled(i,False)
             self.instrument.cfg.save()
 
-
-            self.instrument.run(overwrite=self.volumetric_image['overwrite'].isChecked())
+            # Journal tile grid and order so an interrupted scan can be split into the tiles left even if config changes
+            x_step, y_step = self.instrument.get_xy_grid_step(self.cfg.tile_overlap_x_percent,
+                                                              self.cfg.tile_overlap_y_percent)
+            xtiles, ytiles, ztiles = self.instrument.get_tile_counts(self.cfg.tile_overlap_x_percent,
+                                                                     self.cfg.tile_overlap_y_percent,
+                                                                     self.cfg.z_step_size_um, scan['volume_x_um'],
+                                                                     scan['volume_y_um'], scan['volume_z_um'])
+            features = scan_features(self.cfg, xtiles, ytiles, ztiles)
+            sequence = tile_sequence(xtiles, ytiles, features['tiles'] // max(xtiles * ytiles, 1))
+            self.journal.append('running', scan_id, grid={'xtiles': xtiles, 'ytiles': ytiles,
+                                                          'x_step_um': x_step, 'y_step_um': y_step,
+                                                          'sequence': sequence})
+            self.tile_timer = TileTimer(self.timing.predict_tile_s(features))
+            self.progress_events.start_scan(index, features['tiles'], features['frames'], timer=self.tile_timer)
+            with TileJournaler(self.journal, self.progress_events, scan_id):
+                self.instrument.run(overwrite=self.volumetric_image['overwrite'].isChecked())
+            self.progress_events.end_scan()
+            self.journal.append('finished', scan_id)
+            self.timing.record(features, self.tile_timer.times)
+            self.tile_timer = None
             dest = str(self.instrument.img_storage_dir) if self.instrument.img_storage_dir != None else str(self.instrument.cache_storage_dir)
             self.scans.append(dest)
             self.volumetric_image['start'].blockSignals(False)
             self.volumetric_image['start'].released.emit()  # Signal that scans are done
             self.volumetric_image['start'].blockSignals(True)
+        self.journal.append('complete')
+
+    def resume_queue(self):
+        """Load unfinished scans of an interrupted queue and run them. Scan that was running is restarted from its
+        first tile that didn't finish"""
+
+        pending = self.journal.pending()
+        if pending == []:
+            return
+        scans = []
+        for entry in pending:
+            if entry['state'] == 'running' and 'grid' in entry:
+                scans += remaining_scans(entry['scan'], entry['tiles_done'], **entry['grid'])
+            else:
+                scans.append(entry['scan'])
+        self.log.info(f'Resuming {len(pending)} unfinished scans of interrupted queue as {len(scans)} scans')
+        self.acquisition_order = {}
+        self.scan_table_widget.setRowCount(0)
+        self.add_scans(scans)
+        self.run_volumeteric_imaging()
 
     def end_scan(self):
 
         self.run_worker.quit()
         self.volumetric_image_worker.quit()
-        self.progress_worker.quit()
-        QtCore.QMetaObject.invokeMethod(self.progress['bar'], f'setValue', QtCore.Q_ARG(int, round(100)))
+        self.frame_pacer.stop()
+        self.log.info(f'Acquisition preview display rate: {self.frame_pacer.stats()}')
+        self.progress_events.end_run()
+        self.log.info(f'Progress events: {self.progress_events.stats()}')
         for i in range(1,len(self.tab_widget)):
             self.tab_widget.setTabEnabled(i,True)
         self.volumetric_image['start'].blockSignals(False)
@@ -310,61 +462,63 @@ class VolumetericAcquisition(WidgetBase):
 
         return self.create_layout(struct='H', **self.progress)
 
-    @thread_worker
-    def _progress_bar_worker(self):
-        """Displays progress bar of the current scan"""
-        while self.instrument.total_tiles == None or self.instrument.est_run_time == None:
-            sleep(.5)
-            yield
-        scan_num = len(self.acquisition_order.values()) if not self.instrument.overview_set.is_set() else 1
-
-        for i in range(0, scan_num):
-            QtCore.QMetaObject.invokeMethod(self.progress['bar'], 'setHidden', QtCore.Q_ARG(bool, False))
-            QtCore.QMetaObject.invokeMethod(self.progress['end_time'], 'setHidden', QtCore.Q_ARG(bool, False))
-            QtCore.QMetaObject.invokeMethod(self.progress['bar'], 'setValue', QtCore.Q_ARG(int, 0))
-            while self.instrument.total_tiles == None or self.instrument.est_run_time == None:
-                yield
-                sleep(.5)
-            # Calculate total tiles within all stacks
-            if self.cfg.acquisition_style == 'interleaved' and not self.instrument.overview_set.is_set():
-                total_tiles = self.instrument.total_tiles*len(self.cfg.imaging_wavelengths)
-                z_tiles = total_tiles / self.instrument.x_y_tiles
-                time_scale = self.instrument.x_y_tiles/86400
-            else:
-                total_tiles = self.instrument.total_tiles * (len(self.cfg.imaging_wavelengths))^2
-                z_tiles = self.instrument.total_tiles/self.instrument.x_y_tiles
-                time_scale = (self.instrument.x_y_tiles * len(self.cfg.imaging_wavelengths))/86400
-
-            pct = 0
-            while self.instrument.total_tiles != None:
-                pct = (self.instrument.latest_frame_layer+(self.instrument.tiles_acquired*z_tiles))/total_tiles \
-                    if self.instrument.latest_frame_layer != 0 else pct
-                QtCore.QMetaObject.invokeMethod(self.progress['bar'], f'setValue', QtCore.Q_ARG(int, round(pct*100)))
-                yield
-                # Qt threads are so weird. Can't invoke repaint method outside of main thread and Qthreads don't play nice
-                # with napari threads so QMetaObject is static read-only instances
-
-                if self.instrument.tiles_acquired == 0:
-                    yield
-                    completion_date = self.instrument.start_time + timedelta(days=self.instrument.est_run_time) \
-                        if self.instrument.est_run_time != None else datetime.now()
+    def update_progress(self, state: dict):
+        """Show progress state coalesced by progress_events. Runs on gui thread"""
 
-                else:
-                    yield
-                    total_time_days = self.instrument.tile_time_s*time_scale
-                    completion_date = self.instrument.start_time + timedelta(days=total_time_days)
-
-                if completion_date >= datetime.now():
-                    date_str = completion_date.strftime("%d %b, %Y at %H:%M %p")
-                    weekday = calendar.day_name[completion_date.weekday()]
-                    end_time = f'{weekday}, {date_str}'
-                else:
-                    end_time = '¯\_(ツ)_/¯'
-                self.progress['end_time'].setText(f"End Time: {end_time}")
-                sleep(.5)
-                yield  # So thread can stop
+        if 'bar' not in self.progress:
+            return
+        if state['event'] == 'run_start':
+            self.progress['bar'].setHidden(False)
+            self.progress['end_time'].setHidden(False)
+        self.progress['bar'].setValue(round(100 if state['event'] == 'run_end' else state['fraction'] * 100))
+
+        if not state['running']:
             end_time = datetime.now().strftime("%d %b, %Y at %H:%M %p")
             self.progress['end_time'].setText(f"End Time: {end_time}")
+            return
+        # Smoothed time of finished tiles, seeded with prediction from past runs, plus predicted time of scans queued
+        queued = timedelta(seconds=sum(self.queue_s[state['scan'] + 1:]))
+        if state['eta_s'] is not None:
+            completion_date = datetime.now() + timedelta(seconds=state['eta_s']) + queued
+        elif self.instrument.est_run_time != None and self.instrument.start_time != None:
+            completion_date = self.instrument.start_time + timedelta(days=self.instrument.est_run_time) + queued
+        else:
+            completion_date = datetime.now()
+
+        if completion_date >= datetime.now():
+            date_str = completion_date.strftime("%d %b, %Y at %H:%M %p")
+            weekday = calendar.day_name[completion_date.weekday()]
+            end_time = f'{weekday}, {date_str}'
+        else:
+            end_time = '¯\_(ツ)_/¯'
+        self.progress['end_time'].setText(f"End Time: {end_time}")
+
+    def predict_queue_s(self):
+
+        """Predicted seconds of every scan in acquisition order, from past runs or the instrument estimate. Config
+        is left set up for the last scan like it is after the scan summaries"""
+
+        seconds = []
+        for scan in self.acquisition_order.values():
+            for k, v in scan.items():
+                if k != 'start_pos_um':
+                    setattr(self.cfg, k, v)
+            x, y, z = self.instrument.get_tile_counts(self.cfg.tile_overlap_x_percent,
+                                                      self.cfg.tile_overlap_y_percent,
+                                                      self.cfg.z_step_size_um,
+                                                      scan['volume_x_um'], scan['volume_y_um'], scan['volume_z_um'])
+            days, _ = self.timing.predict_days(scan_features(self.cfg, x, y, z),
+                                               self.instrument.acquisition_time(x, y, z))
+            seconds.append((days or 0) * 86400)
+        return seconds
+
+    def log_progress(self, event: dict):
+        """Log scan boundaries reported to progress_events"""
+
+        if event['event'] == 'scan_start':
+            self.log.info(f"Scan {event['scan']} started: {event['tiles']} tiles of {event['frames_per_tile']} frames")
+        elif event['event'] in ['scan_end', 'run_start', 'run_end']:
+            self.log.info(f"Acquisition {event['event'].replace('_', ' ')}")
 
     def scan_summary(self):
 
@@ -374,12 +528,14 @@ class VolumetericAcquisition(WidgetBase):
                                                            self.cfg.volume_x_um,
                                                            self.cfg.volume_y_um,
                                                            self.cfg.volume_z_um)
+        days, learned = self.timing.predict_days(scan_features(self.cfg, x, y, z),
+                                                 self.instrument.acquisition_time(x, y, z))
         msgBox = QMessageBox()
         msgBox.setIcon(QMessageBox.Information)
         msgBox.setText(f"Scan Summary\n"
-                       f"Start (um): {self.instrument.start_pos if self.instrument.start_pos != None else self.instrument.sample_pose.get_position()}\n"
+                       f"Start (um): {self.instrument.start_pos if self.instrument.start_pos != None else self.position_service.get_position()}\n"
                        f"Lasers: {self.cfg.imaging_wavelengths}\n"
-                       f"Time: {round(self.instrument.acquisition_time(x, y, z), 3)} days\n"
+                       f"Time: {round(days, 3)} days ({'from past runs' if learned else 'instrument estimate'})\n"
                        f"X Tiles: {x}\n"
                        f"Y Tiles: {y}\n"
                        f"Z Tiles: {z}\n"
@@ -0,0 +1,141 @@
+import hashlib
+import importlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Config values waveforms are computed from. Changing anything else, e.g. filenames or acquisition style, keeps cache
+WAVEFORM_ATTRIBUTES = ('exposure_time', 'exposure_time_s', 'slit_width_pix', 'line_time_us', 'scan_direction',
+                       'row_count_px', 'column_count_px', 'daq_ao_names_to_channels')
+WAVEFORM_SECTIONS = ('waveform_specs', 'daq_driver_kwds', 'daq_obj_kwds', 'camera_specs', 'design_specs')
+LASER_SECTIONS = ('galvo', 'etl')
+
+
+def waveform_inputs(cfg, lasers):
+
+    """Tuple of every config value waveforms of lasers are computed from
+    :param cfg: instrument config
+    :param lasers: wavelengths waveforms are made for"""
+
+    sections = getattr(cfg, 'cfg', None) or {}
+    laser_specs = getattr(cfg, 'laser_specs', None) or sections.get('laser_specs', {})
+    period = cfg.get_period_time() if hasattr(cfg, 'get_period_time') else None
+    return (tuple(str(laser) for laser in lasers),
+            period,
+            tuple((name, getattr(cfg, name, None)) for name in WAVEFORM_ATTRIBUTES),
+            tuple((name, sections.get(name)) for name in WAVEFORM_SECTIONS),
+            tuple((str(laser), tuple((name, laser_specs.get(str(laser), {}).get(name)) for name in LASER_SECTIONS))
+                  for laser in lasers))
+
+
+def compute_waveforms(cfg, lasers, *args, **kwargs):
+
+    """ispim's generate_waveforms. Imported on first use so importing the cache doesn't import ispim"""
+
+    return importlib.import_module('ispim.compute_waveforms').generate_waveforms(cfg, lasers, *args, **kwargs)
+
+
+class WaveformCache:
+
+    def __init__(self, generate, size: int = 16):
+
+        """Memoizes waveform generation on the config values waveforms are computed from, see waveform_inputs.
+        Least recently used waveforms are evicted once more than size are held.
+            :param generate: function (cfg, lasers) -> (t, voltages) computing waveforms
+            :param size: number of waveform sets kept
+        """
+
+        self.generate = generate
+        self.size = size
+        self.log = logging.getLogger(__name__ + "." + self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.installed = {}     # Module to generate_waveforms it had before install
+
+    def key(self, cfg, lasers):
+
+        """Hash of waveform inputs of config"""
+
+        encoded = json.dumps(waveform_inputs(cfg, lasers), sort_keys=True, default=str).encode()
+        return hashlib.sha1(encoded).hexdigest()
+
+    def __call__(self, cfg, lasers, generate=None):
+
+        """Return cached waveforms or compute and cache them. Cached arrays are read only
+        :param generate: function computing waveforms on a miss. Defaults to the one cache was made with
+        :return: (t, voltages) like generate_waveforms"""
+
+        key = self.key(cfg, lasers)
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            self.misses += 1
+
+        waveforms = tuple((self.generate if generate is None else generate)(cfg, lasers))
+        for array in waveforms:
+            if isinstance(array, np.ndarray):
+                array.flags.writeable = False
+
+        with self.lock:
+            self.cache[key] = waveforms
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+        return waveforms
+
+    def clear(self):
+
+        with self.lock:
+            self.cache.clear()
+
+    def install(self, module):
+
+        """Replace generate_waveforms global of module, e.g. the instrument module, with cached version so the
+        instrument shares the cache without changes to ispim. Arrays are copied for the module since hardware code
+        may modify them. close puts the original back
+        :return: if module used generate_waveforms"""
+
+        if module is None or not hasattr(module, 'generate_waveforms') or module in self.installed:
+            return False
+        original = self.installed[module] = module.generate_waveforms
+
+        def cached_generate_waveforms(cfg, lasers, *args, **kwargs):
+            if args or kwargs:  # Only plain calls are cached
+                return original(cfg, lasers, *args, **kwargs)
+            return tuple(np.array(array) if isinstance(array, np.ndarray) else array
+                         for array in self(cfg, lasers, original))
+
+        module.generate_waveforms = cached_generate_waveforms
+        self.log.info(f'Caching waveforms generated by {module.__name__}')
+        return True
+
+    def close(self):
+
+        """Restore generate_waveforms of installed modules and empty cache"""
+
+        for module, original in self.installed.items():
+            module.generate_waveforms = original
+        self.installed.clear()
+        self.clear()
+
+    def stats(self):
+
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache),
+                'hit_rate': round(self.hits / total, 3) if total else None}
+
+
+waveform_cache = WaveformCache(compute_waveforms)   # Shared between widgets
+
+
+def generate_waveforms(cfg, lasers):
+
+    """Cached drop in for ispim.compute_waveforms.generate_waveforms"""
+
+    return waveform_cache(cfg, lasers)
@@ -5,6 +5,7 @@ from qtpy.QtWidgets import  QMessageBox, QLineEdit, QVBoxLayout, QWidget, \
 import qtpy.QtCore as QtCore
 import numpy as np
 from time import sleep
+from widgets.reconfiguration import ReconfigurationScheduler
 
 class WidgetBase:
 
@@ -20,17 +21,25 @@ class WidgetBase:
         value = float(value)
         if cfg_value != value:
             self.pathSet(dict, path, value)
-            if self.instrument.livestream_enabled.is_set():
-                self.instrument._setup_waveform_hardware(self.instrument.active_lasers,
-                                                         live=self.instrument.livestream_enabled.is_set(),
-                                                         scout_mode=self.instrument.scout_mode)
-                if self.instrument.scout_mode:
-                    self.start_stop_ni()
+            self.reconfigure_hardware()
+
+    def reconfigure_hardware(self):
+
+        """Reprogram waveform hardware with changed config if livestreaming. Changes are debounced and applied off
+        the gui thread by a ReconfigurationScheduler that can be shared between widgets"""
+
+        if getattr(self, 'reconfiguration', None) is None:
+            self.reconfiguration = ReconfigurationScheduler(self.instrument)
+        self.reconfiguration.request()
+
     def start_stop_ni(self):
         """Start and stop ni task """
-        self.instrument.ni.start()
-        sleep(self.cfg.get_period_time())
-        self.instrument.ni.stop()
+        if getattr(self, 'reconfiguration', None) is None:
+            self.reconfiguration = ReconfigurationScheduler(self.instrument)
+        with self.reconfiguration.ni_lock:
+            self.instrument.ni.start()
+            sleep(self.cfg.get_period_time())
+            self.instrument.ni.stop()
 
     def scan(self, dictionary: dict, attr: str, prev_key: str = None, QDictionary: dict = None,
              WindowDictionary: dict = None, wl: str = None, input_type: str = QLineEdit, subdict: bool = False):
@@ -69,18 +78,26 @@ class WidgetBase:
 
     def update_layer(self, args):
 
-        """Update viewer with latest image"""
+        """Update viewer with latest image
+        :param args: (image, layer) or (image, layer, pyramid level) tuple. Level n is downsampled 2^n times"""
         try:
-            (image, layer) = args
+            (image, layer, *level) = args
             key = f'Wavelength {layer}'
             layer = self.viewer.layers[key]
+            if layer._slice.image._view.shape != image.shape:
+                # Pyramid level changed so swap data and rescale layer to keep the same size in the viewer
+                factor = 2 ** level[0] if level else 1
+                layer.data = image
+                layer.scale = [factor * self.cfg.tile_specs['x_field_of_view_um'] / self.cfg.sensor_row_count,
+                               factor * self.cfg.tile_specs['y_field_of_view_um'] / self.cfg.sensor_column_count]
             layer._slice.image._view = image
             layer.events.set_data()
 
         except KeyError:
 
-            self.viewer.add_image(image, name = key, scale=[self.cfg.tile_specs['x_field_of_view_um'] / self.cfg.sensor_row_count,
-                      self.cfg.tile_specs['y_field_of_view_um'] / self.cfg.sensor_column_count])
+            factor = 2 ** level[0] if level else 1
+            self.viewer.add_image(image, name = key, scale=[factor * self.cfg.tile_specs['x_field_of_view_um'] / self.cfg.sensor_row_count,
+                      factor * self.cfg.tile_specs['y_field_of_view_um'] / self.cfg.sensor_column_count])
             #self.viewer.layers[key].mouse_drag_callbacks.append(self.on_click)
             self.viewer.layers[key].rotate = 90
             self.viewer.layers[key].blending = 'additive'
@@ -158,8 +175,7 @@ class WidgetBase:
         value = value_type(widget.text())
         if getattr(obj, var, value) != value:
             setattr(obj, var, value)
-            if self.instrument.livestream_enabled.is_set():
-                self.instrument._setup_waveform_hardware(self.instrument.active_lasers, live=True)
+            self.reconfigure_hardware()
 
     def error_msg(self, title: str, msg: str):
 